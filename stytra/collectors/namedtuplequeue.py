@@ -1,25 +1,35 @@
 from multiprocessing import Queue
 from collections import namedtuple
+import numpy as np
 
 
 class NamedTupleQueue:
+    """ A queue for namedtuples which sends the field names only when
+    the type of the tuples changes. It also accepts one-row structured
+    NumPy arrays with float64 fields (as output by pipelines in record mode),
+    which are sent as raw bytes and received as namedtuples.
+
+    """
+
     def __init__(self, *args, **kwargs):
         self.q = Queue()
         self.tuple_type = None
 
     def put(self, t, obj, block=True, timeout=None):
-        if self.tuple_type != type(obj):
-            self.tuple_type = type(obj)
-            self.q.put(
-                (t, ("_fieldnames",) + obj._fields), block=block, timeout=timeout
-            )
-        self.q.put((t, tuple(obj)), block=block, timeout=timeout)
+        if isinstance(obj, np.ndarray):
+            obj_type, fields, payload = obj.dtype, obj.dtype.names, obj.tobytes()
+        else:
+            obj_type, fields, payload = type(obj), obj._fields, tuple(obj)
+        if self.tuple_type is not obj_type:
+            self.tuple_type = obj_type
+            self.q.put((t, ("_fieldnames",) + fields), block=block, timeout=timeout)
+        self.q.put((t, payload), block=block, timeout=timeout)
 
     def get(self, block=True, timeout=-1):
         t, el = self.q.get(block=block, timeout=timeout)
         if self.tuple_type is None or el[0] == "_fieldnames":
             self.tuple_type = namedtuple("t", el[1:])
-            t, obtained = self.q.get(block=block, timeout=timeout)
-            return t, self.tuple_type(*obtained)
-        else:
-            return t, self.tuple_type(*el)
+            t, el = self.q.get(block=block, timeout=timeout)
+        if isinstance(el, bytes):
+            return t, self.tuple_type(*np.frombuffer(el, dtype=np.float64))
+        return t, self.tuple_type(*el)
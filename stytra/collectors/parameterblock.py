@@ -0,0 +1,58 @@
+from multiprocessing import Lock, RawValue, RawArray
+import ctypes
+import pickle
+
+
+class ParameterBlock:
+    """ A block of shared memory to send parameter changes (as dictionaries
+    of dictionaries of changed values, like the ones from
+    Pipeline.serialize_changed_params) to another process.
+    Writing the changes increments a generation counter, so the reading
+    process can check if there is anything new with a single read of shared
+    memory, instead of polling a queue.
+
+    Changes written before the previous ones were read are merged with them.
+
+    """
+
+    def __init__(self, max_bytes=2 ** 16):
+        self.lock = Lock()
+        self.generation = RawValue(ctypes.c_uint64, 0)
+        self.n_bytes = RawValue(ctypes.c_uint64, 0)
+        self.buffer = RawArray(ctypes.c_char, max_bytes)
+
+        # the last generation read, each reading process has its own copy
+        self.read_generation = 0
+
+    def put(self, changes):
+        changes = {item: vals for item, vals in changes.items() if vals}
+        if not changes:
+            return
+        with self.lock:
+            if self.n_bytes.value > 0:
+                unread = pickle.loads(self.buffer.raw[: self.n_bytes.value])
+                for item, vals in changes.items():
+                    unread.setdefault(item, dict()).update(vals)
+                changes = unread
+            serialized = pickle.dumps(changes)
+            if len(serialized) > len(self.buffer):
+                raise ValueError(
+                    "Parameter changes do not fit in the {} bytes of the block".format(
+                        len(self.buffer)
+                    )
+                )
+            self.buffer[: len(serialized)] = serialized
+            self.n_bytes.value = len(serialized)
+            self.generation.value += 1
+
+    def get(self):
+        """ Returns the changes written since the last call, or None
+        if there are none
+        """
+        if self.generation.value == self.read_generation:
+            return None
+        with self.lock:
+            self.read_generation = self.generation.value
+            changes = pickle.loads(self.buffer.raw[: self.n_bytes.value])
+            self.n_bytes.value = 0
+        return changes
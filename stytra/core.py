@@ -83,7 +83,8 @@ class Stytra:
             preprocessing_method: str, optional
                "prefilter" or "bgsub"
             method: str
-                one of "tail", "eyes" or "fish"
+                one of "tail", "tail_angles", "multi_tail", "eyes",
+                "eyes_moments" or "fish"
             estimator: str or class
                 for closed-loop experiments: either "vigor" for embedded experiments
                     or "position" for freely-swimming ones. A custom estimator can be supplied.
@@ -1,12 +1,18 @@
 from stytra.tracking.pipelines import Pipeline
 from stytra.tracking.preprocessing import Prefilter, BackgroundSubtractor
-from stytra.tracking.tail import CentroidTrackingMethod
-from stytra.tracking.fish import FishTrackingMethod
-from stytra.tracking.eyes import EyeTrackingMethod
+from stytra.tracking.tail import (
+    CentroidTrackingMethod,
+    AnglesTrackingMethod,
+    MultiTailTrackingMethod,
+)
+from stytra.tracking.fish import FishTrackingMethod, WellTrackingMethod
+from stytra.tracking.eyes import EyeTrackingMethod, MomentEyeTrackingMethod
 from stytra.gui.fishplots import TailStreamPlot, BoutPlot
 from stytra.gui.camera_display import (
     TailTrackingSelection,
+    MultiTailTrackingSelection,
     CameraViewFish,
+    CameraViewWells,
     EyeTrackingSelection,
     EyeTailTrackingSelection,
 )
@@ -21,6 +27,23 @@ class TailTrackingPipeline(Pipeline):
         self.display_overlay = TailTrackingSelection
 
 
+class TailAnglesTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.filter = Prefilter(parent=self.root)
+        self.tailtrack = AnglesTrackingMethod(parent=self.filter)
+        self.extra_widget = TailStreamPlot
+        self.display_overlay = TailTrackingSelection
+
+
+class MultiTailTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.filter = Prefilter(parent=self.root)
+        self.tailtrack = MultiTailTrackingMethod(parent=self.filter)
+        self.display_overlay = MultiTailTrackingSelection
+
+
 class FishTrackingPipeline(Pipeline):
     def __init__(self):
         super().__init__()
@@ -30,6 +53,14 @@ class FishTrackingPipeline(Pipeline):
         self.display_overlay = CameraViewFish
 
 
+class WellTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.bgsub = BackgroundSubtractor(parent=self.root)
+        self.fishtrack = WellTrackingMethod(parent=self.bgsub)
+        self.display_overlay = CameraViewWells
+
+
 class EyeTrackingPipeline(Pipeline):
     def __init__(self):
         super().__init__()
@@ -38,6 +69,13 @@ class EyeTrackingPipeline(Pipeline):
         self.display_overlay = EyeTrackingSelection
 
 
+class MomentEyeTrackingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.eyetrack = MomentEyeTrackingMethod(parent=self.root)
+        self.display_overlay = EyeTrackingSelection
+
+
 class EyeTailTrackingPipeline(Pipeline):
     def __init__(self):
         super().__init__()
@@ -50,7 +88,11 @@ class EyeTailTrackingPipeline(Pipeline):
 
 pipeline_dict = dict(
     tail=TailTrackingPipeline,
+    tail_angles=TailAnglesTrackingPipeline,
+    multi_tail=MultiTailTrackingPipeline,
     fish=FishTrackingPipeline,
+    wells=WellTrackingPipeline,
     eyes=EyeTrackingPipeline,
+    eyes_moments=MomentEyeTrackingPipeline,
     eyes_tail=EyeTailTrackingPipeline,
 )
@@ -21,9 +21,10 @@ from stytra.collectors import (
     EstimatorLog,
     FramerateQueueAccumulator,
 )
-from stytra.tracking.tracking_process import TrackingProcess
+from stytra.tracking.tracking_process import TrackingProcess, ParallelTrackingProcess
 from stytra.tracking.pipelines import Pipeline
 from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.collectors.parameterblock import ParameterBlock
 from stytra.experiments.fish_pipelines import pipeline_dict
 
 from stytra.stimulation.estimators import estimator_dict
@@ -185,6 +186,19 @@ class TrackingExperiment(CameraVisualExperiment):
             containing fields:  tracking_method
                                 estimator: can be vigor for embedded fish, position
                                     for freely-swimming, or a custom subclass of Estimator
+                                record_output: (optional) if True the tracking
+                                    process writes the pipeline output in a
+                                    preallocated structured array
+                                branch_threads: (optional) number of threads
+                                    to run independent pipeline branches
+                                    (e.g. eyes and tail tracking) in parallel
+                                timing_interval: (optional) if set, the processing
+                                    time of every pipeline node is summarized
+                                    over this interval (in seconds), plotted
+                                    and saved in the tracking_timing_log
+                                n_workers: (optional) number of tracking
+                                    processes, for pipelines without stateful
+                                    nodes. The outputs are reordered by frame.
 
     Returns
     -------
@@ -201,7 +215,7 @@ class TrackingExperiment(CameraVisualExperiment):
                            in the child).
         """
 
-        self.processing_params_queue = Queue()
+        self.processing_params = ParameterBlock()
         self.tracking_output_queue = NamedTupleQueue()
         self.finished_sig = Event()
         super().__init__(*args, **kwargs)
@@ -217,14 +231,28 @@ class TrackingExperiment(CameraVisualExperiment):
             else tracking["method"]
         )
 
-        self.frame_dispatcher = TrackingProcess(
+        n_workers = tracking.get("n_workers", 1)
+        if n_workers > 1:
+            tracking_process_cls = ParallelTrackingProcess
+            worker_kwargs = dict(n_workers=n_workers)
+            # each worker takes frames from the camera queue
+            self.camera.n_consumers = n_workers
+        else:
+            tracking_process_cls = TrackingProcess
+            worker_kwargs = dict()
+
+        self.frame_dispatcher = tracking_process_cls(
             in_frame_queue=self.camera.frame_queue,
             finished_signal=self.camera.kill_event,
             pipeline=self.pipeline_cls,
-            processing_parameter_queue=self.processing_params_queue,
+            parameter_block=self.processing_params,
             output_queue=self.tracking_output_queue,
             recording_signal=self.recording_event,
             gui_framerate=20,
+            record_output=tracking.get("record_output", False),
+            branch_threads=tracking.get("branch_threads", 0),
+            timing_interval=tracking.get("timing_interval", None),
+            **worker_kwargs
         )
         if self.pipeline_cls is None:
             raise NameError("The selected tracking method does not exist!")
@@ -246,6 +274,25 @@ class TrackingExperiment(CameraVisualExperiment):
         # Tracking is reset at experiment start:
         self.protocol_runner.sig_protocol_started.connect(self.acc_tracking.reset)
 
+        if self.frame_dispatcher.timing_queue is not None:
+            self.acc_tracking_timing = QueueDataAccumulator(
+                name="tracking_timing",
+                experiment=self,
+                data_queue=self.frame_dispatcher.timing_queue,
+                monitored_headers=[
+                    col
+                    for col in self.pipeline.timing_columns
+                    if col.endswith("_mean")
+                ],
+            )
+            self.acc_tracking_timing.sig_acc_init.connect(self.refresh_plots)
+            self.gui_timer.timeout.connect(self.acc_tracking_timing.update_list)
+            self.protocol_runner.sig_protocol_started.connect(
+                self.acc_tracking_timing.reset
+            )
+        else:
+            self.acc_tracking_timing = None
+
         # start frame dispatcher process:
         self.frame_dispatcher.start()
 
@@ -300,6 +347,8 @@ class TrackingExperiment(CameraVisualExperiment):
         super().reset()
         self.acc_tracking_framerate.reset()
         self.acc_tracking.reset()
+        if self.acc_tracking_timing is not None:
+            self.acc_tracking_timing.reset()
         if self.estimator is not None:
             self.estimator.reset()
             self.estimator_log.reset()
@@ -318,6 +367,8 @@ class TrackingExperiment(CameraVisualExperiment):
     def refresh_plots(self):
         self.window_main.stream_plot.remove_streams()
         self.window_main.stream_plot.add_stream(self.acc_tracking)
+        if self.acc_tracking_timing is not None:
+            self.window_main.stream_plot.add_stream(self.acc_tracking_timing)
         if self.estimator is not None:
             self.window_main.stream_plot.add_stream(self.estimator_log)
 
@@ -328,8 +379,8 @@ class TrackingExperiment(CameraVisualExperiment):
             self.window_main.stream_plot.add_stream(self.protocol_runner.dynamic_log)
 
     def send_gui_parameters(self):
-        """Called upon gui timeout, put tracking parameters in the relative
-        queue.
+        """Called upon gui timeout, write the changed tracking parameters
+        in the shared parameter block.
 
         Parameters
         ----------
@@ -339,7 +390,7 @@ class TrackingExperiment(CameraVisualExperiment):
 
         """
         super().send_gui_parameters()
-        self.processing_params_queue.put(self.pipeline.serialize_changed_params())
+        self.processing_params.put(self.pipeline.serialize_changed_params())
 
     def start_protocol(self):
         # Freeze the plots so the plotting does not interfere with
@@ -380,6 +431,8 @@ class TrackingExperiment(CameraVisualExperiment):
 
         # Save log and estimators:
         self.save_log(self.acc_tracking, "behavior_log")
+        if self.acc_tracking_timing is not None:
+            self.save_log(self.acc_tracking_timing, "tracking_timing_log")
         try:
             self.save_log(self.estimator.log, "estimator_log")
         except AttributeError:
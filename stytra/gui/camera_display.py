@@ -378,6 +378,130 @@ class TailTrackingSelection(CameraSelection):
         return (tsx, tsy), (tlx, tly)
 
 
+class MultiTailTrackingSelection(CameraSelection):
+    """ Displays one ROI for the selection of each tail, for the tracking
+    of several embedded fish. The ROIs are added or removed when the number
+    of tails changes.
+    """
+
+    def __init__(self, **kwargs):
+        """ """
+        super().__init__(**kwargs)
+
+        self.tail_params = self.experiment.pipeline.tailtrack._params
+        self.rois_tail = []
+        self.curves_tail = []
+
+        self.setting_param_val = False
+        self.update_rois()
+
+    def update_rois(self):
+        """ Adds or removes ROIs and curves to match the number of tails"""
+        tails = self.experiment.pipeline.tailtrack.tails()
+        while len(self.rois_tail) > len(tails):
+            self.display_area.removeItem(self.rois_tail.pop())
+            self.display_area.removeItem(self.curves_tail.pop())
+        while len(self.rois_tail) < len(tails):
+            roi = SingleLineROI(
+                self.tail_points(*tails[len(self.rois_tail)]),
+                pen=dict(color=(40, 5, 200), width=3),
+            )
+            curve = pg.PlotCurveItem(pen=dict(color=(230, 40, 5), width=3))
+            self.display_area.addItem(curve)
+            self.rois_tail.append(roi)
+            self.curves_tail.append(curve)
+            self.initialise_roi(roi)
+        # the tails are stored, so that the added ones can be moved
+        self.set_pos_from_roi()
+
+    def set_pos_from_tree(self):
+        """Go to parent for definition."""
+        super().set_pos_from_tree()
+        if not self.setting_param_val:
+            for roi, tail in zip(
+                self.rois_tail, self.experiment.pipeline.tailtrack.tails()
+            ):
+                roi.prepareGeometryChange()
+                p1, p2 = roi.getHandles()
+                np1, np2 = self.tail_points(*tail)
+                p1.setPos(QPointF(*np1))
+                p2.setPos(QPointF(*np2))
+
+    def set_pos_from_roi(self):
+        """Go to parent for definition."""
+        super().set_pos_from_roi()
+
+        # there is always at least one tail
+        if len(self.rois_tail) == 0:
+            return
+
+        self.setting_param_val = True
+
+        tail_starts = []
+        tail_lengths = []
+        for roi in self.rois_tail:
+            p1, p2 = roi.getHandles()
+            tail_starts.append((p1.y() / self.scale, p1.x() / self.scale))
+            tail_lengths.append(
+                ((p2.y() - p1.y()) / self.scale, (p2.x() - p1.x()) / self.scale)
+            )
+        self.tail_params.tail_starts = tail_starts
+        self.tail_params.params.tail_starts.changed = True
+        self.tail_params.tail_lengths = tail_lengths
+        self.tail_params.params.tail_lengths.changed = True
+
+        self.setting_param_val = False
+
+    def scale_changed(self):
+        self.set_pos_from_tree()
+
+    def retrieve_image(self):
+        """Go to parent for definition."""
+        super().retrieve_image()
+
+        if self.current_image is None:
+            return
+
+        if len(self.rois_tail) != self.tail_params.n_tails:
+            self.update_rois()
+
+        if len(self.experiment.acc_tracking.stored_data) > 1:
+            retrieved_data = self.experiment.acc_tracking.values_at_abs_time(
+                self.current_frame_time
+            )
+            for i_tail, (curve, tail) in enumerate(
+                zip(self.curves_tail, self.experiment.pipeline.tailtrack.tails())
+            ):
+                try:
+                    angles = np.array(
+                        [
+                            getattr(retrieved_data, "a{}_theta_{:02d}".format(i_tail, i))
+                            for i in range(self.tail_params.n_output_segments)
+                        ]
+                    )
+                except AttributeError:
+                    # the tracking has not caught up with the number of tails
+                    continue
+                (start_x, start_y), (tail_x, tail_y) = self.tail_points(*tail)
+                tail_segment_length = np.hypot(
+                    tail_x - start_x, tail_y - start_y
+                ) / len(angles)
+                # as in TailTrackingSelection, the angles are
+                # arctan2(x, y) of the segments
+                points_x = start_x + np.concatenate(
+                    [[0], np.cumsum(tail_segment_length * np.sin(angles))]
+                )
+                points_y = start_y + np.concatenate(
+                    [[0], np.cumsum(tail_segment_length * np.cos(angles))]
+                )
+                curve.setData(x=points_x, y=points_y)
+
+    def tail_points(self, tail_start, tail_length):
+        tsy, tsx = (t * self.scale for t in tail_start)
+        tly, tlx = (t * self.scale for t in tail_length)
+        return (tsx, tsy), (tsx + tlx, tsy + tly)
+
+
 class EyeTrackingSelection(CameraSelection):
     def __init__(self, **kwargs):
         """ """
@@ -626,7 +750,7 @@ class CameraViewFish(CameraViewCalib):
             self.current_frame_time
         )
 
-        n_fish = self.tracking_params.n_fish_max
+        n_fish = self.experiment.pipeline.fishtrack.n_tracked
 
         n_data_per_fish = (
             len(current_data) - 1
@@ -648,3 +772,57 @@ class CameraViewFish(CameraViewCalib):
                 self.lines_fish.setData(x=xs, y=ys)
         except ValueError as e:
             pass
+
+
+class CameraViewWells(CameraViewFish):
+    """ Displays the tracked fish and a rectangle ROI for the selection
+    of the multi-well plate, with the grid of the wells
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.roi_plate = pg.ROI(
+            pos=self.tracking_params.wnd_pos,
+            size=self.tracking_params.wnd_dim,
+            pen=dict(color=(5, 40, 200), width=3),
+        )
+        self.roi_plate.addScaleHandle([0, 0], [1, 1])
+        self.roi_plate.addScaleHandle([1, 1], [0, 0])
+        self.lines_wells = pg.PlotCurveItem(
+            connect="pairs", pen=pg.mkPen((5, 40, 200), width=1)
+        )
+        self.display_area.addItem(self.roi_plate)
+        self.display_area.addItem(self.lines_wells)
+        self.roi_plate.sigRegionChanged.connect(self.set_pos_from_roi)
+
+        self.setting_param_val = False
+        self.draw_wells()
+
+    def draw_wells(self):
+        """ Draws the walls between the wells inside the plate rectangle"""
+        (x0, y0), (w, h) = self.tracking_params.wnd_pos, self.tracking_params.wnd_dim
+        n_rows, n_columns = self.tracking_params.n_rows, self.tracking_params.n_columns
+        xs, ys = [], []
+        for i_row in range(1, n_rows):
+            xs.extend([x0, x0 + w])
+            ys.extend([y0 + i_row * h / n_rows] * 2)
+        for i_col in range(1, n_columns):
+            xs.extend([x0 + i_col * w / n_columns] * 2)
+            ys.extend([y0, y0 + h])
+        self.lines_wells.setData(x=np.array(xs, float), y=np.array(ys, float))
+
+    def set_pos_from_tree(self):
+        super().set_pos_from_tree()
+        if not self.setting_param_val:
+            self.roi_plate.setPos(self.tracking_params.wnd_pos, finish=False)
+            self.roi_plate.setSize(self.tracking_params.wnd_dim)
+        self.draw_wells()
+
+    def set_pos_from_roi(self):
+        self.setting_param_val = True
+        self.tracking_params.params.wnd_dim.changed = True
+        self.tracking_params.wnd_dim = tuple([int(p) for p in self.roi_plate.size()])
+        self.tracking_params.params.wnd_pos.changed = True
+        self.tracking_params.wnd_pos = tuple([int(p) for p in self.roi_plate.pos()])
+        self.setting_param_val = False
+        self.draw_wells()
@@ -104,8 +104,14 @@ class TailStreamPlot(QWidget):
             return
         data_array = np.array(self.acc.stored_data[-self.n_points :])
         if len(data_array) > 0:
+            # the other columns (tail sum, confidence...) are not displayed
+            i_angles = [
+                i
+                for i, field in enumerate(self.acc.stored_data[-1]._fields)
+                if field.startswith("theta_")
+            ]
             self.image_item.setImage(
-                image=np.diff(data_array[:, 1:], axis=1).T, autoLevels=False
+                image=np.diff(data_array[:, i_angles], axis=1).T, autoLevels=False
             )
 
 
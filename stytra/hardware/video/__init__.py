@@ -70,7 +70,7 @@ class VideoSource(FrameProcess):
         self.control_queue = Queue()
         self.frame_queue = IndexedArrayQueue(max_mbytes=max_mbytes_queue)
         self.kill_event = Event()
-        self.n_consumers = 1
+        self.n_consumers = n_consumers
         self.state = None
 
     def put_frame(self, frame, messages):
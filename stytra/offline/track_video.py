@@ -18,6 +18,7 @@ from stytra.stimulation.stimuli import Stimulus
 from stytra.experiments.fish_pipelines import pipeline_dict
 from stytra.utilities import save_df
 import imageio
+import numpy as np
 import pandas as pd
 import json
 
@@ -41,7 +42,7 @@ class TrackingDialog(QDialog):
 
 
 class OfflineToolbar(QToolBar):
-    def __init__(self, app, exp, input_path, pipeline_type):
+    def __init__(self, app, exp, input_path, pipeline_type, batch_size=100):
         super().__init__()
         self.app = app
         self.setObjectName("toolbar_offline")
@@ -49,6 +50,7 @@ class OfflineToolbar(QToolBar):
         self.input_path = Path(input_path)
         self.pipeline_type = pipeline_type
         self.output_path = self.input_path.parent / self.input_path.stem
+        self.batch_size = batch_size
 
         self.cmb_fmt = QComboBox()
         self.cmb_fmt.addItems(["csv", "feather", "hdf5"])
@@ -77,14 +79,23 @@ class OfflineToolbar(QToolBar):
         self.diag_track.prog_track.setMaximum(l)
         self.diag_track.lbl_status.setText("Tracking to " + output_name)
 
+        # the parameters can be changed while tracking, so each batch
+        # gets its own dataframe, as the output columns may differ
+        batch = []
         for i, frame in enumerate(reader):
-            data.append(self.exp.pipeline.run(frame[:, :, 0]).data)
-            self.diag_track.prog_track.setValue(i)
-            if i % 100 == 0:
+            batch.append(frame[:, :, 0])
+            if len(batch) == self.batch_size:
+                data.append(
+                    pd.DataFrame(self.exp.pipeline.run_batch(np.stack(batch)).data)
+                )
+                batch = []
+                self.diag_track.prog_track.setValue(i)
                 self.app.processEvents()
+        if len(batch) > 0:
+            data.append(pd.DataFrame(self.exp.pipeline.run_batch(np.stack(batch)).data))
 
         self.diag_track.lbl_status.setText("Saving " + output_name)
-        df = pd.DataFrame.from_records(data, columns=data[0]._fields)
+        df = pd.concat(data, ignore_index=True, sort=False)
         save_df(df, self.output_path, fileformat)
         self.diag_track.lbl_status.setText("Completed " + output_name)
         self.exp.wrap_up()
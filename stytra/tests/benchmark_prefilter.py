@@ -0,0 +1,53 @@
+""" Compares the single-pass filtering of the Prefilter with the separate
+OpenCV and NumPy operations, on 1 megapixel frames.
+
+Run with python -m stytra.tests.benchmark_prefilter
+
+"""
+from time import perf_counter
+
+import numpy as np
+
+from stytra.tracking.pipelines import SourceNode
+from stytra.tracking.preprocessing import Prefilter
+
+
+def time_per_call(function, n_repeats=200):
+    function()
+    t_start = perf_counter()
+    for _ in range(n_repeats):
+        function()
+    return (perf_counter() - t_start) / n_repeats
+
+
+def benchmark(shape=(1024, 1024), filter_size=2, color_invert=True, clip=140):
+    frame = np.random.RandomState(0).randint(0, 255, shape, dtype=np.uint8)
+    prefilter = Prefilter(parent=SourceNode())
+    prefilter.setup()
+    prefilter._params.filter_size = filter_size
+    prefilter._params.color_invert = color_invert
+    prefilter._params.clip = clip
+
+    for image_scale in [0.5, 1.0]:
+        prefilter._params.image_scale = image_scale
+        out = np.empty(prefilter.output_shape(shape), np.uint8)
+        fused = time_per_call(
+            lambda: prefilter._filter(
+                frame, out, image_scale, filter_size, color_invert, clip
+            )
+        )
+        separate = time_per_call(
+            lambda: prefilter._filter_separately(
+                frame, image_scale, filter_size, color_invert, clip
+            )
+        )
+        print(
+            "image_scale {}: single pass {:.3f} ms, separate passes {:.3f} ms, "
+            "speedup {:.1f}x".format(
+                image_scale, fused * 1000, separate * 1000, separate / fused
+            )
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,130 @@
+import numpy as np
+import cv2
+from stytra.tracking.pipelines import SourceNode
+from stytra.tracking.eyes import (
+    _blob_moments,
+    EyeTrackingMethod,
+    MomentEyeTrackingMethod,
+)
+
+
+def test_blob_moments():
+    # blobs whose parts are labelled separately until they meet
+    im = np.full((30, 40), 255, dtype=np.uint8)
+    cv2.rectangle(im, (2, 2), (4, 20), 0, -1)
+    cv2.rectangle(im, (10, 2), (12, 20), 0, -1)
+    cv2.rectangle(im, (2, 20), (12, 22), 0, -1)
+    cv2.line(im, (30, 2), (20, 12), 0, 1)
+    cv2.line(im, (20, 2), (30, 12), 0, 1)
+    cv2.circle(im, (30, 24), 3, 0, -1)
+    im[28, 2] = 0
+
+    n_blobs, moments = _blob_moments(im, 128)
+    n_labels, labels = cv2.connectedComponents((im < 128).view(np.uint8), 8)
+    assert n_blobs == n_labels - 1
+
+    expected = []
+    for label in range(1, n_labels):
+        m = cv2.moments((labels == label).view(np.uint8), True)
+        ys, xs = np.nonzero(labels == label)
+        expected.append(
+            (
+                m["m00"],
+                m["m10"],
+                m["m01"],
+                m["m20"],
+                m["m11"],
+                m["m02"],
+                max(xs.max(), ys.max()),
+            )
+        )
+    np.testing.assert_allclose(sorted(map(tuple, moments[:n_blobs])), sorted(expected))
+
+
+def eyes_image(angles, bladder=True):
+    im = np.full((70, 60), 200, dtype=np.uint8)
+    for centre, angle in zip([(18, 20), (42, 20)], angles):
+        cv2.ellipse(im, centre, (5, 10), angle, 0, 360, 20, -1)
+    if bladder:
+        cv2.ellipse(im, (30, 52), (6, 8), 0, 0, 360, 20, -1)
+    # a speck of dirt, smaller than min_area
+    im[2, 2:4] = 0
+    return im
+
+
+def test_moment_eye_tracking():
+    node = MomentEyeTrackingMethod(parent=SourceNode())
+    node.setup()
+    ellipse_node = EyeTrackingMethod(parent=SourceNode())
+    ellipse_node.setup()
+    window = dict(
+        wnd_pos=(0, 0),
+        threshold=56,
+        wnd_dim=(60, 70),
+        auto_threshold="off",
+        threshold_percentile=30.0,
+        threshold_update_every=500,
+        threshold_drift=5.0,
+    )
+
+    im = eyes_image([30, 160])
+    out = node._process(im, min_area=5, **window).data
+    assert out.eye_quality == 2
+    np.testing.assert_allclose(
+        [out.pos_x_e0, out.pos_y_e0, out.pos_x_e1, out.pos_y_e1],
+        [20, 18, 20, 42],
+        atol=0.1,
+    )
+    np.testing.assert_allclose([out.pos_x_sb, out.pos_y_sb], [52, 30], atol=0.1)
+    np.testing.assert_allclose([out.dim_x_e0, out.dim_y_e0], [21, 11], atol=0.6)
+
+    # without the swim bladder the eyes match the ellipse fitting
+    im = eyes_image([30, 160], bladder=False)
+    out = node._process(im, min_area=5, **window).data
+    assert out.eye_quality == 1
+    assert np.isnan(out.th_sb)
+    fitted = ellipse_node._process(im, **window).data
+    np.testing.assert_allclose(out[:10], fitted, atol=1.5)
+
+    out = node._process(im, min_area=500, **window).data
+    assert out.eye_quality == 0
+    assert np.all(np.isnan(out[:15]))
+
+
+def test_auto_threshold():
+    node = EyeTrackingMethod(parent=SourceNode())
+    node.setup()
+    settings = dict(
+        threshold=56,
+        threshold_percentile=20.0,
+        threshold_update_every=10,
+        threshold_drift=5.0,
+    )
+    im = eyes_image([30, 160])
+    window = im[5:65, 5:55]
+    assert node._window_threshold(window, auto_threshold="off", **settings) == 56
+
+    threshold = node._window_threshold(window, auto_threshold="otsu", **settings)
+    assert 20 < threshold <= 200
+    # the threshold is kept while the window does not change much
+    assert node._window_threshold(window + 4, auto_threshold="otsu", **settings) == (
+        threshold
+    )
+    brighter = node._window_threshold(window + 30, auto_threshold="otsu", **settings)
+    assert brighter == threshold + 30
+    for _ in range(9):
+        node._window_threshold(window, auto_threshold="otsu", **settings)
+    # recomputed after threshold_update_every frames
+    assert node._window_threshold(window, auto_threshold="otsu", **settings) == (
+        threshold
+    )
+
+    node.reset()
+    ramp = np.arange(100, dtype=np.uint8).reshape(10, 10)
+    assert node._window_threshold(ramp, auto_threshold="percentile", **settings) == 20
+
+    # the eyes are found as with the manual threshold
+    tracked = node._process(im, (0, 0), 56, (60, 70), "off", 20.0, 10, 5.0).data
+    node.reset()
+    auto_tracked = node._process(im, (0, 0), 56, (60, 70), "otsu", 20.0, 10, 5.0).data
+    np.testing.assert_allclose(tracked, auto_tracked)
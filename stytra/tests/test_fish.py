@@ -0,0 +1,125 @@
+import numpy as np
+import flammkuchen as fl
+from pathlib import Path
+
+from stytra.experiments.fish_pipelines import pipeline_dict
+from stytra.tracking.fish import _aligned_window, _merge_windows, _well_windows
+
+
+def test_search_windows():
+    # the windows stay inside the image and start at multiples of the alignment
+    assert _aligned_window(5.5, 20.2, 10, (100, 30), 2) == (10, 31, 0, 16)
+    assert _aligned_window(25.0, 95.0, 10, (100, 30), 4) == (84, 100, 12, 30)
+
+    # overlapping windows are merged, also if they overlap only after a merge
+    windows = [(0, 10, 0, 10), (20, 30, 20, 30), (5, 25, 5, 25), (50, 60, 0, 10)]
+    assert sorted(_merge_windows(windows)) == [(0, 30, 0, 30), (50, 60, 0, 10)]
+
+
+def test_well_windows():
+    # the plate is divided row by row, and the wells stay inside the image
+    assert _well_windows((10, 0), (30, 20), 2, 3, (15, 100)) == [
+        (0, 10, 10, 20),
+        (0, 10, 20, 30),
+        (0, 10, 30, 40),
+        (10, 15, 10, 20),
+        (10, 15, 20, 30),
+        (10, 15, 30, 40),
+    ]
+
+
+def test_well_tracking():
+    """ Tracking fish in a plate of wells should give the same results
+    as tracking each well separately
+    """
+    video = fl.load(
+        str(
+            Path(__file__).parent.parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )[150:230]
+    h, w = video.shape[1:]
+    # two wells, with the fish at different times
+    plate = np.concatenate([video, video[::-1]], 2)
+
+    wells = pipeline_dict["wells"]()
+    wells.setup()
+    wells.fishtrack._params.wnd_pos = (0, 0)
+    wells.fishtrack._params.wnd_dim = (2 * w, h)
+    wells.fishtrack._params.n_rows = 1
+    wells.fishtrack._params.n_columns = 2
+    wells.fishtrack.reset()
+
+    singles = []
+    for _ in range(2):
+        single = pipeline_dict["fish"]()
+        single.setup()
+        singles.append(single)
+
+    for i_frame in range(len(video)):
+        output = wells.run(plate[i_frame])
+        for i_well, single_video in enumerate([video, video[::-1]]):
+            single_output = singles[i_well].run(single_video[i_frame])
+            assert np.allclose(
+                [
+                    getattr(output.data, "w{}_x".format(i_well)) - i_well * w,
+                    getattr(output.data, "w{}_y".format(i_well)),
+                    getattr(output.data, "w{}_theta".format(i_well)),
+                ],
+                [
+                    single_output.data.f0_x,
+                    single_output.data.f0_y,
+                    single_output.data.f0_theta,
+                ],
+                equal_nan=True,
+            )
+    assert not np.isnan(output.data.w0_x) and not np.isnan(output.data.w1_x)
+
+
+def test_well_tracking_outside_plate():
+    """ Wells outside of the image are empty, and a fish in a well
+    is followed however far it moves between frames
+    """
+    video = fl.load(
+        str(
+            Path(__file__).parent.parent
+            / "examples"
+            / "assets"
+            / "fish_free_compressed.h5"
+        ),
+        "/video",
+    )[150:230]
+    h, w = video.shape[1:]
+    plate = np.concatenate([video, video[::-1]], 2)
+
+    outputs = []
+    for wnd_dim, n_rows, n_columns, max_displacement, max_turn in [
+        ((2 * w, h), 1, 2, 15.0, np.pi / 2),
+        # the plate extends past the image, with tight gating
+        ((4 * w, 2 * h), 2, 4, 1.0, 0.01),
+    ]:
+        wells = pipeline_dict["wells"]()
+        wells.setup()
+        params = wells.fishtrack._params
+        params.wnd_pos = (0, 0)
+        params.wnd_dim = wnd_dim
+        params.n_rows = n_rows
+        params.n_columns = n_columns
+        params.max_displacement = max_displacement
+        params.max_turn = max_turn
+        wells.fishtrack.reset()
+        outputs.append([wells.run(frame).data for frame in plate])
+
+    for output, plate_output in zip(*outputs):
+        for i_well in range(2):
+            assert np.allclose(
+                [getattr(output, "w{}_{}".format(i_well, c)) for c in "xy"],
+                [getattr(plate_output, "w{}_{}".format(i_well, c)) for c in "xy"],
+                equal_nan=True,
+            )
+        for i_well in range(2, 8):
+            assert np.isnan(getattr(plate_output, "w{}_x".format(i_well)))
+    assert not np.isnan(plate_output.w0_x) and not np.isnan(plate_output.w1_x)
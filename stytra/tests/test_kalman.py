@@ -1,5 +1,5 @@
 import numpy as np
-from stytra.tracking.fish import Fishes
+from stytra.tracking.fish import Fishes, assign_detections
 
 
 def test_fish():
@@ -11,22 +11,73 @@ def test_fish():
     """
     fshs = Fishes(1, 1.0, 1.0, 2, 1.0, 1)
     fshs.add_fish(np.array([0.0, 0.0, np.pi + 0.1, 0.0, 0.0]))
-    fshs.predict()
+    fshs.predict(0.02)
     fshs.update(np.array([1.0, 1.0, np.pi + 2 * np.pi, 0.0, 0.0]))
     assert np.allclose(
         fshs.coords,
         np.array(
             [
                 [
-                    0.66666667,
-                    0.33333466,
-                    0.66666667,
-                    0.33333466,
-                    3.17492599,
-                    -0.03333376,
+                    0.66667778,
+                    16.66944435,
+                    0.66667778,
+                    16.66944435,
+                    3.17492488,
+                    -1.66694444,
                     0.0,
                     0.0,
                 ]
             ]
         ),
     )
+
+
+def test_fish_assignment():
+    fshs = Fishes(3, 1.0, 1.0, 2, 1.0, 1)
+    fshs.add_fish(np.array([0.0, 0.0, 0.0, 0.0, 0.0]))
+    fshs.add_fish(np.array([12.0, 0.0, 0.0, 0.0, 0.0]))
+    fshs.predict(0.02)
+
+    # the first detection is close enough to both fish, but closer to the
+    # second one. The last one is too far from both
+    detections = np.array(
+        [[11.0, 0.0, 0.0, 0.0, 0.0], [1.0, 0.0, 0.0, 0.0, 0.0], [50.0, 0, 0, 0, 0]]
+    )
+    costs = fshs.assignment_costs(detections)
+    assert costs.shape == (3, 3)
+    assert np.all(np.isinf(costs[:, 2])) and np.all(np.isinf(costs[2, :]))
+    assert sorted(assign_detections(costs)) == [(0, 1), (1, 0)]
+
+    # turning too much is not allowed
+    fshs.max_turn = 0.1
+    detections[:, 2] = 0.5
+    assert assign_detections(fshs.assignment_costs(detections)) == []
+
+
+def test_frame_interval():
+    """ Test that the velocities are estimated in pixels per second
+    and the positions predicted over the actual intervals between frames,
+    also if frames are dropped
+    """
+    fshs = Fishes(2, 1.0, 1.0, 2, 1.0, 1)
+    t = 0.0
+    fshs.add_fish(np.array([0.0, 0.0, 0.0, 0.0, 0.0]))
+    fshs.add_fish(np.array([50.0, 50.0, 1.0, 0.0, 0.0]))
+    for i in range(1, 100):
+        dt = 0.02 if i % 10 == 0 else 0.01
+        t += dt
+        fshs.predict(dt)
+        fshs.update_fishes(
+            np.array([0, 1]),
+            np.array(
+                [
+                    [100.0 * t, 0.0, 0.0, 0.0, 0.0],
+                    [50.0, 50.0 - 20.0 * t, 1.0, 0.0, 0.0],
+                ]
+            ),
+        )
+    assert np.allclose(fshs.coords[:, 1:4:2], [[100.0, 0.0], [0.0, -20.0]], atol=1.0)
+
+    fshs.predict(0.05)
+    assert np.allclose(fshs.coords[0, 0], 100.0 * (t + 0.05), atol=0.1)
+    assert np.allclose(fshs.coords[1, 2], 50.0 - 20.0 * (t + 0.05), atol=0.1)
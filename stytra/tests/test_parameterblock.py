@@ -0,0 +1,37 @@
+from stytra.collectors.parameterblock import ParameterBlock
+from multiprocessing import Process, Queue
+
+
+class ParamProc(Process):
+    def __init__(self, block, result_queue):
+        super().__init__()
+        self.block = block
+        self.result_queue = result_queue
+
+    def run(self):
+        changes = None
+        while changes is None:
+            changes = self.block.get()
+        self.result_queue.put(changes)
+
+
+def test_parameter_block():
+    block = ParameterBlock()
+    assert block.get() is None
+
+    # empty changes do not count as a new generation
+    block.put({"/source/filtering": {}})
+    assert block.get() is None
+
+    # unread changes are merged
+    block.put({"/source/filtering": dict(clip=100), "reset": {}})
+    block.put({"/source/filtering": dict(filter_size=3)})
+    assert block.get() == {"/source/filtering": dict(clip=100, filter_size=3)}
+    assert block.get() is None
+
+    result_queue = Queue()
+    proc = ParamProc(block, result_queue)
+    proc.start()
+    block.put({"diagnostics": dict(image="unprocessed")})
+    assert result_queue.get(timeout=5) == {"diagnostics": dict(image="unprocessed")}
+    proc.join()
@@ -1,6 +1,21 @@
-from stytra.tracking.pipelines import Pipeline, ImageToDataNode, NodeOutput
+from stytra.tracking.pipelines import (
+    Pipeline,
+    ImageToDataNode,
+    ImageToImageNode,
+    NodeOutput,
+    SourceNode,
+)
 from lightparam import Param
 from collections import namedtuple
+from stytra.tracking.preprocessing import Prefilter, BackgroundSubtractor
+from stytra.tracking.tail import CentroidTrackingMethod
+from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.tracking.tracking_process import TrackingProcess, ParallelTrackingProcess
+from time import sleep, perf_counter
+from queue import Empty
+import numpy as np
+import cv2
+import pytest
 
 
 class TestNode(ImageToDataNode):
@@ -38,3 +53,519 @@ def test_a_pipeline():
     p.deserialize_params(ser)
     assert p.run(None) == NodeOutput([], tt(None, 2))
     assert p.diagnostic_image == "img"
+
+
+class DoublingNode(ImageToImageNode):
+    def __init__(self, *args, **kwargs):
+        super().__init__("doubling", *args, **kwargs)
+
+    def _process(self, input, set_diagnostic=None):
+        return NodeOutput(["I:doubled"], input * 2)
+
+
+class SumNode(ImageToDataNode):
+    def __init__(self, *args, column="total", **kwargs):
+        super().__init__("sum_" + column, *args, **kwargs)
+        self._output_type = namedtuple("o", column)
+
+    def _process(self, input, offset: Param(0), set_diagnostic=None):
+        return NodeOutput(["I:summed"], self._output_type(np.sum(input) + offset))
+
+
+class ColumnsNode(ImageToDataNode):
+    """ A node whose number of output columns is a parameter
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("columns", *args, **kwargs)
+
+    def changed(self, vals):
+        if "n_columns" in vals.keys():
+            self.reset()
+
+    def reset(self):
+        self._output_type = namedtuple(
+            "o", ["col_{}".format(i) for i in range(self._params.n_columns)]
+        )
+        self._output_type_changed = True
+
+    def _process(self, input, n_columns: Param(2, (1, 10)), set_diagnostic=None):
+        if self._output_type is None:
+            self.reset()
+        return NodeOutput(
+            [], self._output(*(np.sum(input) + i for i in range(n_columns)))
+        )
+
+
+class MeanNode(ImageToDataNode):
+    """ A node with a fixed output type, which writes in place
+    in record mode
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("mean", *args, **kwargs)
+        self._output_type = namedtuple("o", "mean")
+
+    def _process(self, input, set_diagnostic=None):
+        return NodeOutput([], self._output(np.mean(input)))
+
+
+class ColumnsPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.doubling = DoublingNode(parent=self.root)
+        self.columns = ColumnsNode(parent=self.doubling)
+        self.mean_raw = MeanNode(parent=self.root)
+        self.sum_raw = SumNode(parent=self.root, column="total_raw")
+
+
+class BranchingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.doubling = DoublingNode(parent=self.root)
+        self.sum_doubled = SumNode(parent=self.doubling)
+        self.tp = TestNode(parent=self.root)
+
+
+def test_compiled_plan():
+    p = BranchingPipeline()
+    p.setup()
+    inp = np.arange(4)
+    for _ in range(2):
+        reference = p.recursive_run(p.root, inp)
+        compiled = p.run(inp)
+        assert compiled == reference
+        assert compiled.data._fields == ("total", "inp", "par")
+
+
+def test_compiled_plan_output_type_change():
+    p = ColumnsPipeline()
+    p.setup()
+    inp = np.arange(4)
+    for n_columns in [2, 4, 1]:
+        p.deserialize_params({"/source/doubling/columns": dict(n_columns=n_columns)})
+        for _ in range(2):
+            reference = p.recursive_run(p.root, inp)
+            compiled = p.run(inp)
+            assert compiled == reference
+            assert compiled.data._fields == reference.data._fields
+            assert len(compiled.data) == n_columns + 2
+
+
+class SumPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.doubling = DoublingNode(parent=self.root)
+        self.sum_doubled = SumNode(parent=self.doubling)
+        self.sum_raw = SumNode(parent=self.root, column="total_raw")
+
+
+def test_record_output():
+    p = SumPipeline()
+    p.setup(record_output=True)
+    reference = SumPipeline()
+    reference.setup()
+    inp = np.arange(4)
+    for _ in range(3):
+        out = p.run(inp)
+        assert isinstance(out.data, np.ndarray)
+        assert out.data.dtype.names == ("total", "total_raw")
+        assert tuple(out.data[0]) == tuple(reference.run(inp).data)
+
+
+def test_record_output_in_place():
+    p = ColumnsPipeline()
+    p.setup(record_output=True)
+    reference = ColumnsPipeline()
+    reference.setup()
+    inp = np.arange(4)
+    q = NamedTupleQueue()
+
+    records = []
+    for n_columns in [2, 4]:
+        # change the output type of only one of the branches
+        for pipeline in [p, reference]:
+            pipeline.deserialize_params(
+                {"/source/doubling/columns": dict(n_columns=n_columns)}
+            )
+        for _ in range(3):
+            out = p.run(inp)
+            ref_out = reference.run(inp)
+            records.append(out.data)
+            assert out.data.dtype.names == ref_out.data._fields
+            assert tuple(out.data[0]) == tuple(ref_out.data)
+
+            q.put(None, out.data)
+            _, received = q.get(timeout=1)
+            assert received == ref_out.data
+            assert received._fields == ref_out.data._fields
+
+        # after the first frame with the new type, the nodes write in place
+        # and the same record is returned
+        assert records[-1] is records[-2]
+        assert p.mean_raw._output_buffer.base is records[-1]
+
+
+class FailingNode(ImageToDataNode):
+    def __init__(self, *args, **kwargs):
+        super().__init__("failing", *args, **kwargs)
+        self._output_type = namedtuple("o", "failed")
+
+    def _process(self, input, set_diagnostic=None):
+        raise ValueError("Failed in a branch")
+
+
+class FailingPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.doubling = DoublingNode(parent=self.root)
+        self.sum_doubled = SumNode(parent=self.doubling)
+        self.failing = FailingNode(parent=self.root)
+
+
+def test_parallel_branches():
+    p = SumPipeline()
+    p.setup(branch_threads=2)
+    assert p._executor is not None
+    reference = SumPipeline()
+    reference.setup()
+    assert reference._executor is None
+    inp = np.arange(4)
+    for _ in range(3):
+        assert p.run(inp) == reference.run(inp)
+    p.close()
+    assert p._executor is None
+
+
+def test_parallel_branch_exception():
+    p = FailingPipeline()
+    p.setup(branch_threads=2)
+    with pytest.raises(ValueError, match="Failed in a branch"):
+        p.run(np.arange(4))
+    p.close()
+
+
+def test_timing_statistics():
+    p = SumPipeline()
+    p.setup(record_timing=True)
+    assert p.timing_statistics() is None
+    for _ in range(10):
+        p.run(np.arange(4))
+    stats = p.timing_statistics()
+    assert stats._fields == tuple(p.timing_columns)
+    assert stats.sum_total_mean <= stats.sum_total_max
+    assert p.timing_statistics() is None
+
+
+class ImagePipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.filter = Prefilter(parent=self.root)
+        self.mean_filtered = MeanNode(parent=self.filter)
+        self.bgsub = BackgroundSubtractor(parent=self.root)
+        self.sum_bgsub = SumNode(parent=self.bgsub, column="total_bgsub")
+
+
+def test_run_batch():
+    frames = np.random.RandomState(0).randint(0, 255, (25, 60, 80), dtype=np.uint8)
+    params = {"/source/bgsub": dict(learn_every=7, learning_rate=0.5)}
+
+    p = ImagePipeline()
+    p.setup()
+    p.deserialize_params(params)
+    batch_output = p.run_batch(frames)
+
+    reference = ImagePipeline()
+    reference.setup()
+    reference.deserialize_params(params)
+    for frame, batch_row in zip(frames, batch_output.data):
+        assert tuple(batch_row) == tuple(reference.run(frame).data)
+    assert batch_output.data.dtype.names == ("mean", "total_bgsub")
+
+
+
+class GrowingNode(ImageToDataNode):
+    """ A node which outputs one more column on every frame
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__("growing", *args, **kwargs)
+        self.n_frames = 0
+
+    def _process(self, input, set_diagnostic=None):
+        self.n_frames += 1
+        self._output_type = namedtuple(
+            "o", ["col_{}".format(i) for i in range(self.n_frames)]
+        )
+        self._output_type_changed = True
+        return NodeOutput([], self._output(*range(self.n_frames)))
+
+
+def test_run_batch_output_type_change():
+    frames = np.arange(24).reshape(6, 2, 2)
+    p = ColumnsPipeline()
+    p.setup()
+    # the output columns can change between batches
+    for n_columns in [2, 3]:
+        p.deserialize_params({"/source/doubling/columns": dict(n_columns=n_columns)})
+        batch_output = p.run_batch(frames)
+        assert batch_output.data.dtype.names == p.run(frames[0]).data._fields
+        assert len(batch_output.data.dtype.names) == n_columns + 2
+
+    data_output = p.mean_raw.process_batch(frames)
+    assert isinstance(data_output, NodeOutput)
+    np.testing.assert_array_equal(data_output.data[:, 0], frames.mean(axis=(1, 2)))
+
+    # but not within a batch
+    node = GrowingNode(parent=SourceNode())
+    node.setup()
+    with pytest.raises(ValueError, match="growing changed at frame 1"):
+        node.process_batch(frames)
+
+def test_median_background():
+    rng = np.random.RandomState(0)
+    background = rng.randint(50, 200, (60, 80)).astype(np.uint8)
+    frames = np.repeat(background[None, :, :], 300, 0)
+    # a dark object moving across the image, present from the first frame
+    for i_frame, frame in enumerate(frames):
+        frame[20:30, i_frame % 70 : i_frame % 70 + 10] = 0
+
+    errors = dict()
+    for model in ["mean", "median"]:
+        p = ImagePipeline()
+        p.setup()
+        p.deserialize_params(
+            {
+                "/source/bgsub": dict(
+                    model=model, learn_every=1, learning_rate=0.1, median_subsample=1
+                )
+            }
+        )
+        for frame in frames:
+            p.run(frame)
+        errors[model] = np.abs(
+            p.bgsub.background_image.astype(np.float32) - background
+        ).max()
+    # the object does not leave a ghost in the median background, and the
+    # error is only due to its last passage
+    assert errors["median"] <= 10 < errors["mean"]
+
+    # the median background is updated a few rows at a time
+    params = {"/source/bgsub": dict(model="median", median_subsample=3)}
+    p = ImagePipeline()
+    p.setup()
+    p.deserialize_params(params)
+    p.run(frames[0])
+    p.run(frames[1])
+    # on the second frame, the rows 1, 4, 7...
+    changed_rows = np.flatnonzero(np.any(p.bgsub.background_image != frames[0], 1))
+    assert len(changed_rows) > 0 and np.all(changed_rows % 3 == 1)
+
+    # and the batched version is equivalent
+    batch_output = p.run_batch(frames[2:40])
+    reference = ImagePipeline()
+    reference.setup()
+    reference.deserialize_params(params)
+    for frame in frames[:2]:
+        reference.run(frame)
+    for frame, batch_row in zip(frames[2:40], batch_output.data):
+        assert tuple(batch_row) == tuple(reference.run(frame).data)
+
+
+class TailPipeline(Pipeline):
+    def __init__(self):
+        super().__init__()
+        self.filter = Prefilter(parent=self.root)
+        self.tailtrack = CentroidTrackingMethod(parent=self.filter)
+
+
+def test_roi_cropping():
+    # a dark, slightly bent tail on a bright background
+    im = np.full((400, 480), 200, dtype=np.uint8)
+    for y in range(100, 300):
+        x = 240 + int(20 * np.sin((y - 100) / 80))
+        im[y, x - 3 : x + 3] = 20
+    params = {
+        "/source/filtering/tail_tracking": dict(
+            tail_start=(100 / 400, 240 / 400), tail_length=(150 / 400, 0.0)
+        )
+    }
+
+    outputs = []
+    for crop_roi in [False, True]:
+        p = TailPipeline()
+        p.setup(crop_roi=crop_roi)
+        p.deserialize_params(params)
+        outputs.append(p.run(im).data)
+
+    # the filtering is done only around the tail
+    (crop_y, crop_x) = p._crops[1]
+    assert crop_y.start % 2 == 0 and crop_x.start % 2 == 0
+    assert (crop_y.stop - crop_y.start) * (crop_x.stop - crop_x.start) < im.size / 2
+    assert p.tailtrack.input_offset == (crop_y.start / 2, crop_x.start / 2)
+    assert p.tailtrack.input_shape == (200, 240)
+
+    assert not np.any(np.isnan(outputs[0]))
+    np.testing.assert_allclose(outputs[0], outputs[1])
+
+    # the image is not cropped while a diagnostic image is displayed
+    p.deserialize_params({"diagnostics": dict(image="/source/filtering/filtered")})
+    p.run(im)
+    assert p._crops[1] is None
+    assert p.tailtrack.input_offset == (0, 0)
+
+
+class ListQueue(list):
+    def put(self, item, timestamp=None):
+        self.append(item)
+
+
+def test_lazy_diagnostic_image():
+    computed = []
+
+    def diagnostic_image():
+        computed.append(True)
+        return np.zeros((2, 2))
+
+    gui_queue = ListQueue()
+    process = TrackingProcess(None, gui_framerate=30, gui_queue=gui_queue)
+    process.framerate_rec.current_framerate = 90
+    for i in range(9):
+        process.send_to_gui(i, diagnostic_image)
+
+    # only every third frame is displayed, and only those are computed
+    assert len(gui_queue) == 3
+    assert len(computed) == 3
+
+
+
+def test_disable_frame_dependence():
+    p = TailPipeline()
+    p.setup()
+    path = "/source/filtering/tail_tracking"
+    p.deserialize_params(
+        {path: dict(time_filter_weight=0.5, warm_start=True, n_segments=12)}
+    )
+    assert p.disable_frame_dependence() == {
+        path: dict(time_filter_weight=0.0, warm_start=False)
+    }
+    values = p.tailtrack._params.params.values
+    assert values["time_filter_weight"] == 0.0 and not values["warm_start"]
+    assert p.disable_frame_dependence() == dict()
+
+
+def test_ordered_reassembly():
+    output_queue = NamedTupleQueue()
+    process = ParallelTrackingProcess(
+        None, output_queue=output_queue, n_workers=3, reorder_timeout=0.05
+    )
+    output_type = namedtuple("o", "x")
+
+    def receive(i_worker, frame_idx):
+        process.started_workers.add(i_worker)
+        if process.first_received is None:
+            process.first_received = perf_counter()
+        process.pending_outputs[frame_idx] = (0.0, [], output_type(frame_idx))
+
+    def sent():
+        outputs = []
+        while True:
+            try:
+                outputs.append(output_queue.get(timeout=0.2)[1].x)
+            except Empty:
+                return outputs
+
+    # nothing is sent until every worker has started
+    receive(0, 1)
+    receive(1, 0)
+    process.send_ordered()
+    assert sent() == []
+
+    # but a worker which gets no frames does not hold back the others
+    sleep(0.06)
+    process.send_ordered()
+    assert sent() == [0, 1]
+
+    # with nothing pending, there is nothing to skip to
+    sleep(0.06)
+    process.send_ordered()
+
+    # a missing frame is skipped after the timeout, even if nothing
+    # else arrives
+    receive(0, 3)
+    process.last_sent = perf_counter()
+    process.send_ordered()
+    assert sent() == []
+    sleep(0.06)
+    process.send_ordered()
+    assert sent() == [3]
+    assert process.message_queue.get(timeout=1) == "W:Frame 2 not tracked in time"
+
+def test_prefilter_buffers():
+    p = ImagePipeline()
+    p.setup()
+    frame = np.random.RandomState(0).randint(0, 255, (60, 80), dtype=np.uint8)
+    original = frame.copy()
+
+    filtered = p.filter.process(frame).data
+    subtracted = p.bgsub.process(frame).data
+    # the outputs are written in the same buffers on every frame
+    assert p.filter.process(frame).data is filtered
+    assert p.bgsub.process(frame).data is subtracted
+    assert np.array_equal(frame, original)
+
+    # downscaling and smoothing, with the borders reflected and the
+    # averages rounded half up, the 2x2 boxes one below the half as well
+    downscaled = (frame.reshape(30, 2, 40, 2).astype(int).sum((1, 3)) + 2) // 4
+    padded = np.pad(downscaled, ((1, 0), (1, 0)), mode="reflect")
+    smoothed = (
+        padded[:-1, :-1] + padded[:-1, 1:] + padded[1:, :-1] + padded[1:, 1:] + 3
+    ) // 4
+    expected = np.maximum(255 - smoothed, 140) - 140
+    assert np.array_equal(filtered, expected)
+
+    # as with the separate OpenCV operations
+    opencv = cv2.boxFilter(
+        cv2.resize(frame, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA), -1, (2, 2)
+    )
+    opencv = np.maximum(255 - opencv, 140) - 140
+    assert np.array_equal(filtered, opencv)
+
+
+def test_prefilter_parameters():
+    """ The single-pass filtering has the same parameters as the
+    separate OpenCV operations
+    """
+    rng = np.random.RandomState(0)
+    node = Prefilter()
+    node.setup()
+    for shape in [(60, 80), (61, 83), (4, 4)]:
+        frame = rng.randint(0, 255, shape, dtype=np.uint8)
+        for image_scale in [1.0, 0.5, 0.25, 0.3]:
+            for filter_size in [0, 1, 2, 3, 5]:
+                for color_invert, clip in [(True, 140), (False, 0), (False, 30)]:
+                    expected = frame
+                    if image_scale != 1:
+                        expected = cv2.resize(
+                            expected,
+                            None,
+                            fx=image_scale,
+                            fy=image_scale,
+                            interpolation=cv2.INTER_AREA,
+                        )
+                    filtered = node._filter(
+                        frame,
+                        np.empty(expected.shape, np.uint8),
+                        image_scale,
+                        filter_size,
+                        color_invert,
+                        clip,
+                    )
+                    if filter_size > 0:
+                        expected = cv2.boxFilter(expected, -1, (filter_size,) * 2)
+                    if color_invert:
+                        expected = 255 - expected
+                    expected = np.maximum(expected, clip) - clip
+                    # OpenCV rounds the 4x4 averages of the downscaling
+                    # differently, by at most one grey level
+                    assert np.abs(filtered.astype(int) - expected).max() <= 1
@@ -0,0 +1,241 @@
+import numpy as np
+import cv2
+from stytra.tracking.tail import (
+    _next_segment,
+    _trace_tail_centroid,
+    _trace_tail_centroid_warm,
+    _bilinear,
+    AnglesTrackingMethod,
+    CentroidTrackingMethod,
+    MultiTailTrackingMethod,
+)
+
+
+def test_next_segment_direction():
+    # a symmetric blob next to the look-ahead point sets the direction
+    im = np.zeros((40, 40), dtype=np.uint8)
+    cv2.circle(im, (22, 25), 2, 255, -1)
+    x, y, dx, dy, acc = _next_segment(im, 20.0, 15.0, 1.5, 9.5, 5, 5.0)
+    assert acc > 0
+    np.testing.assert_allclose((dx, dy), np.array([2, 10]) / np.hypot(2, 10) * 5)
+    np.testing.assert_allclose((x, y), (20 + dx, 15 + dy))
+
+    # nothing in the window
+    assert _next_segment(im, 2.0, 2.0, 1.0, 1.0, 3, 1.0)[0] == -1
+
+
+def straight_tail_image(start, angle):
+    im = np.zeros((300, 300), dtype=np.uint8)
+    end = start + 200 * np.array([np.sin(angle), np.cos(angle)])
+    cv2.line(im, tuple(int(c) for c in start), tuple(int(c) for c in end), 255, 5)
+    return cv2.GaussianBlur(im, (0, 0), 2)
+
+
+def test_straight_tail():
+    angle = 0.3
+    start = np.array([150.0, 40.0])
+    im = straight_tail_image(start, angle)
+
+    n_segments = 40
+    seg_length = 150 / n_segments
+    angles, intensities, i_missing = _trace_tail_centroid(
+        im,
+        start[0],
+        start[1],
+        np.sin(angle + 0.1) * seg_length,
+        np.cos(angle + 0.1) * seg_length,
+        3.5,
+        seg_length,
+        n_segments,
+        0.0,
+    )
+    assert i_missing == 0
+    np.testing.assert_allclose(angles[3:], angle, atol=0.07)
+
+
+def test_early_termination():
+    angle = 0.3
+    start = np.array([50.0, 40.0])
+    im = straight_tail_image(start, angle)
+
+    # the segments are traced past the tail tip, 200 pixels from the start
+    n_segments = 25
+    seg_length = 250 / n_segments
+    args = (
+        im,
+        start[0],
+        start[1],
+        np.sin(angle) * seg_length,
+        np.cos(angle) * seg_length,
+        3.5,
+        seg_length,
+        n_segments + 1,
+    )
+    # without a threshold, segments are traced on the faint edge of the tip
+    angles, intensities, i_missing_all = _trace_tail_centroid(*args, 0.0)
+    assert np.isfinite(angles[i_missing_all - 2])
+    assert intensities[i_missing_all - 2] < 0.1 * intensities[0]
+
+    angles, intensities, i_missing = _trace_tail_centroid(*args, 0.5)
+    assert 0 < i_missing < i_missing_all
+    assert np.all(np.isfinite(angles[: i_missing - 1]))
+    assert np.all(np.isnan(angles[i_missing - 1 :]))
+
+
+
+def test_stop_messages():
+    node = CentroidTrackingMethod()
+    intensities = np.array([200.0, 150.0, 20.0, np.nan])
+    # a stop on min_confidence is reported once, not on every frame
+    assert node._stop_messages(intensities, 3) == [
+        "I:tracing stopped at segment 3 below min_confidence"
+    ]
+    assert node._stop_messages(intensities, 3) == []
+    assert node._stop_messages(intensities, 0) == []
+    assert len(node._stop_messages(intensities, 3)) == 1
+
+    # a lost tail gives a warning on every frame
+    for _ in range(2):
+        assert node._stop_messages(intensities, 4) == ["W:segment 4 not detected"]
+    intensities[2] = 0
+    assert node._stop_messages(intensities, 3) == ["W:segment 3 not detected"]
+
+    multi = MultiTailTrackingMethod()
+    intensities = np.array([[200.0, 20.0, np.nan], [200.0, 0.0, np.nan]])
+    assert multi._stop_messages(intensities, np.array([2, 2]), ["a ", "b "]) == [
+        "I:a tracing stopped at segment 2 below min_confidence",
+        "W:b segment 2 not detected",
+    ]
+    assert multi._stop_messages(intensities, np.array([2, 2]), ["a ", "b "]) == [
+        "W:b segment 2 not detected"
+    ]
+
+def test_warm_start():
+    angle = 0.3
+    start = np.array([150.0, 40.0])
+    im = straight_tail_image(start, angle)
+
+    n_segments = 40
+    seg_length = 150 / n_segments
+    args = (
+        im,
+        start[0],
+        start[1],
+        np.sin(angle) * seg_length,
+        np.cos(angle) * seg_length,
+        3.5,
+        2.5,
+        seg_length,
+        n_segments,
+    )
+    angles = np.full(n_segments - 1, np.nan)
+    intensities = np.full(n_segments - 1, np.nan)
+    for i_frame in range(3):
+        angles, intensities, i_missing = _trace_tail_centroid_warm(
+            *args, angles, intensities, 0.5, 0.0
+        )
+        assert i_missing == 0
+        np.testing.assert_allclose(angles[3:], angle, atol=0.07)
+
+    # if the tail is not where it was, the full window is used
+    seg_length = 150 / 10
+    angles, intensities, i_missing = _trace_tail_centroid_warm(
+        *args[:7], seg_length, 11, np.full(10, angle + 1.0), np.full(10, 255.0), 0.5, 0.0
+    )
+    assert i_missing == 0
+    np.testing.assert_allclose(angles[1:], angle, atol=0.07)
+
+
+def test_bilinear():
+    im = np.array([[0, 10], [20, 30]], dtype=np.uint8)
+    assert _bilinear(im, 0.5, 0.5) == 15
+    assert _bilinear(im, 0.25, 0.0) == 2.5
+    assert _bilinear(im, 1.5, 0.0) == -1
+
+
+def test_angles_tracking():
+    angle = 0.3
+    start = np.array([150.0, 40.0])
+    im = straight_tail_image(start, angle)
+
+    outputs = []
+    for method in [AnglesTrackingMethod, CentroidTrackingMethod]:
+        node = method()
+        node.setup()
+        node._params.tail_start = (start[1] / 300, start[0] / 300)
+        node._params.tail_length = (np.cos(angle) * 0.5, np.sin(angle) * 0.5)
+        output = node.process(im)
+        assert output.messages == []
+        outputs.append(output.data)
+
+    # the methods are interchangeable
+    assert outputs[0]._fields == outputs[1]._fields
+    np.testing.assert_allclose(outputs[0][1:-1], angle, atol=0.02)
+    for output in outputs:
+        assert output.tail_confidence > 0.5
+
+
+def test_tail_angles_pipeline():
+    from stytra.experiments.fish_pipelines import pipeline_dict
+
+    angle = -0.2
+    start = np.array([150.0, 40.0])
+    # in the camera images the tail is dark
+    im = 255 - straight_tail_image(start, angle)
+
+    p = pipeline_dict["tail_angles"]()
+    p.setup()
+    p.deserialize_params(
+        {
+            "/source/filtering/tail_tracking": dict(
+                tail_start=(start[1] / 300, start[0] / 300),
+                tail_length=(np.cos(angle) * 0.5, np.sin(angle) * 0.5),
+                n_output_segments=5,
+            ),
+        }
+    )
+    output = p.run(im)
+    assert output.data._fields == ("tail_sum",) + tuple(
+        "theta_{:02}".format(i) for i in range(5)
+    ) + ("tail_confidence",)
+    np.testing.assert_allclose(output.data[1:-1], angle, atol=0.03)
+
+
+def test_multi_tail_tracking():
+    angles = [0.3, -0.2, 0.1]
+    starts = [np.array([150.0, 40.0]), np.array([100.0, 20.0]), np.array([200.0, 60.0])]
+    im = np.max([straight_tail_image(s, a) for s, a in zip(starts, angles)], 0)
+
+    node = MultiTailTrackingMethod()
+    node.setup()
+    node._params.n_tails = 3
+    node._params.tail_starts = [(s[1] / 300, s[0] / 300) for s in starts]
+    node._params.tail_lengths = [(np.cos(a) * 0.3, np.sin(a) * 0.3) for a in angles]
+    node.reset()
+    output = node.process(im)
+    assert output.messages == []
+    assert output.data._fields[:2] == ("a0_tail_sum", "a0_theta_00")
+    assert len(output.data) == 3 * 11
+    assert node.monitored_headers == ["a0_tail_sum", "a1_tail_sum", "a2_tail_sum"]
+
+    # each tail is traced as by the single tail method
+    single = CentroidTrackingMethod()
+    single.setup()
+    for i_tail in range(3):
+        single._params.tail_start = node._params.tail_starts[i_tail]
+        single._params.tail_length = node._params.tail_lengths[i_tail]
+        np.testing.assert_allclose(
+            output.data[i_tail * 11 : (i_tail + 1) * 11], single.process(im).data
+        )
+
+    # missing tails are placed next to the last one
+    node._params.n_tails = 4
+    assert len(node.tails()) == 4
+
+    # or at the default position, if there are none
+    node._params.tail_starts = []
+    node._params.tail_lengths = []
+    assert node.tails()[0] == MultiTailTrackingMethod.default_tail
+    assert len(node.tails()) == 4
+    node.reset()
+    assert len(node.process(im).data) == 4 * 11
@@ -5,6 +5,7 @@
 import numpy as np
 from skimage.filters import threshold_local
 import cv2
+from numba import jit
 from lightparam import Parametrized, Param
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
 from collections import namedtuple
@@ -37,12 +38,101 @@ class EyeTrackingMethod(ImageToDataNode):
 
         self.diagnostic_image_options = ["thresholded"]
 
+        # the automatic threshold is cached, together with the number of
+        # frames since it was computed and the mean intensity of the window
+        # at that time. It is not a state which has to be kept in a single
+        # worker, as each worker can compute its own
+        self._cached_threshold = None
+        self._frames_since_threshold = 0
+        self._threshold_window_mean = 0.0
+
+    def reset(self):
+        self._cached_threshold = None
+
+    def changed(self, vals):
+        if any(
+            name in vals.keys()
+            for name in ["wnd_pos", "wnd_dim", "auto_threshold", "threshold_percentile"]
+        ):
+            self.reset()
+
+    def _window_threshold(
+        self,
+        window,
+        threshold,
+        auto_threshold,
+        threshold_percentile,
+        threshold_update_every,
+        threshold_drift,
+    ):
+        """Returns the threshold for the window on the eyes. The automatic
+        threshold is computed from the histogram of the window only every
+        threshold_update_every frames, or if the mean intensity of the window
+        changed by more than threshold_drift, so on the other frames it costs
+        only the mean of the window.
+
+        The Otsu threshold separates the two classes of intensities with
+        the smallest variance within each, the percentile threshold
+        is such that the given percentage of the pixels are darker.
+        """
+        if auto_threshold == "off" or window.size == 0:
+            return threshold
+
+        window_mean = cv2.mean(window)[0]
+        if (
+            self._cached_threshold is None
+            or self._frames_since_threshold >= threshold_update_every
+            or abs(window_mean - self._threshold_window_mean) > threshold_drift
+        ):
+            if auto_threshold == "otsu":
+                # OpenCV returns the highest intensity of the dark class
+                level = cv2.threshold(
+                    window, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU
+                )[0]
+            else:
+                cumulative = np.cumsum(
+                    cv2.calcHist([window], [0], None, [256], [0, 256])
+                )
+                level = np.searchsorted(
+                    cumulative, window.size * threshold_percentile / 100
+                )
+            self._cached_threshold = int(min(level + 1, 255))
+            self._frames_since_threshold = 0
+            self._threshold_window_mean = window_mean
+
+        self._frames_since_threshold += 1
+        return self._cached_threshold
+
     def _process(
         self,
         im,
         wnd_pos: Param((129, 20), gui=False),
         threshold: Param(56, limits=(1, 254)),
         wnd_dim: Param((14, 22), gui=False),
+        auto_threshold: Param(
+            "off",
+            ["off", "otsu", "percentile"],
+            desc="Compute the threshold from the histogram of the window, "
+            "instead of using the threshold parameter",
+        ),
+        threshold_percentile: Param(
+            30.0,
+            (0.0, 100.0),
+            desc="For the percentile threshold, the percentage of the window "
+            "pixels darker than the threshold",
+        ),
+        threshold_update_every: Param(
+            500,
+            (1, 100000),
+            desc="Number of frames after which the automatic threshold "
+            "is recomputed",
+        ),
+        threshold_drift: Param(
+            5.0,
+            (0.0, 255.0),
+            desc="Change of the mean intensity of the window after which "
+            "the automatic threshold is recomputed",
+        ),
         **extraparams
     ):
         """
@@ -56,7 +146,9 @@ class EyeTrackingMethod(ImageToDataNode):
         win_dim :
             dimension of the window on the eyes (w, h);
         threshold :
-            threshold for ellipse fitting (int).
+            threshold for ellipse fitting (int);
+        auto_threshold :
+            if not off, the threshold is computed from the window (str).
 
         Returns
         -------
@@ -65,25 +157,26 @@ class EyeTrackingMethod(ImageToDataNode):
         message = ""
         PAD = 0
 
+        window = im[
+            wnd_pos[1] : wnd_pos[1] + wnd_dim[1], wnd_pos[0] : wnd_pos[0] + wnd_dim[0]
+        ]
+        threshold = self._window_threshold(
+            window,
+            threshold,
+            auto_threshold,
+            threshold_percentile,
+            threshold_update_every,
+            threshold_drift,
+        )
         cropped = _pad(
-            (
-                im[
-                    wnd_pos[1] : wnd_pos[1] + wnd_dim[1],
-                    wnd_pos[0] : wnd_pos[0] + wnd_dim[0],
-                ]
-                < threshold
-            )
-            .view(dtype=np.uint8)
-            .copy(),
-            padding=PAD,
-            val=255,
+            (window < threshold).view(dtype=np.uint8).copy(), padding=PAD, val=255
         )
 
         # try:
         e = _fit_ellipse(cropped)
 
         if self.set_diagnostic == "thresholded":
-            self.diagnostic_image = (im < threshold).view(dtype=np.uint8)
+            self.diagnostic_image = lambda: (im < threshold).view(dtype=np.uint8)
 
         if e is False:
             e = (np.nan,) * 10
@@ -97,7 +190,130 @@ class EyeTrackingMethod(ImageToDataNode):
                 + e[1][1][::-1]
                 + (-e[1][2],)
             )
-        return NodeOutput([message], self._output_type(*e))
+        return NodeOutput([message], self._output(*e))
+
+
+class MomentEyeTrackingMethod(EyeTrackingMethod):
+    """Eyes tracking from the image moments of the thresholded blobs,
+    computed in a single pass over the window. Besides the two eyes, the
+    swim bladder is tracked if it is inside the window, as the blob
+    opposite to the closest pair of the three largest ones.
+
+    The output columns of the eyes are the same as the ones of the
+    ellipse fitting method, with the axes of the ellipse with the same
+    second order moments as the blob. The swim bladder columns have the
+    _sb suffix, and eye_quality is 2 if both the eyes and the swim bladder
+    were found, 1 if only the eyes were and 0 otherwise.
+    """
+
+    name = "eyes_moments"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        headers = list(self._output_type._fields)
+        headers.extend(
+            ["pos_x_sb", "pos_y_sb", "dim_x_sb", "dim_y_sb", "th_sb", "eye_quality"]
+        )
+        self._output_type = namedtuple("t", headers)
+
+    def _process(
+        self,
+        im,
+        wnd_pos: Param((129, 20), gui=False),
+        threshold: Param(56, limits=(1, 254)),
+        wnd_dim: Param((14, 22), gui=False),
+        auto_threshold: Param(
+            "off",
+            ["off", "otsu", "percentile"],
+            desc="Compute the threshold from the histogram of the window, "
+            "instead of using the threshold parameter",
+        ),
+        threshold_percentile: Param(
+            30.0,
+            (0.0, 100.0),
+            desc="For the percentile threshold, the percentage of the window "
+            "pixels darker than the threshold",
+        ),
+        threshold_update_every: Param(
+            500,
+            (1, 100000),
+            desc="Number of frames after which the automatic threshold "
+            "is recomputed",
+        ),
+        threshold_drift: Param(
+            5.0,
+            (0.0, 255.0),
+            desc="Change of the mean intensity of the window after which "
+            "the automatic threshold is recomputed",
+        ),
+        min_area: Param(5, limits=(1, 500)),
+        **extraparams
+    ):
+        """
+
+        Parameters
+        ----------
+        im :
+            image (numpy array);
+        win_pos :
+            position of the window on the eyes (x, y);
+        win_dim :
+            dimension of the window on the eyes (w, h);
+        threshold :
+            threshold for the eyes and swim bladder blobs (int);
+        auto_threshold :
+            if not off, the threshold is computed from the window (str);
+        min_area :
+            smallest area in pixels of a blob (int).
+
+        Returns
+        -------
+
+        """
+        message = ""
+        window = im[
+            wnd_pos[1] : wnd_pos[1] + wnd_dim[1], wnd_pos[0] : wnd_pos[0] + wnd_dim[0]
+        ]
+        threshold = self._window_threshold(
+            window,
+            threshold,
+            auto_threshold,
+            threshold_percentile,
+            threshold_update_every,
+            threshold_drift,
+        )
+        n_blobs, moments = _blob_moments(window, threshold)
+
+        if self.set_diagnostic == "thresholded":
+            self.diagnostic_image = lambda: (im < threshold).view(dtype=np.uint8)
+
+        blobs = np.flatnonzero(moments[:n_blobs, 0] >= min_area)
+        # keep the three largest blobs, the eyes and the swim bladder
+        blobs = blobs[np.argsort(moments[blobs, 0])[::-1][:3]]
+        if len(blobs) < 2:
+            return NodeOutput(
+                ["E: eyes not detected!"], self._output(*((np.nan,) * 15 + (0,)))
+            )
+
+        ellipses = _moment_ellipses(moments, blobs)
+        bladder = (np.nan,) * 5
+        quality = len(blobs) - 1
+        if len(blobs) == 3:
+            # the eyes are the closest pair, opposite to the swim bladder
+            centres = ellipses[:, :2]
+            i_bladder = np.argmin(
+                [np.sum((centres[i - 2] - centres[i - 1]) ** 2) for i in range(3)]
+            )
+            bladder = tuple(ellipses[i_bladder])
+            ellipses = np.delete(ellipses, i_bladder, axis=0)
+            blobs = np.delete(blobs, i_bladder)
+        # as in the ellipse fitting, the first eye is the left one in the image
+        if moments[blobs[0], 6] > moments[blobs[1], 6]:
+            ellipses = ellipses[::-1]
+
+        return NodeOutput(
+            [message], self._output(*ellipses[0], *ellipses[1], *bladder, quality)
+        )
 
 
 def _pad(im, padding=0, val=0):
@@ -190,3 +406,130 @@ def _fit_ellipse(thresholded_image):
     else:
         # Not at least two eyes + maybe dirt found...
         return False
+
+
+@jit(nopython=True, nogil=True)
+def _find_root(parents, label):
+    while parents[label] != label:
+        parents[label] = parents[parents[label]]
+        label = parents[label]
+    return label
+
+
+@jit(nopython=True, nogil=True)
+def _merge_labels(parents, label, neighbour):
+    """ Merges the blob of a neighbouring pixel (if it belongs to one)
+    with the blob of the current pixel, returning the label of the union
+    """
+    if neighbour == 0:
+        return label
+    neighbour = _find_root(parents, neighbour)
+    if label == 0 or label == neighbour:
+        return neighbour
+    if neighbour < label:
+        parents[label] = neighbour
+        return neighbour
+    parents[neighbour] = label
+    return label
+
+
+@jit(nopython=True, nogil=True)
+def _blob_moments(im, threshold):
+    """ Labels the 8-connected blobs of the pixels below the threshold,
+    and accumulates their image moments in the same pass over the image.
+    Parts of a blob which are labelled separately until they meet are merged
+    in the union-find forest of the labels, and their moments summed at
+    the end.
+
+    Parameters
+    ----------
+    im :
+        image (numpy array)
+    threshold :
+        the blobs are the pixels darker than the threshold
+
+    Returns
+    -------
+    tuple
+        the number of blobs n and an array whose first n rows are
+        the (m00, m10, m01, m20, m11, m02) moments of the blobs and the
+        largest coordinate of their pixels
+
+    """
+    height, width = im.shape
+    # the labels of the current and the previous row
+    labels = np.empty((2, width), np.int64)
+    # in 8-connectivity at most one pixel in a 2x2 square starts a new label
+    max_labels = ((height + 1) // 2) * ((width + 1) // 2) + 1
+    parents = np.empty(max_labels, np.int64)
+    moments = np.empty((max_labels, 7))
+    n_labels = 0
+    for y in range(height):
+        current = labels[y % 2]
+        previous = labels[(y + 1) % 2]
+        for x in range(width):
+            if im[y, x] >= threshold:
+                current[x] = 0
+                continue
+            label = 0
+            if x > 0:
+                label = _merge_labels(parents, label, current[x - 1])
+            if y > 0:
+                for x_prev in range(max(x - 1, 0), min(x + 2, width)):
+                    label = _merge_labels(parents, label, previous[x_prev])
+            if label == 0:
+                n_labels += 1
+                label = n_labels
+                parents[label] = label
+                moments[label, :] = 0
+            current[x] = label
+            moments[label, 0] += 1
+            moments[label, 1] += x
+            moments[label, 2] += y
+            moments[label, 3] += x * x
+            moments[label, 4] += x * y
+            moments[label, 5] += y * y
+            moments[label, 6] = max(moments[label, 6], max(x, y))
+
+    # the roots of the forest have lower labels than their descendants
+    for label in range(1, n_labels + 1):
+        root = _find_root(parents, label)
+        if root != label:
+            moments[root, :6] += moments[label, :6]
+            moments[root, 6] = max(moments[root, 6], moments[label, 6])
+
+    n_blobs = 0
+    for label in range(1, n_labels + 1):
+        if parents[label] == label:
+            moments[n_blobs, :] = moments[label, :]
+            n_blobs += 1
+    return n_blobs, moments
+
+
+@jit(nopython=True, nogil=True)
+def _moment_ellipses(moments, blobs):
+    """ Computes the ellipses with the same second order moments as the
+    blobs, in the convention of the ellipse fitting method: (y, x) of the
+    centre, major and minor axis and the angle, in degrees, of the minor
+    axis
+
+    """
+    ellipses = np.empty((len(blobs), 5))
+    for i in range(len(blobs)):
+        m00, m10, m01, m20, m11, m02 = moments[blobs[i], :6]
+        x = m10 / m00
+        y = m01 / m00
+        mu20 = m20 / m00 - x * x
+        mu11 = m11 / m00 - x * y
+        mu02 = m02 / m00 - y * y
+        mean = (mu20 + mu02) / 2
+        spread = np.sqrt(((mu20 - mu02) / 2) ** 2 + mu11 ** 2)
+        angle = np.degrees(0.5 * np.arctan2(2 * mu11, mu20 - mu02)) + 90
+        if angle >= 180:
+            angle -= 180
+        ellipses[i, 0] = y
+        ellipses[i, 1] = x
+        ellipses[i, 2] = 4 * np.sqrt(mean + spread)
+        ellipses[i, 3] = 4 * np.sqrt(max(mean - spread, 0.0))
+        ellipses[i, 4] = -angle
+    return ellipses
@@ -1,6 +1,6 @@
 import cv2
 import numpy as np
-from numba import jit, int64, float64
+from numba import jit, prange, int64, float64
 try:
     from numba.experimental import jitclass
 except ModuleNotFoundError:
@@ -11,28 +11,44 @@ from stytra.tracking.tail import find_fish_midline
 from stytra.tracking.preprocessing import BackgroundSubtractor
 
 from itertools import chain
+from scipy.optimize import linear_sum_assignment
 
 from lightparam import Param
-from stytra.tracking.simple_kalman import predict_inplace, update_inplace
+from stytra.tracking.simple_kalman import (
+    predict_stacked,
+    update_stacked,
+    white_noise_acceleration,
+)
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
 from collections import namedtuple
 
 
-def _fish_column_names(i_fish, n_segments):
+def _fish_column_names(i_fish, n_segments, prefix="f"):
     return [
-        "f{:d}_x".format(i_fish),
-        "f{:d}_vx".format(i_fish),
-        "f{:d}_y".format(i_fish),
-        "f{:d}_vy".format(i_fish),
-        "f{:d}_theta".format(i_fish),
-        "f{:d}_vtheta".format(i_fish),
-    ] + ["f{:d}_theta_{:02d}".format(i_fish, i) for i in range(n_segments)]
+        prefix + "{:d}_x".format(i_fish),
+        prefix + "{:d}_vx".format(i_fish),
+        prefix + "{:d}_y".format(i_fish),
+        prefix + "{:d}_vy".format(i_fish),
+        prefix + "{:d}_theta".format(i_fish),
+        prefix + "{:d}_vtheta".format(i_fish),
+    ] + [prefix + "{:d}_theta_{:02d}".format(i_fish, i) for i in range(n_segments)]
+
+
+# the interval between frames which is assumed if the camera does not
+# provide timestamps, in seconds. The uncertainties of the velocities
+# and of the prediction are given for this interval
+_NOMINAL_DT = 0.02
 
 
 class FishTrackingMethod(ImageToDataNode):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, name="fish_tracking", **kwargs)
-        self.monitored_headers = ["biggest_area", "f0_theta"]
+    stateful = True
+
+    # the prefix of the output columns of each tracked fish
+    column_prefix = "f"
+
+    def __init__(self, *args, name="fish_tracking", **kwargs):
+        super().__init__(*args, name=name, **kwargs)
+        self.monitored_headers = ["biggest_area", self.column_prefix + "0_theta"]
         self.diagnostic_image_options = [
             "background difference",
             "thresholded background difference",
@@ -43,11 +59,29 @@ class FishTrackingMethod(ImageToDataNode):
         self.dilation_kernel = np.ones((3, 3), dtype=np.uint8)
         self.fishes = None
 
+        # for the search around the predicted positions, the number of frames
+        # since the whole image was searched, and whether a fish was missed
+        self.frames_since_full_search = 0
+        self.missed_fish = True
+
+        # time of the previous frame, to predict the motion of the fish
+        # over the actual interval between frames
+        self.previous_frame_time = None
+
     def changed(self, vals):
         if any(
             p in vals.keys() for p in ["n_segments", "n_fish_max", "bg_downsample"]
         ) or vals.get("reset", False):
             self.reset()
+        elif self.fishes is not None:
+            # the gating can be changed without losing the tracked fish
+            self.fishes.max_displacement = self._params.max_displacement
+            self.fishes.max_turn = self._params.max_turn
+
+    @property
+    def n_tracked(self):
+        """ The number of fish which can be tracked at once """
+        return self._params.n_fish_max
 
     def reset(self):
         self._output_type = namedtuple(
@@ -55,8 +89,10 @@ class FishTrackingMethod(ImageToDataNode):
             list(
                 chain.from_iterable(
                     [
-                        _fish_column_names(i_fish, self._params.n_segments - 1)
-                        for i_fish in range(self._params.n_fish_max)
+                        _fish_column_names(
+                            i_fish, self._params.n_segments - 1, self.column_prefix
+                        )
+                        for i_fish in range(self.n_tracked)
                     ]
                 )
             )
@@ -66,13 +102,17 @@ class FishTrackingMethod(ImageToDataNode):
 
         # used for booking a spot for one of the potentially tracked fish
         self.fishes = Fishes(
-            self._params.n_fish_max,
+            self.n_tracked,
             n_segments=self._params.n_segments - 1,
             pos_std=self._params.pos_uncertainty,
             pred_coef=self._params.prediction_uncertainty,
             angle_std=np.pi / 10,
             persist_fish_for=self._params.persist_fish_for,
+            max_displacement=self._params.max_displacement,
+            max_turn=self._params.max_turn,
         )
+        self.missed_fish = True
+        self.previous_frame_time = None
 
     def _process(
         self,
@@ -93,22 +133,171 @@ class FishTrackingMethod(ImageToDataNode):
             desc="How many frames does the fish persist for if it is not detected",
         ),
         prediction_uncertainty: Param(0.1, (0.0, 10.0, 0.0001)),
+        max_displacement: Param(
+            15.0,
+            (1.0, 200.0),
+            desc="Maximal distance in pixels between the predicted and the "
+            "detected position of a fish for the detection to be assigned to it",
+        ),
+        max_turn: Param(
+            np.pi / 2,
+            (0.0, np.pi),
+            desc="Maximal difference between the predicted and the "
+            "detected orientation of a fish for the detection to be assigned to it",
+        ),
         fish_area: Param((200, 1200), (1, 4000)),
         border_margin: Param(5, (0, 100)),
         tail_length: Param(60.0, (1.0, 200.0)),
         tail_track_window: Param(3, (3, 70)),
+        local_search: Param(
+            False,
+            desc="Search for the fish only around their predicted positions, "
+            "except every full_search_every frames or if a fish is missed",
+        ),
+        full_search_every: Param(20, (1, 1000)),
     ):
 
         # update the previously-detected fish using the Kalman filter
         if self.fishes is None:
             self.reset()
         else:
-            self.fishes.predict()
+            self.fishes.predict(self._frame_interval())
+        self.previous_frame_time = self.frame_time
 
         area_scale = bg_downsample * bg_downsample
         border_margin = border_margin // bg_downsample
 
-        # downsample background
+        # unless all the fish can be searched for around their predicted
+        # positions, the whole image is searched
+        predicted = self.fishes.coords[~np.isnan(self.fishes.coords[:, 0]), :]
+        if (
+            local_search
+            and not self.missed_fish
+            and len(predicted) > 0
+            and self.frames_since_full_search < full_search_every
+        ):
+            self.frames_since_full_search += 1
+            # the windows contain the whole fish and the margin, even if the
+            # fish is as far as possible from the predicted position
+            half_size = int(np.ceil(tail_length + max_displacement)) + border_margin
+            windows = _merge_windows(
+                [
+                    _aligned_window(x, y, half_size, bg.shape, bg_downsample)
+                    for x, y in predicted[:, 0:4:2]
+                ]
+            )
+        else:
+            self.frames_since_full_search = 0
+            windows = [(0, bg.shape[0], 0, bg.shape[1])]
+
+        messages = []
+        detections = []
+        max_area = 0
+        for y_start, y_stop, x_start, x_stop in windows:
+            window_detections, status, window_max_area = self._find_fish(
+                bg[y_start:y_stop, x_start:x_stop],
+                bg_downsample,
+                bg_dif_threshold,
+                fish_area,
+                border_margin,
+                threshold_eyes,
+                tail_length,
+                n_segments,
+                tail_track_window,
+            )
+            window_detections[:, 0] += x_start
+            window_detections[:, 1] += y_start
+            detections.append(window_detections[status == _BLOB_FISH])
+            max_area = max(max_area, window_max_area)
+            messages.extend(
+                _BLOB_MESSAGES[blob_status]
+                for blob_status in status
+                # fish crossing the edge of a window are missed,
+                # not outside the margins of the image
+                if blob_status in _BLOB_MESSAGES
+                and (len(windows) == 1 or blob_status != _BLOB_OUTSIDE_MARGINS)
+            )
+        detections = np.concatenate(detections)
+
+        # assign the detections to the previously detected fish, the
+        # remaining ones are new fish
+        if len(detections) > 0:
+            assigned = np.zeros(len(detections), dtype=bool)
+            assignments = assign_detections(self.fishes.assignment_costs(detections))
+            if len(assignments) > 0:
+                i_fishes, i_detections = np.array(assignments, dtype=np.int64).T
+                self.fishes.update_fishes(
+                    i_fishes, np.ascontiguousarray(detections[i_detections])
+                )
+                assigned[i_detections] = True
+                messages.extend(["I:Updated previous fish"] * len(assignments))
+            for fish_coords in detections[~assigned]:
+                if self.fishes.add_fish(fish_coords):
+                    messages.append("I:Added new fish")
+                else:
+                    messages.append("E:More fish than n_fish max")
+        else:
+            messages.append(
+                "W:No object of right area, between {:.0f} and {:.0f}".format(
+                    *fish_area
+                )
+            )
+
+        # the fish which were predicted but not found, if any,
+        # have to be searched for in the whole image
+        self.missed_fish = len(predicted) > 0 and np.any(
+            self.fishes.i_not_updated[~np.isnan(self.fishes.coords[:, 0])] > 0
+        )
+
+        self._set_diagnostic_image(
+            bg, bg_downsample, bg_dif_threshold, threshold_eyes
+        )
+
+        if self._output_type is None:
+            self.reset_state()
+
+        return NodeOutput(
+            messages, self._output(*self.fishes.coords.flatten(), max_area * 1.0)
+        )
+
+    def _set_diagnostic_image(
+        self, bg, bg_downsample, bg_dif_threshold, threshold_eyes
+    ):
+        """ If a debugging image is to be shown, sets it. The images which
+        have to be computed are computed only when they are displayed
+        """
+        if self.set_diagnostic == "background difference":
+            self.diagnostic_image = bg
+        elif self.set_diagnostic == "thresholded background difference":
+            self.diagnostic_image = lambda: self._threshold(
+                bg, bg_downsample, bg_dif_threshold
+            )[1]
+        elif self.set_diagnostic == "fish detection":
+            self.diagnostic_image = lambda: np.multiply(
+                *self._threshold(bg, bg_downsample, bg_dif_threshold)
+            )
+        elif self.set_diagnostic == "thresholded for eye and swim bladder":
+            self.diagnostic_image = (
+                lambda: np.maximum(bg, threshold_eyes) - threshold_eyes
+            )
+
+    def _frame_interval(self):
+        """ The time since the previous frame in seconds, from the
+        timestamps if the pipeline is given them
+        """
+        if self.frame_time is None or self.previous_frame_time is None:
+            return _NOMINAL_DT
+        dt = self.frame_time - self.previous_frame_time
+        return dt if dt > 0 else _NOMINAL_DT
+
+    def _threshold(self, bg, bg_downsample, bg_dif_threshold):
+        """ Downsamples and thresholds the background difference
+
+        Returns
+        -------
+        the downsampled image and the thresholded one, dilated
+
+        """
         if bg_downsample > 1:
             bg_small = cv2.resize(bg, None, fx=1 / bg_downsample, fy=1 / bg_downsample)
         else:
@@ -117,6 +306,30 @@ class FishTrackingMethod(ImageToDataNode):
         bg_thresh = cv2.dilate(
             (bg_small > bg_dif_threshold).view(dtype=np.uint8), self.dilation_kernel
         )
+        return bg_small, bg_thresh
+
+    def _find_fish(
+        self,
+        bg,
+        bg_downsample,
+        bg_dif_threshold,
+        fish_area,
+        border_margin,
+        threshold_eyes,
+        tail_length,
+        n_segments,
+        tail_track_window,
+    ):
+        """ Finds the fish in the background difference, or in a region of it
+
+        Returns
+        -------
+        the fish coordinates and outcome for each region different from the
+        background (see _detect_fish), and the area of the biggest region
+
+        """
+        area_scale = bg_downsample * bg_downsample
+        bg_small, bg_thresh = self._threshold(bg, bg_downsample, bg_dif_threshold)
 
         # find regions where there is a difference with the background
         n_comps, labels, stats, centroids = cv2.connectedComponentsWithStats(bg_thresh)
@@ -126,213 +339,543 @@ class FishTrackingMethod(ImageToDataNode):
         except ValueError:
             max_area = 0
 
-        # iterate through all the regions different from the background and try
-        # to find fish
+        # process all the regions different from the background in parallel,
+        # and try to find fish in them
+        detections, status = _detect_fish(
+            bg,
+            stats,
+            fish_area[0] / area_scale,
+            fish_area[1] / area_scale,
+            bg_downsample,
+            border_margin,
+            threshold_eyes,
+            tail_length,
+            n_segments,
+            tail_track_window,
+        )
+        return detections, status, max_area
 
-        messages = []
 
-        nofish = True
-        for row, centroid in zip(stats, centroids):
-            # check if the contour is fish-sized and central enough
-            if not fish_area[0] < row[cv2.CC_STAT_AREA] * area_scale < fish_area[1]:
-                continue
+class WellTrackingMethod(FishTrackingMethod):
+    """ Tracks one fish in each well of a multi-well plate. The plate
+    rectangle, given by wnd_pos and wnd_dim, is divided in a grid of
+    n_rows x n_columns wells. The regions different from the background are
+    found separately in each well, so that fish on the two sides of a wall
+    are not merged, and the fish are then looked for in the regions
+    of all the wells in parallel.
 
-            # find the bounding box of the fish in the original image coordinates
-            ftop, fleft, fheight, fwidth = (
-                int(round(row[x] * bg_downsample))
-                for x in [
-                    cv2.CC_STAT_TOP,
-                    cv2.CC_STAT_LEFT,
-                    cv2.CC_STAT_HEIGHT,
-                    cv2.CC_STAT_WIDTH,
-                ]
-            )
+    The running average of the background subtractor is computed for
+    each pixel, so each well effectively has its own background model.
 
-            if not (
-                (fleft - border_margin >= 0)
-                and (fleft + fwidth + border_margin < bg.shape[1])
-                and (ftop - border_margin >= 0)
-                and (ftop + fheight + border_margin < bg.shape[0])
-            ):
-                messages.append("W:An object of right area found outside margins")
-                continue
+    As each well holds a single fish, the best detection in the well is
+    always taken, max_displacement and max_turn only weigh the distance
+    against the orientation difference, without gating the detections.
 
-            # how much is this region shifted from the upper left corner of the image
-            cent_shift = np.array([fleft - border_margin, ftop - border_margin])
+    """
 
-            slices = (
-                slice(ftop - border_margin, ftop + fheight + border_margin),
-                slice(fleft - border_margin, fleft + fwidth + border_margin),
-            )
+    column_prefix = "w"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, name="well_tracking", **kwargs)
 
-            # take the region and mask the background away to aid detection
-            fishdet = bg[slices].copy()
+    @property
+    def n_tracked(self):
+        return self._params.n_rows * self._params.n_columns
 
-            # estimate the position of the head
-            fish_coords = fish_start(fishdet, threshold_eyes)
+    def changed(self, vals):
+        # the identities of the wells change with the grid
+        if any(p in vals.keys() for p in ["n_rows", "n_columns", "wnd_pos", "wnd_dim"]):
+            self.reset()
+        else:
+            super().changed(vals)
 
-            # if no actual fish was found here, continue on to the next connected component
-            if fish_coords[0] == -1:
-                messages.append("W:No appropriate tail start position found")
+    def _process(
+        self,
+        bg,
+        wnd_pos: Param((0, 0), gui=False),
+        wnd_dim: Param((640, 480), gui=False),
+        n_rows: Param(4, (1, 16)),
+        n_columns: Param(6, (1, 24)),
+        n_segments: Param(10, (2, 30)),
+        bg_dif_threshold: Param(25, (0, 255)),
+        threshold_eyes: Param(35, (0, 255)),
+        pos_uncertainty: Param(
+            1.0,
+            (0, 10.0),
+            desc="Uncertainty in pixels about the location of the head center of mass",
+        ),
+        persist_fish_for: Param(
+            2,
+            (1, 50),
+            desc="How many frames does the fish persist for if it is not detected",
+        ),
+        prediction_uncertainty: Param(0.1, (0.0, 10.0, 0.0001)),
+        max_displacement: Param(
+            15.0,
+            (1.0, 200.0),
+            desc="Maximal distance in pixels between the predicted and the "
+            "detected position of a fish for the detection to be assigned to it",
+        ),
+        max_turn: Param(
+            np.pi / 2,
+            (0.0, np.pi),
+            desc="Maximal difference between the predicted and the "
+            "detected orientation of a fish for the detection to be assigned to it",
+        ),
+        fish_area: Param((200, 1200), (1, 4000)),
+        border_margin: Param(5, (0, 100)),
+        tail_length: Param(60.0, (1.0, 200.0)),
+        tail_track_window: Param(3, (3, 70)),
+    ):
+        if self.fishes is None:
+            self.reset()
+        else:
+            self.fishes.predict(self._frame_interval())
+        self.previous_frame_time = self.frame_time
+
+        wells = _well_windows(wnd_pos, wnd_dim, n_rows, n_columns, bg.shape)
+        _, bg_thresh = self._threshold(bg, 1, bg_dif_threshold)
+
+        # find the regions different from the background in each well,
+        # in the coordinates of the whole image
+        well_stats = [np.zeros((0, 5), dtype=np.int32)]
+        blob_wells = [np.zeros(0, dtype=np.int64)]
+        for i_well, (y_start, y_stop, x_start, x_stop) in enumerate(wells):
+            # wells outside of the image are empty
+            if y_stop <= y_start or x_stop <= x_start:
                 continue
+            _, _, stats, _ = cv2.connectedComponentsWithStats(
+                bg_thresh[y_start:y_stop, x_start:x_stop]
+            )
+            # the first region is the background of the well
+            stats = stats[1:]
+            stats[:, cv2.CC_STAT_LEFT] += x_start
+            stats[:, cv2.CC_STAT_TOP] += y_start
+            well_stats.append(stats)
+            blob_wells.append(np.full(len(stats), i_well))
+        stats = np.concatenate(well_stats)
+        blob_wells = np.concatenate(blob_wells)
+        max_area = np.max(stats[:, cv2.CC_STAT_AREA]) if len(stats) > 0 else 0
+
+        detections, status = _detect_fish(
+            bg,
+            stats,
+            fish_area[0],
+            fish_area[1],
+            1,
+            border_margin,
+            threshold_eyes,
+            tail_length,
+            n_segments,
+            tail_track_window,
+        )
+        messages = [
+            _BLOB_MESSAGES[blob_status]
+            for blob_status in set(status)
+            if blob_status in _BLOB_MESSAGES
+        ]
 
-            head_coords_up = fish_coords + cent_shift
+        # in each well, the tracked fish is updated with the closest
+        # detection, however far it is, or, if there is no fish tracked,
+        # the largest detection starts to be tracked
+        is_fish = status == _BLOB_FISH
+        costs = self.fishes.assignment_costs(detections, False)
+        i_updated = []
+        i_detections = []
+        for i_well in range(len(wells)):
+            in_well = np.flatnonzero(is_fish & (blob_wells == i_well))
+            if len(in_well) == 0:
+                continue
+            if np.isnan(self.fishes.coords[i_well, 0]):
+                self.fishes.set_fish(
+                    i_well,
+                    detections[in_well[np.argmax(stats[in_well, cv2.CC_STAT_AREA])]],
+                )
+                messages.append("I:Added new fish")
+            else:
+                i_updated.append(i_well)
+                i_detections.append(in_well[np.argmin(costs[i_well, in_well])])
+        if len(i_updated) > 0:
+            self.fishes.update_fishes(
+                np.array(i_updated, dtype=np.int64),
+                np.ascontiguousarray(detections[i_detections]),
+            )
 
-            theta = _fish_direction_n(bg, head_coords_up, int(round(tail_length / 2)))
+        self._set_diagnostic_image(bg, 1, bg_dif_threshold, threshold_eyes)
 
-            # find the points of the tail
-            points = find_fish_midline(
-                bg,
-                *head_coords_up,
-                theta,
-                tail_track_window,
-                tail_length / n_segments,
-                n_segments + 1,
-            )
+        return NodeOutput(
+            messages, self._output(*self.fishes.coords.flatten(), max_area * 1.0)
+        )
 
-            # convert to angles
-            angles = np.mod(points_to_angles(points) + np.pi, np.pi * 2) - np.pi
-            if len(angles) == 0:
-                messages.append("W:Tail not completely detectable")
-                continue
 
-            # also, make the angles continuous
-            angles[1:] = np.unwrap(angles[1:] - angles[0])
+def _well_windows(wnd_pos, wnd_dim, n_rows, n_columns, shape):
+    """ Divides the rectangle with the upper left corner at wnd_pos and
+    size wnd_dim (both as x, y) in a grid of wells, clipped to the image,
+    so the wells outside of it are empty
 
-            # put the data together for one fish
-            fish_coords = np.concatenate([np.array(points[0][:2]), angles])
+    Returns
+    -------
+    list of the (y_start, y_stop, x_start, x_stop) windows of the
+    wells, row by row
 
-            nofish = False
-            # check if this is a new fish, or it is an update of
-            # a fish detected previously
-            if self.fishes.update(fish_coords):
-                messages.append("I:Updated previous fish")
-            elif self.fishes.add_fish(fish_coords):
-                messages.append("I:Added new fish")
-            else:
-                messages.append("E:More fish than n_fish max")
+    """
+    ys = np.clip(
+        np.round(wnd_pos[1] + np.arange(n_rows + 1) * wnd_dim[1] / n_rows), 0, shape[0]
+    ).astype(int)
+    xs = np.clip(
+        np.round(wnd_pos[0] + np.arange(n_columns + 1) * wnd_dim[0] / n_columns),
+        0,
+        shape[1],
+    ).astype(int)
+    return [
+        (ys[i_row], ys[i_row + 1], xs[i_col], xs[i_col + 1])
+        for i_row in range(n_rows)
+        for i_col in range(n_columns)
+    ]
 
-        if nofish:
-            messages.append(
-                "W:No object of right area, between {:.0f} and {:.0f}".format(
-                    *fish_area
+
+def _aligned_window(x, y, half_size, shape, alignment):
+    """ The window around the point (x, y), inside the image, with the
+    start aligned to a multiple of alignment (the downsampling)
+
+    Returns
+    -------
+    tuple (y_start, y_stop, x_start, x_stop)
+
+    """
+    y_start = max(int(y - half_size) // alignment * alignment, 0)
+    x_start = max(int(x - half_size) // alignment * alignment, 0)
+    return (
+        y_start,
+        min(int(np.ceil(y + half_size)), shape[0]),
+        x_start,
+        min(int(np.ceil(x + half_size)), shape[1]),
+    )
+
+
+def _merge_windows(windows):
+    """ Replaces overlapping windows by the smallest one containing
+    both, until none overlap, so that no fish is found twice
+    """
+    windows = list(windows)
+    i = 0
+    while i < len(windows):
+        for j in range(i + 1, len(windows)):
+            a, b = windows[i], windows[j]
+            if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                windows[i] = (
+                    min(a[0], b[0]),
+                    max(a[1], b[1]),
+                    min(a[2], b[2]),
+                    max(a[3], b[3]),
                 )
-            )
+                del windows[j]
+                # the merged window has to be checked against all others again
+                i = -1
+                break
+        i += 1
+    return windows
+
+
+# the outcomes of the search for a fish in a region different from the background
+_BLOB_FISH = 0
+_BLOB_WRONG_AREA = 1
+_BLOB_OUTSIDE_MARGINS = 2
+_BLOB_NO_START = 3
+_BLOB_NO_TAIL = 4
+
+_BLOB_MESSAGES = {
+    _BLOB_OUTSIDE_MARGINS: "W:An object of right area found outside margins",
+    _BLOB_NO_START: "W:No appropriate tail start position found",
+    _BLOB_NO_TAIL: "W:Tail not completely detectable",
+}
+
+
+@jit(nopython=True, parallel=True)
+def _detect_fish(
+    bg,
+    stats,
+    min_area,
+    max_area,
+    bg_downsample,
+    border_margin,
+    threshold_eyes,
+    tail_length,
+    n_segments,
+    tail_track_window,
+):
+    """ Looks for a fish in each of the regions different from the
+    background, in parallel
 
-        # if a debugging image is to be shown, set it
-        if self.set_diagnostic == "background difference":
-            self.diagnostic_image = bg
-        elif self.set_diagnostic == "thresholded background difference":
-            self.diagnostic_image = bg_thresh
-        elif self.set_diagnostic == "fish detection":
-            fishdet = bg_small.copy()
-            fishdet[bg_thresh == 0] = 0
-            self.diagnostic_image = fishdet
-        elif self.set_diagnostic == "thresholded for eye and swim bladder":
-            self.diagnostic_image = np.maximum(bg, threshold_eyes) - threshold_eyes
+    Parameters
+    ----------
+    bg :
+        background-subtracted image
+    stats :
+        statistics of the regions, from cv2.connectedComponentsWithStats
+        on the downsampled image
+    min_area :
+        minimal area of a fish, in pixels of the downsampled image
+    max_area :
+        maximal area of a fish, in pixels of the downsampled image
 
-        if self._output_type is None:
-            self.reset_state()
+    Returns
+    -------
+    array of the fish coordinates (x, y, angles of the n_segments segments)
+    found in each region, and an array with the outcome for each region
+    (one of the _BLOB_ constants)
 
-        return NodeOutput(
-            messages, self._output_type(*self.fishes.coords.flatten(), max_area * 1.0)
+    """
+    n_blobs = stats.shape[0]
+    detections = np.full((n_blobs, 2 + n_segments), np.nan)
+    status = np.full(n_blobs, _BLOB_WRONG_AREA)
+    radius = int(round(tail_length / 2))
+    for i_blob in prange(n_blobs):
+        # check if the contour is fish-sized and central enough
+        if not min_area < stats[i_blob, cv2.CC_STAT_AREA] < max_area:
+            continue
+
+        # find the bounding box of the fish in the original image coordinates
+        ftop = stats[i_blob, cv2.CC_STAT_TOP] * bg_downsample
+        fleft = stats[i_blob, cv2.CC_STAT_LEFT] * bg_downsample
+        fheight = stats[i_blob, cv2.CC_STAT_HEIGHT] * bg_downsample
+        fwidth = stats[i_blob, cv2.CC_STAT_WIDTH] * bg_downsample
+
+        if not (
+            (fleft - border_margin >= 0)
+            and (fleft + fwidth + border_margin < bg.shape[1])
+            and (ftop - border_margin >= 0)
+            and (ftop + fheight + border_margin < bg.shape[0])
+        ):
+            status[i_blob] = _BLOB_OUTSIDE_MARGINS
+            continue
+
+        # estimate the position of the head
+        fish_coords = fish_start(
+            bg[
+                ftop - border_margin : ftop + fheight + border_margin,
+                fleft - border_margin : fleft + fwidth + border_margin,
+            ],
+            threshold_eyes,
+        )
+
+        # if no actual fish was found here, continue on to the next region
+        if fish_coords[0] == -1:
+            status[i_blob] = _BLOB_NO_START
+            continue
+
+        # shift the position from the upper left corner of the region
+        fish_coords[0] += fleft - border_margin
+        fish_coords[1] += ftop - border_margin
+
+        theta = _fish_direction_n(bg, fish_coords, radius)
+
+        # find the points of the tail
+        points = find_fish_midline(
+            bg,
+            fish_coords[0],
+            fish_coords[1],
+            theta,
+            tail_track_window,
+            tail_length / n_segments,
+            n_segments + 1,
         )
+        if len(points) < 2:
+            status[i_blob] = _BLOB_NO_TAIL
+            continue
+
+        # convert to angles, and make the ones of the tail relative to the
+        # first one continuous, as np.unwrap
+        angles = np.mod(points_to_angles(points) + np.pi, np.pi * 2) - np.pi
+        detections[i_blob, 0] = points[0][0]
+        detections[i_blob, 1] = points[0][1]
+        detections[i_blob, 2] = angles[0]
+        if n_segments > 1:
+            detections[i_blob, 3] = angles[1] - angles[0]
+        for i in range(2, n_segments):
+            detections[i_blob, 2 + i] = _minimal_angle_dif(
+                detections[i_blob, 1 + i], angles[i] - angles[0]
+            )
+        status[i_blob] = _BLOB_FISH
+
+    return detections, status
+
+
+def assign_detections(costs):
+    """ Finds the assignment of detections to fish with the minimal total cost
+
+    Parameters
+    ----------
+    costs :
+        (n_fish, n_detections) array of the costs of the assignments,
+        infinite for the forbidden ones
+
+    Returns
+    -------
+    list of (i_fish, i_detection) pairs
+
+    """
+    allowed = np.isfinite(costs)
+    if not np.any(allowed):
+        return []
+    # forbidden assignments cost more than all allowed ones together, so that
+    # they are chosen only if no other assignment is possible, and then dropped
+    i_fishes, i_detections = linear_sum_assignment(
+        np.where(allowed, costs, np.sum(costs[allowed]) + 1)
+    )
+    return [
+        (i_fish, i_detection)
+        for i_fish, i_detection in zip(i_fishes, i_detections)
+        if allowed[i_fish, i_detection]
+    ]
 
 
 spec = [
     ("n_fish", int64),
     ("coords", float64[:, :]),
     ("i_not_updated", int64[:]),
-    ("F", float64[:, :]),
     ("uncertainties", float64[:]),
-    ("Q", float64[:, :]),
+    ("acceleration_variance", float64),
     ("Ps", float64[:, :, :, :]),
     ("def_P", float64[:, :, :]),
     ("persist_fish_for", int64),
+    ("max_displacement", float64),
+    ("max_turn", float64),
 ]
 
 
 @jitclass(spec)
 class Fishes(object):
     def __init__(
-        self, n_fish_max, pos_std, angle_std, n_segments, pred_coef, persist_fish_for
+        self,
+        n_fish_max,
+        pos_std,
+        angle_std,
+        n_segments,
+        pred_coef,
+        persist_fish_for,
+        max_displacement=15.0,
+        max_turn=np.pi / 2,
     ):
         self.n_fish = n_fish_max
+        # the filtered x, y and orientation with their velocities
+        # (in pixels and radians per second), followed by the tail angles
         self.coords = np.full((n_fish_max, 6 + n_segments), np.nan)
         self.uncertainties = np.array((pos_std, angle_std, angle_std))
+        # the velocity uncertainties and the prediction coefficient are
+        # given per nominal frame interval
         self.def_P = np.zeros((3, 2, 2))
         for i, uc in enumerate(self.uncertainties):
             self.def_P[i, 0, 0] = uc
-            self.def_P[i, 1, 1] = uc
+            self.def_P[i, 1, 1] = uc / _NOMINAL_DT ** 2
+        self.acceleration_variance = pred_coef / _NOMINAL_DT ** 2
         self.i_not_updated = np.zeros(n_fish_max, dtype=np.int64)
         self.Ps = np.zeros((n_fish_max, 3, 2, 2))
-        self.F = np.array([[1.0, 1.0], [0.0, 1.0]])
-        dt = 0.02
-        self.Q = (
-            np.array([[0.25 * dt ** 4, 0.5 * dt ** 3], [0.5 * dt ** 3, dt ** 2]])
-            * pred_coef
-        )
         self.persist_fish_for = persist_fish_for
+        self.max_displacement = max_displacement
+        self.max_turn = max_turn
 
-    def predict(self):
+    def predict(self, dt):
+        """ Predicts the positions and orientations of all the fish
+        dt seconds after the previous frame
+        """
+        active = ~np.isnan(self.coords[:, 0])
+        Q = white_noise_acceleration(dt, self.acceleration_variance)
+        Qs = np.empty((3, 2, 2))
+        for i_coord in range(3):
+            Qs[i_coord] = Q
+        predict_stacked(self.coords, self.Ps, active, dt, Qs)
         for i_fish in range(self.n_fish):
-            if not np.isnan(self.coords[i_fish, 0]):
-                for i_coord in range(0, 6, 2):
-                    predict_inplace(
-                        self.coords[i_fish, i_coord : i_coord + 2],
-                        self.Ps[i_fish, i_coord // 2],
-                        self.F,
-                        self.Q,
-                    )
+            if active[i_fish]:
                 self.i_not_updated[i_fish] += 1
                 if self.i_not_updated[i_fish] > self.persist_fish_for:
                     self.coords[i_fish, :] = np.nan
 
-    def update(self, new_fish):
+    def assignment_costs(self, detections, gated=True):
+        """ The costs of assigning each detection to each of the tracked fish,
+        from the distances to their predicted positions and orientations.
+        The assignments to fish which were already updated in this frame,
+        and, if gated, the ones further than max_displacement or max_turn,
+        are forbidden and cost infinity.
+
+        Returns
+        -------
+        (n_fish, n_detections) array of costs
+
+        """
+        costs = np.full((self.n_fish, len(detections)), np.inf)
         for i_fish in range(self.n_fish):
-            if not np.isnan(self.coords[i_fish, 0]):
-                if self.is_close(new_fish, i_fish) and self.i_not_updated[i_fish] != 0:
-                    # update position with Kalman filtering
-                    for i_coord in range(0, 3):
-                        # if it is the angle find the modulo 2pi closest
-                        nc = new_fish[i_coord]
-                        if i_coord == 2:
-                            nc = _minimal_angle_dif(self.coords[i_fish, 4], nc)
-                        update_inplace(
-                            nc,
-                            self.coords[i_fish, i_coord * 2 : i_coord * 2 + 2],
-                            self.Ps[i_fish, i_coord],
-                            self.uncertainties[i_coord],
-                        )
-                    # update tail angles
-                    self.coords[i_fish, 6:] = new_fish[3:]
-                    self.i_not_updated[i_fish] = 0
-                    return True
+            if np.isnan(self.coords[i_fish, 0]) or self.i_not_updated[i_fish] == 0:
+                continue
+            for i_detection in range(len(detections)):
+                dist_sq = (detections[i_detection, 0] - self.coords[i_fish, 0]) ** 2 + (
+                    detections[i_detection, 1] - self.coords[i_fish, 2]
+                ) ** 2
+                dtheta = np.abs(
+                    np.mod(
+                        detections[i_detection, 2] - self.coords[i_fish, 4] + np.pi,
+                        np.pi * 2,
+                    )
+                    - np.pi
+                )
+                if not gated or (
+                    dist_sq < self.max_displacement ** 2 and dtheta < self.max_turn
+                ):
+                    costs[i_fish, i_detection] = (
+                        dist_sq / self.max_displacement ** 2
+                        + (dtheta / self.max_turn) ** 2
+                    )
+        return costs
+
+    def update(self, new_fish):
+        """ Updates the fish closest to the new coordinates, if any
+        is within the gating distance and angle
+        """
+        costs = self.assignment_costs(new_fish.reshape(1, -1))[:, 0]
+        i_fish = np.argmin(costs)
+        if not np.isfinite(costs[i_fish]):
+            return False
+        self.update_fish(i_fish, new_fish)
+        return True
+
+    def update_fish(self, i_fish, new_fish):
+        self.update_fishes(
+            np.full(1, i_fish, dtype=np.int64), new_fish.reshape(1, -1)
+        )
+
+    def update_fishes(self, i_fishes, new_fishes):
+        """ Updates the fish with indices i_fishes with the
+        detections in the rows of new_fishes
+        """
+        measurements = np.ascontiguousarray(new_fishes[:, :3])
+        for i_meas in range(len(i_fishes)):
+            # for the angle, find the modulo 2pi closest to the prediction
+            measurements[i_meas, 2] = _minimal_angle_dif(
+                self.coords[i_fishes[i_meas], 4], measurements[i_meas, 2]
+            )
+        # update the positions and orientations with Kalman filtering
+        update_stacked(
+            measurements, i_fishes, self.coords, self.Ps, self.uncertainties
+        )
+        # update tail angles
+        for i_meas in range(len(i_fishes)):
+            self.coords[i_fishes[i_meas], 6:] = new_fishes[i_meas, 3:]
+            self.i_not_updated[i_fishes[i_meas]] = 0
 
     def add_fish(self, new_fish):
         for i_fish in range(self.n_fish):
             if np.isnan(self.coords[i_fish, 0]):
-                self.coords[i_fish, 0:6:2] = new_fish[:3]
-                self.coords[i_fish, 1:6:2] = 0.0
-                self.coords[i_fish, 6:] = new_fish[3:]
-                self.Ps[i_fish] = self.def_P
-                self.i_not_updated[i_fish] = 0
+                self.set_fish(i_fish, new_fish)
                 return True
         return False
 
-    def is_close(self, new_fish, i_fish):
-        """ Check whether the new coordinates are
-        within a certain number of pixels of the old estimate
-        and within a certain angle
-        """
-        n_px = 15
-        d_theta = np.pi / 2
-        dists = new_fish[:2] - self.coords[i_fish, 0:4:2]
-        dtheta = np.abs(
-            np.mod(new_fish[2] - self.coords[i_fish, 4] + np.pi, np.pi * 2) - np.pi
-        )
-
-        return np.sum(dists ** 2) < n_px ** 2 and dtheta < d_theta
+    def set_fish(self, i_fish, new_fish):
+        """ Starts tracking a fish with index i_fish from a detection """
+        self.coords[i_fish, 0:6:2] = new_fish[:3]
+        self.coords[i_fish, 1:6:2] = 0.0
+        self.coords[i_fish, 6:] = new_fish[3:]
+        self.Ps[i_fish] = self.def_P
+        self.i_not_updated[i_fish] = 0
 
 
 @jit(nopython=True)
@@ -1,22 +1,51 @@
+import numpy as np
 from lightparam import Parametrized, Param
 from anytree import PreOrderIter, Node, Resolver
 from multiprocessing import Queue
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
+from time import perf_counter
 
 
 NodeOutput = namedtuple("NodeOutput", "messages data")
 
 
 class PipelineNode(Node):
+    # nodes whose output depends on the previous frames have to set this,
+    # so that the pipeline is not split across several tracking workers
+    stateful = False
+
+    # parameters which make the output depend on the previous frames, with
+    # the values which turn this off, for the workers which see only some
+    # of the frames
+    stateless_params = dict()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._params = None
         self.diagnostic_image_options = []
+        # either the image or, if it takes time to compute, a function
+        # without arguments returning it, which is called only for the
+        # frames which are displayed
         self.diagnostic_image = None
         self.set_diagnostic = None
         self._output_type = None
 
+        # if set, the duration of each call to process, in seconds
+        # is appended to the timings list
+        self.record_timing = False
+        self.timings = []
+
+        # if the pipeline crops the input of the node to a region of interest,
+        # the position of the cropped region and the shape of the whole input
+        self.input_offset = (0, 0)
+        self.input_shape = None
+
+        # for stateful nodes, the time of the frame being processed
+        # in seconds, if the pipeline is given it, otherwise None
+        self.frame_time = None
+
     def reset(self):
         pass
 
@@ -35,7 +64,12 @@ class PipelineNode(Node):
         return self.separator.join([""] + [str(node.name) for node in self.path])
 
     def process(self, *inputs) -> NodeOutput:
-        out = self._process(*inputs, **self._params.params.values)
+        if self.record_timing:
+            t_start = perf_counter()
+            out = self._process(*inputs, **self._params.params.values)
+            self.timings.append(perf_counter() - t_start)
+        else:
+            out = self._process(*inputs, **self._params.params.values)
         try:
             assert isinstance(out, NodeOutput)
         except AssertionError:
@@ -51,6 +85,8 @@ class PipelineNode(Node):
 class ImageToImageNode(PipelineNode):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # preallocated images which the node reuses on every frame
+        self._buffers = dict()
 
     @property
     def output_type_changed(self):
@@ -60,6 +96,77 @@ class ImageToImageNode(PipelineNode):
         for c in self.children:
             c.acknowledge_changes()
 
+    @property
+    def output_scale(self):
+        """ The ratio between the size of the output and of the input image"""
+        return 1.0
+
+    @property
+    def roi_margin(self):
+        """ The number of pixels around each output pixel which are used to
+        compute it (e.g. for filtering), in output image coordinates"""
+        return 0
+
+    def output_shape(self, shape):
+        """ The shape of the output image for an input image of given shape"""
+        scale = self.output_scale
+        if scale == 1:
+            return shape
+        return tuple(int(round(s * scale)) for s in shape[:2]) + tuple(shape[2:])
+
+    def _buffer(self, name, shape, dtype):
+        """ Returns the image buffer of the node with the given name,
+        which is allocated only on the first call or if the shape or type of
+        the image change. Nodes write their outputs (and intermediate images)
+        in the buffers with the dst= or out= arguments of OpenCV and NumPy
+        functions, so that processing a frame does not allocate new images.
+        The outputs are therefore valid only until the next frame is processed.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def input_roi(self, roi):
+        """ The region of the input image which is needed to compute the
+        given region (y_start, y_stop, x_start, x_stop) of the output image
+        """
+        scale = self.output_scale
+        margin = self.roi_margin
+        y_start, y_stop, x_start, x_stop = roi
+        return (
+            (y_start - margin) / scale,
+            (y_stop + margin) / scale,
+            (x_start - margin) / scale,
+            (x_stop + margin) / scale,
+        )
+
+    def process_batch(self, images) -> NodeOutput:
+        """ Processes a stack of images (with frames along the first axis)
+        and returns a NodeOutput with the stack of processed images
+
+        """
+        return self._process_batch(images, **self._params.params.values)
+
+    def _process_batch(self, images, **kwargs) -> NodeOutput:
+        """ Nodes which can vectorise their processing over frames override
+        this method, by default the node processes the frames one by one
+        into a preallocated stack.
+
+        """
+        messages = []
+        processed = None
+        for i_frame, image in enumerate(images):
+            output = self._process(image, **kwargs)
+            messages.extend(output.messages)
+            if processed is None:
+                processed = np.empty(
+                    (len(images),) + output.data.shape, output.data.dtype
+                )
+            processed[i_frame] = output.data
+        return NodeOutput(messages, processed)
+
 
 class SourceNode(ImageToImageNode):
     def __init__(self, *args, **kwargs):
@@ -68,6 +175,9 @@ class SourceNode(ImageToImageNode):
     def _process(self, *input, **kwargs):
         return NodeOutput([], *input)
 
+    def _process_batch(self, images, **kwargs):
+        return NodeOutput([], images)
+
 
 class ImageToDataNode(PipelineNode):
     def __init__(self, *args, **kwargs):
@@ -76,6 +186,10 @@ class ImageToDataNode(PipelineNode):
         self._params = None
         self._output_type_changed = True  # Has to be true to initialize the class
 
+        # if the pipeline runs in record mode, the slice of the
+        # preallocated output record this node writes into
+        self._output_buffer = None
+
     @property
     def output_type_changed(self):
         if self._output_type_changed:
@@ -85,6 +199,64 @@ class ImageToDataNode(PipelineNode):
     def acknowledge_changes(self):
         self._output_type_changed = False
 
+    def roi(self, shape):
+        """ The region of the input image which the node needs with the
+        current parameters, for an input image of the given shape.
+        Nodes which only look at part of the image override this, so that
+        the pipeline can crop the image before the preceding nodes process it.
+        The node then receives the cropped image, and has to take the
+        input_offset and input_shape attributes into account.
+
+        Returns
+        -------
+        tuple (y_start, y_stop, x_start, x_stop) or None for the whole image
+
+        """
+        return None
+
+    def _output(self, *values):
+        """ Packs the output values of the node. If the pipeline runs in
+        record mode the values are written in place into the preallocated
+        output record, otherwise they are put in a new output namedtuple.
+        The namedtuple is also returned if the output type has just changed,
+        so that the pipeline can read the new column names.
+
+        """
+        if self._output_buffer is not None and not self._output_type_changed:
+            self._output_buffer[:] = values
+            return self._output_buffer
+        return self._output_type(*values)
+
+    def process_batch(self, images) -> NodeOutput:
+        """ Processes a stack of images frame by frame, writing the outputs
+        in preallocated columns. The columns are laid out from the output
+        type of the first frame, so the output type must not change within
+        the batch.
+
+        Returns
+        -------
+        NodeOutput with the messages and a (n_frames, n_columns) float64 array
+
+        """
+        messages = []
+        columns = None
+        fields = None
+        for i_frame, image in enumerate(images):
+            output = self.process(image)
+            messages.extend(output.messages)
+            if columns is None:
+                fields = self._output_type._fields
+                columns = np.empty((len(images), len(fields)))
+            elif self._output_type._fields != fields:
+                raise ValueError(
+                    "The output columns of {} changed at frame {} of the batch, "
+                    "they can only change between batches".format(
+                        self.name, i_frame
+                    )
+                )
+            columns[i_frame, :] = output.data
+        return NodeOutput(messages, columns)
+
     def _process(self):
         # Node processing code
 
@@ -105,6 +277,27 @@ class Pipeline:
         self._param_finder = Resolver()
         self.node_dict = dict()
 
+        self._execution_plan = None
+        self._data_nodes = []
+        self._stateful_nodes = []
+        self._output_slices = None
+
+        self.record_output = False
+        self._record = None
+
+        self.branch_threads = 0
+        self._branches = []
+        self._executor = None
+
+        self.crop_roi = True
+        self._crops = None
+        self._crop_shape = None
+
+    @property
+    def stateful(self):
+        """ Whether any of the nodes depends on the previous frames"""
+        return any(node.stateful for node in PreOrderIter(self.root))
+
     @property
     def headers_to_plot(self):
         hds = []
@@ -113,11 +306,46 @@ class Pipeline:
                 hds.extend(node.monitored_headers)
         return hds
 
-    def setup(self, tree=None):
+    def setup(
+        self,
+        tree=None,
+        record_output=False,
+        branch_threads=0,
+        record_timing=False,
+        crop_roi=True,
+    ):
         """ Due to multiprocessing limitations, the setup is
         run separately from the constructor
 
+        Parameters
+        ----------
+        tree :
+            lightparam tree to which the parameters of the nodes are added
+        record_output : bool
+            if True, the output of the pipeline is a one-row NumPy
+            structured array with a float64 column for each output field,
+            which is preallocated and overwritten on every frame,
+            instead of a new namedtuple per frame
+        branch_threads : int
+            if larger than 1, the subtrees starting from the children of the
+            root node are run concurrently on a persistent pool with this
+            many threads. This pays off only if the nodes release the GIL
+            (as OpenCV and nogil numba functions do). The outputs are
+            assembled in the same order as in the sequential case.
+        record_timing : bool
+            if True, every node records the time taken to process each frame,
+            which can be summarized with timing_statistics
+        crop_roi : bool
+            if True, the input of each subtree starting from a child of the
+            root is cropped to the union of the regions of interest of its
+            data nodes, if all of them declare one (see ImageToDataNode.roi).
+            The cropping is turned off while a diagnostic image is displayed.
+
         """
+        self.record_output = record_output
+        self.branch_threads = branch_threads
+        self.crop_roi = crop_roi
+        self._timing_type = None
         diag_images = []
         for node in PreOrderIter(self.root):
             node.setup()
@@ -142,6 +370,214 @@ class Pipeline:
             params=dict(reset=Param(False, gui="button")),
             tree=tree,
         )
+        self.compile()
+        for node, _, _ in self._execution_plan:
+            node.record_timing = record_timing
+
+    def compile(self):
+        """ Flattens the tree of nodes into a list of processing steps
+        in the order in which recursive_run would visit them, so that
+        running the pipeline on a frame does not need to walk the tree.
+
+        Each step is a tuple of the node, the index of the step
+        which provides its input (-1 for the raw input) and, for
+        ImageToDataNodes, the position of their data in the output (-1 for
+        image nodes). The children of ImageToDataNodes are never run,
+        as in recursive_run.
+
+        As the steps are in pre-order, the subtree of each child of the root
+        is a contiguous range of steps, which can be run independently
+        of the others.
+
+        """
+        step_indices = dict()
+        plan = []
+        self._data_nodes = []
+        self._branches = []
+        for node in PreOrderIter(
+            self.root, stop=lambda n: isinstance(n.parent, ImageToDataNode)
+        ):
+            if node.parent is self.root:
+                self._branches.append(len(plan))
+            step_indices[node] = len(plan)
+            if isinstance(node, ImageToDataNode):
+                i_data = len(self._data_nodes)
+                self._data_nodes.append(node)
+            else:
+                i_data = -1
+            plan.append((node, step_indices.get(node.parent, -1), i_data))
+        self._branches = list(
+            zip(self._branches, self._branches[1:] + [len(plan)])
+        )
+        self._execution_plan = plan
+        self._stateful_nodes = [node for node, _, _ in plan if node.stateful]
+        self._output_slices = None
+        self._output_type = None
+        self._crops = None
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        if self.branch_threads > 1 and len(self._branches) > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.branch_threads, thread_name_prefix="pipeline"
+            )
+
+    @property
+    def timing_columns(self):
+        """ The column names of the timing statistics, the mean, 99th
+        percentile and maximum processing time of each node
+        """
+        if self._execution_plan is None:
+            self.compile()
+        return [
+            node.name + "_" + stat
+            for node, _, _ in self._execution_plan
+            for stat in ["mean", "p99", "max"]
+        ]
+
+    def timing_statistics(self):
+        """ Summarizes the processing times (in milliseconds) recorded by
+        the nodes since the last call, and clears them.
+
+        Returns
+        -------
+        namedtuple with the timing_columns, or None if no frames were timed
+
+        """
+        if self._timing_type is None:
+            self._timing_type = namedtuple("timing", self.timing_columns)
+        if any(len(node.timings) == 0 for node, _, _ in self._execution_plan):
+            return None
+        stats = []
+        for node, _, _ in self._execution_plan:
+            timings = np.array(node.timings) * 1000
+            node.timings.clear()
+            stats.extend(
+                (np.mean(timings), np.percentile(timings, 99), np.max(timings))
+            )
+        return self._timing_type(*stats)
+
+    def close(self):
+        """ Stops the threads used to run branches in parallel, if any
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _compile_outputs(self):
+        """ Computes the fixed position of the data of each ImageToDataNode
+        in the pipeline output and the output type. Has to be rerun
+        only when the output type of a node changes.
+
+        The column names are taken from the output types of the nodes and
+        not from their outputs, as in record mode the nodes whose
+        output type did not change return a view of the previous record.
+
+        """
+        self._output_slices = []
+        fields = []
+        for node in self._data_nodes:
+            node_fields = node._output_type._fields
+            self._output_slices.append(
+                slice(len(fields), len(fields) + len(node_fields))
+            )
+            fields.extend(node_fields)
+        self._output_type = namedtuple("o", fields)
+
+        if self.record_output:
+            self._record = np.full(
+                1, np.nan, dtype=[(field, np.float64) for field in fields]
+            )
+            flat_record = self._record.view(np.float64)
+            for node, sl in zip(self._data_nodes, self._output_slices):
+                node._output_buffer = flat_record[sl]
+
+    def _compute_crops(self, shape):
+        """ Computes the region of the input each branch is cropped to,
+        and sets the offsets and full input shapes of the nodes accordingly.
+        Has to be rerun when the parameters or the input shape change.
+
+        """
+        self._crop_shape = shape
+        self._crops = [None] * len(self._execution_plan)
+        for node, _, _ in self._execution_plan:
+            node.input_offset = (0, 0)
+            node.input_shape = None
+
+        if (
+            not self.crop_roi
+            or shape is None
+            or self.all_params["diagnostics"].image != "unprocessed"
+        ):
+            return
+
+        shape = shape[:2]
+        for start, stop in self._branches:
+            branch_nodes = [node for node, _, _ in self._execution_plan[start:stop]]
+            # nodes with a state would be confused by a changing input size
+            if any(node.stateful for node in branch_nodes):
+                continue
+
+            crop = None
+            min_scale = 1.0
+            for node in branch_nodes:
+                if not isinstance(node, ImageToDataNode):
+                    continue
+                image_nodes = node.path[1:-1]
+                node_shape = shape
+                scale = 1.0
+                for image_node in image_nodes:
+                    node_shape = image_node.output_shape(node_shape)
+                    scale *= image_node.output_scale
+                roi = node.roi(node_shape)
+                if roi is None:
+                    crop = None
+                    break
+                for image_node in image_nodes[::-1]:
+                    roi = image_node.input_roi(roi)
+                crop = (
+                    roi
+                    if crop is None
+                    else (
+                        min(crop[0], roi[0]),
+                        max(crop[1], roi[1]),
+                        min(crop[2], roi[2]),
+                        max(crop[3], roi[3]),
+                    )
+                )
+                min_scale = min(min_scale, scale)
+
+            if crop is None:
+                continue
+
+            # align the crop to the pixels of the downscaled images
+            align = max(1, int(round(1 / min_scale)))
+            y_start, x_start = (
+                max(0, int(np.floor(c / align)) * align) for c in crop[::2]
+            )
+            y_stop, x_stop = (
+                min(s, int(np.ceil(c / align)) * align)
+                for c, s in zip(crop[1::2], shape)
+            )
+            if y_stop <= y_start or x_stop <= x_start:
+                continue
+            if (y_start, y_stop, x_start, x_stop) == (0, shape[0], 0, shape[1]):
+                continue
+            self._crops[start] = (slice(y_start, y_stop), slice(x_start, x_stop))
+
+            for node in branch_nodes:
+                if node.parent is self.root:
+                    node.input_offset = (y_start, x_start)
+                    node.input_shape = shape
+                else:
+                    scale = node.parent.output_scale
+                    node.input_offset = tuple(
+                        o * scale for o in node.parent.input_offset
+                    )
+                    node.input_shape = node.parent.output_shape(
+                        node.parent.input_shape
+                    )
 
     @property
     def diagnostic_image(self):
@@ -164,7 +600,34 @@ class Pipeline:
     def serialize_params(self):
         return {n: p.params.values for n, p in self.all_params.items()}
 
+    def disable_frame_dependence(self):
+        """ Sets the parameters which make the output of the nodes depend
+        on the previous frames (see PipelineNode.stateless_params) to the
+        values which turn this off, for pipelines which see only some
+        of the frames.
+
+        Returns
+        -------
+        the changed parameters, as a dictionary by node path
+
+        """
+        changes = dict()
+        for path, node in self.node_dict.items():
+            values = node._params.params.values
+            node_changes = {
+                name: value
+                for name, value in node.stateless_params.items()
+                if values[name] != value
+            }
+            if node_changes:
+                changes[path] = node_changes
+        if changes:
+            self.deserialize_params(changes)
+        return changes
+
     def deserialize_params(self, rec_params):
+        # the regions of interest depend on the parameters
+        self._crops = None
         for item, vals in rec_params.items():
             self.all_params[item].params.values = vals
             if item != "diagnostics" and item != "reset":
@@ -213,7 +676,139 @@ class Pipeline:
             output_tuple,
         )
 
-    def run(self, input):
-        out = self.recursive_run(self.root, input)
-        self.root.acknowledge_changes()
-        return out
+    def _run_steps(self, start, stop, input, images, messages, data_outputs):
+        """ Runs a range of steps of the execution plan, filling the
+        lists of images and messages (indexed by step) and of data outputs
+        (indexed by the position in the output)
+
+        """
+        for i_step in range(start, stop):
+            node, i_input, i_data = self._execution_plan[i_step]
+            image = images[i_input] if i_input >= 0 else input
+            crop = self._crops[i_step]
+            if crop is not None:
+                image = image[crop]
+            output = node.process(image)
+            messages[i_step] = output.messages
+            if i_data >= 0:
+                data_outputs[i_data] = output.data
+            else:
+                images[i_step] = output.data
+
+    def run_batch(self, frames):
+        """ Runs the pipeline on a stack of frames, for offline tracking.
+        Image processing nodes process the whole stack at once, and
+        data nodes fill preallocated output columns.
+
+        Parameters
+        ----------
+        frames : np.ndarray
+            stack of frames, with frames along the first axis
+
+        Returns
+        -------
+        NodeOutput with all the messages and a structured array with a float64
+        column for each output field and a row for each frame. The output
+        fields can differ between batches, if the parameters were changed.
+
+        """
+        if self._execution_plan is None:
+            self.compile()
+        # the frames are processed uncropped
+        self._compute_crops(None)
+        self._crops = None
+
+        images = [None] * len(self._execution_plan)
+        data_columns = [None] * len(self._data_nodes)
+        messages = []
+        for i_step, (node, i_input, i_data) in enumerate(self._execution_plan):
+            input = images[i_input] if i_input >= 0 else frames
+            if i_data >= 0:
+                node_messages, data_columns[i_data] = node.process_batch(input)
+            else:
+                node_messages, images[i_step] = node.process_batch(input)
+            messages.extend(node_messages)
+
+        self._compile_outputs()
+        for node in self._data_nodes:
+            node.acknowledge_changes()
+
+        output = np.empty(
+            len(frames),
+            dtype=[(field, np.float64) for field in self._output_type._fields],
+        )
+        flat_output = output.view(np.float64).reshape(len(frames), -1)
+        for sl, columns in zip(self._output_slices, data_columns):
+            flat_output[:, sl] = columns
+        return NodeOutput(messages, output)
+
+    def run(self, input, frame_time=None):
+        """ Runs the pipeline on a frame
+
+        Parameters
+        ----------
+        input :
+            the frame
+        frame_time : datetime or float, optional
+            the time the frame was acquired at, datetimes are converted to
+            seconds. It is given to the stateful nodes, so that they
+            can account for the actual interval between frames
+
+        Returns
+        -------
+        NodeOutput with the messages and the output of the data nodes
+
+        """
+        if self._execution_plan is None:
+            self.compile()
+
+        if frame_time is not None and hasattr(frame_time, "timestamp"):
+            frame_time = frame_time.timestamp()
+        for node in self._stateful_nodes:
+            node.frame_time = frame_time
+
+        shape = getattr(input, "shape", None)
+        if self._crops is None or shape != self._crop_shape:
+            self._compute_crops(shape)
+
+        n_steps = len(self._execution_plan)
+        # outputs of the image processing steps and messages, indexed by step
+        images = [None] * n_steps
+        messages = [None] * n_steps
+        data_outputs = [None] * len(self._data_nodes)
+        step_args = (input, images, messages, data_outputs)
+
+        if self._executor is None:
+            self._run_steps(0, n_steps, *step_args)
+        else:
+            # the root is run first, then each branch in a separate thread
+            self._run_steps(0, 1, *step_args)
+            for future in [
+                self._executor.submit(self._run_steps, start, stop, *step_args)
+                for start, stop in self._branches
+            ]:
+                future.result()
+
+        messages = list(chain.from_iterable(messages))
+
+        if self._output_slices is None or any(
+            node.output_type_changed for node in self._data_nodes
+        ):
+            self._compile_outputs()
+            for node in self._data_nodes:
+                node.acknowledge_changes()
+
+        if self.record_output:
+            # nodes which wrote in place already filled their part of the record
+            for node, sl, data in zip(
+                self._data_nodes, self._output_slices, data_outputs
+            ):
+                if data is not node._output_buffer:
+                    node._output_buffer[:] = data
+            return NodeOutput(messages, self._record)
+
+        values = [None] * len(self._output_type._fields)
+        for sl, data in zip(self._output_slices, data_outputs):
+            values[sl] = data
+
+        return NodeOutput(messages, self._output_type(*values))
@@ -6,7 +6,7 @@
 import cv2
 
 import numpy as np
-from numba import vectorize, uint8, float32
+from numba import jit, vectorize, uint8, float32
 from lightparam import Param
 from stytra.tracking.pipelines import ImageToImageNode, NodeOutput
 
@@ -16,6 +16,14 @@ class Prefilter(ImageToImageNode):
         super().__init__(*args, name="filtering", **kwargs)
         self.diagnostic_image_options = ["filtered"]
 
+    @property
+    def output_scale(self):
+        return self._params.image_scale
+
+    @property
+    def roi_margin(self):
+        return self._params.filter_size
+
     def _process(
         self,
         im,
@@ -25,7 +33,11 @@ class Prefilter(ImageToImageNode):
         clip: Param(140, (0, 255)),
         **extraparams
     ):
-        """ Optionally resizes, smooths and inverts the image
+        """ Optionally resizes, smooths, inverts and clips the image.
+        For 8-bit images, this is done in a single pass by _prefilter, if the
+        image is downscaled by an integer factor (otherwise it is resized
+        first). The results are the same as with the separate OpenCV
+        operations.
 
         :param im:
         :param state:
@@ -34,24 +46,215 @@ class Prefilter(ImageToImageNode):
         :param color_invert:
         :return:
         """
+        if image_scale == 1 and filter_size <= 1 and not color_invert and clip == 0:
+            pass
+        elif im.dtype == np.uint8 and im.ndim == 2:
+            im = self._filter(
+                im,
+                self._buffer("filtered", self.output_shape(im.shape), im.dtype),
+                image_scale,
+                filter_size,
+                color_invert,
+                clip,
+            )
+        else:
+            im = self._filter_separately(
+                im, image_scale, filter_size, color_invert, clip
+            )
+
+        if self.set_diagnostic == "filtered":
+            self.diagnostic_image = im
+
+        return NodeOutput([], im)
+
+    def _filter(self, im, out, image_scale, filter_size, color_invert, clip):
+        """ Filters an 8-bit image into out, in one pass if possible """
+        factor = int(round(1 / image_scale))
+        if factor * image_scale != 1 or (
+            (im.shape[0] % factor, im.shape[1] % factor) != (0, 0)
+        ):
+            # non-integer downscaling is done by OpenCV
+            im = cv2.resize(
+                im,
+                None,
+                dst=self._buffer("resized", out.shape, im.dtype),
+                fx=image_scale,
+                fy=image_scale,
+                interpolation=cv2.INTER_AREA,
+            )
+            factor = 1
+        return _prefilter(im, factor, max(filter_size, 1), color_invert, clip, out)
+
+    def _filter_separately(self, im, image_scale, filter_size, color_invert, clip):
+        """ Filters images which are not 8-bit grayscale, with a pass
+        for each operation
+        """
         if image_scale != 1:
             im = cv2.resize(
-                im, None, fx=image_scale, fy=image_scale, interpolation=cv2.INTER_AREA
+                im,
+                None,
+                dst=self._buffer("resized", self.output_shape(im.shape), im.dtype),
+                fx=image_scale,
+                fy=image_scale,
+                interpolation=cv2.INTER_AREA,
             )
         if filter_size > 0:
-            im = cv2.boxFilter(im, -1, (filter_size, filter_size))
+            im = cv2.boxFilter(
+                im,
+                -1,
+                (filter_size, filter_size),
+                dst=self._buffer("box_filtered", im.shape, im.dtype),
+            )
         if color_invert:
-            im = 255 - im
+            im = np.subtract(255, im, out=self._buffer("inverted", im.shape, im.dtype))
         if clip > 0:
-            im = np.maximum(im, clip) - clip
+            # the input frame is not modified, the buffers are
+            if image_scale == 1 and filter_size == 0 and not color_invert:
+                clipped = self._buffer("clipped", im.shape, im.dtype)
+            else:
+                clipped = im
+            im = np.maximum(im, clip, out=clipped)
+            im -= clip
+        return im
+
+    def _process_batch(
+        self, ims, image_scale, filter_size, color_invert, clip, **extraparams
+    ):
+        """ Batched version of the prefiltering, the frames are
+        filtered one by one into a preallocated stack
+
+        """
+        if image_scale == 1 and filter_size <= 1 and not color_invert and clip == 0:
+            filtered = ims.copy()
+        elif ims.dtype == np.uint8 and ims.ndim == 3:
+            filtered = np.empty(
+                (len(ims),) + self.output_shape(ims.shape[1:]), dtype=ims.dtype
+            )
+            for im, out in zip(ims, filtered):
+                self._filter(im, out, image_scale, filter_size, color_invert, clip)
+        else:
+            filtered = np.stack(
+                [
+                    self._filter_separately(
+                        im, image_scale, filter_size, color_invert, clip
+                    )
+                    for im in ims
+                ]
+            )
 
         if self.set_diagnostic == "filtered":
-            self.diagnostic_image = im
+            self.diagnostic_image = filtered[-1]
 
-        return NodeOutput([], im)
+        return NodeOutput([], filtered)
+
+
+@jit(nopython=True, nogil=True)
+def _reflect_index(i, n):
+    """ The index i reflected inside range(n), without repeating the
+    edges, as the default border of OpenCV filters
+    """
+    if n == 1:
+        return 0
+    while i < 0 or i >= n:
+        if i < 0:
+            i = -i
+        else:
+            i = 2 * n - 2 - i
+    return i
+
+
+@jit(nopython=True, nogil=True)
+def _downsample_row(im, i_row, factor, row):
+    """ Computes a row of the image downscaled by an integer factor, by
+    averaging factor x factor blocks (as cv2.INTER_AREA), into row
+    """
+    area = factor * factor
+    if factor == 2:
+        s0 = im[2 * i_row]
+        s1 = im[2 * i_row + 1]
+        for x in range(row.shape[0]):
+            row[x] = (
+                np.int32(s0[2 * x]) + s0[2 * x + 1] + s1[2 * x] + s1[2 * x + 1] + 2
+            ) >> 2
+        return
+    row[:] = 0
+    for a in range(factor):
+        src = im[i_row * factor + a]
+        for b in range(factor):
+            for x in range(row.shape[0]):
+                row[x] += src[x * factor + b]
+    for x in range(row.shape[0]):
+        row[x] = (row[x] + area // 2) // area
+
+
+@jit(nopython=True, nogil=True)
+def _add_row(total, row, first):
+    if first:
+        for x in range(total.shape[0]):
+            total[x] = row[x]
+    else:
+        for x in range(total.shape[0]):
+            total[x] += row[x]
+
+
+@jit(nopython=True, nogil=True)
+def _prefilter(im, factor, filter_size, color_invert, clip, out):
+    """ Downscales the image by an integer factor, smooths it with a box
+    filter of filter_size (as cv2.boxFilter), inverts and clips it,
+    writing the result into out, in a single pass over the image.
+
+    Each output row is computed from the column sums of the filter_size
+    downscaled rows around it, which are kept in a small ring buffer,
+    so that each input row is read once.
+
+    """
+    h, w = out.shape
+    anchor = filter_size // 2
+    n_box = filter_size * filter_size
+    # exact division of the box sums, as a multiplication and a shift
+    div_mult = np.int64((2 ** 32 + n_box - 1) // n_box)
+    # the averages are rounded half up, except for power of two box sizes,
+    # for which OpenCV also rounds up the sums one below the half
+    rounding = n_box // 2
+    if n_box > 1 and n_box & (n_box - 1) == 0:
+        rounding += 1
+
+    rows = np.empty((filter_size, w), np.int32)
+    row_indices = np.full(filter_size, -1)
+    # the column sums with the reflected borders around them
+    padded = np.empty(w + filter_size - 1, np.int32)
+    col_sums = padded[anchor : anchor + w]
+    box_sums = np.empty(w, np.int32)
+    for y in range(h):
+        for j in range(filter_size):
+            i_row = _reflect_index(y - anchor + j, h)
+            if factor == 1:
+                _add_row(col_sums, im[i_row], j == 0)
+            else:
+                slot = i_row % filter_size
+                if row_indices[slot] != i_row:
+                    _downsample_row(im, i_row, factor, rows[slot])
+                    row_indices[slot] = i_row
+                _add_row(col_sums, rows[slot], j == 0)
+        for i in range(anchor):
+            padded[i] = col_sums[_reflect_index(i - anchor, w)]
+        for i in range(anchor + w, w + filter_size - 1):
+            padded[i] = col_sums[_reflect_index(i - anchor, w)]
+
+        _add_row(box_sums, padded[:w], True)
+        for j in range(1, filter_size):
+            _add_row(box_sums, padded[j : j + w], False)
+
+        dst = out[y]
+        for x in range(w):
+            value = np.int32(((box_sums[x] + rounding) * div_mult) >> 32)
+            if color_invert:
+                value = 255 - value
+            dst[x] = max(value, clip) - clip
+    return out
 
 
-@vectorize([uint8(float32, uint8)])
+@vectorize([uint8(float32, uint8), uint8(uint8, uint8)])
 def negdif(xf, y):
     """
 
@@ -73,7 +276,7 @@ def negdif(xf, y):
         return 0
 
 
-@vectorize([uint8(float32, uint8)])
+@vectorize([uint8(float32, uint8), uint8(uint8, uint8)])
 def absdif(xf, y):
     """
 
@@ -96,6 +299,25 @@ def absdif(xf, y):
 
 
 class BackgroundSubtractor(ImageToImageNode):
+    """ Subtracts a background model from the frames. Two models are
+    available:
+
+    - mean: an exponential moving average of the frames, in float32,
+      updated with learning_rate once every learn_every frames
+    - median: an approximate running median, in uint8, where each pixel of
+      the background moves by one grey level towards the frame every
+      median_subsample frames. The background is updated a few rows at a
+      time, one every median_subsample rows on each frame, so the cost
+      is spread over the frames. It takes 1 byte per pixel, and the cost
+      of an update is one comparison for 1/median_subsample of the pixels.
+      Unlike the mean, it is not pulled towards fish which are
+      still for less than half of the time, and does not keep ghosts of the
+      moving ones
+
+    """
+
+    stateful = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="bgsub", **kwargs)
         self.background_image = None
@@ -103,6 +325,11 @@ class BackgroundSubtractor(ImageToImageNode):
 
     def reset(self):
         self.background_image = None
+        self.i = 0
+
+    def changed(self, vals):
+        if "model" in vals.keys():
+            self.reset()
 
     def _process(
         self,
@@ -110,19 +337,88 @@ class BackgroundSubtractor(ImageToImageNode):
         learning_rate: Param(0.04, (0.0, 1.0)),
         learn_every: Param(400, (1, 10000)),
         only_darker: Param(True),
+        model: Param("mean", ["mean", "median"]),
+        median_subsample: Param(
+            4,
+            (1, 256),
+            desc="For the median model, the number of frames over which "
+            "the whole background is updated",
+        ),
     ):
         messages = []
         if self.background_image is None:
-            self.background_image = im.astype(np.float32)
+            self.background_image = self._new_background(im, model)
             messages.append("I:New backgorund image set")
+        elif model == "median":
+            _update_median(self.background_image, im, self.i, median_subsample)
         elif self.i == 0:
-            self.background_image[:, :] = im.astype(np.float32) * np.float32(
-                learning_rate
-            ) + self.background_image * np.float32(1 - learning_rate)
+            cv2.accumulateWeighted(im, self.background_image, learning_rate)
 
-        self.i = (self.i + 1) % learn_every
+        self.i = (self.i + 1) % (median_subsample if model == "median" else learn_every)
 
-        if only_darker:
-            return NodeOutput(messages, negdif(self.background_image, im))
-        else:
-            return NodeOutput(messages, absdif(self.background_image, im))
+        difference = negdif if only_darker else absdif
+        return NodeOutput(
+            messages,
+            difference(
+                self.background_image,
+                im,
+                out=self._buffer("subtracted", im.shape, np.uint8),
+            ),
+        )
+
+    def _new_background(self, im, model):
+        if model == "median":
+            return im.astype(np.uint8)
+        return im.astype(np.float32)
+
+    def _process_batch(
+        self, ims, learning_rate, learn_every, only_darker, model, median_subsample
+    ):
+        """ Batched background subtraction: the stack is split in chunks
+        between background updates, and each chunk is subtracted from
+        the background at once. The median background is updated on
+        every frame, so it is subtracted frame by frame
+
+        """
+        messages = []
+        difference = negdif if only_darker else absdif
+        subtracted = np.empty(ims.shape, dtype=np.uint8)
+        if model == "median":
+            for im, out in zip(ims, subtracted):
+                if self.background_image is None:
+                    self.background_image = self._new_background(im, model)
+                    messages.append("I:New backgorund image set")
+                else:
+                    _update_median(self.background_image, im, self.i, median_subsample)
+                self.i = (self.i + 1) % median_subsample
+                difference(self.background_image, im, out=out)
+            return NodeOutput(messages, subtracted)
+
+        start = 0
+        while start < len(ims):
+            if self.background_image is None:
+                self.background_image = self._new_background(ims[start], model)
+                messages.append("I:New backgorund image set")
+            elif self.i == 0:
+                cv2.accumulateWeighted(ims[start], self.background_image, learning_rate)
+            stop = min(len(ims), start + learn_every - self.i)
+            difference(
+                self.background_image, ims[start:stop], out=subtracted[start:stop]
+            )
+            self.i = (self.i + stop - start) % learn_every
+            start = stop
+
+        return NodeOutput(messages, subtracted)
+
+
+@jit(nopython=True)
+def _update_median(background, im, start, step):
+    """ Moves the rows start, start + step, ... of the approximate
+    median background by one grey level towards the image, in place
+    """
+    for i in range(start, background.shape[0], step):
+        for j in range(background.shape[1]):
+            if im[i, j] > background[i, j]:
+                background[i, j] += 1
+            elif im[i, j] < background[i, j]:
+                background[i, j] -= 1
@@ -3,24 +3,87 @@ import numpy as np
 
 
 @jit(nopython=True)
-def predict_inplace(x, P, F, Q):
-    x[0] = x[0] + x[1]
-    P[:, :] = np.dot(np.dot(F, P), F.T) + Q
+def white_noise_acceleration(dt, q):
+    """ Process noise covariance of a constant velocity model over a time
+    step dt, for an acceleration with variance q
+    """
+    return (
+        np.array([[0.25 * dt ** 4, 0.5 * dt ** 3], [0.5 * dt ** 3, dt ** 2]]) * q
+    )
 
 
 @jit(nopython=True)
-def update_inplace(z, x, P, R):
-    # error (residual) between measurement and prediction
-    y = z - x[0]
+def predict_stacked(states, Ps, active, dt, Q):
+    """ Predicts, in place, the states of a stack of independent constant
+    velocity filters after a time step dt
 
-    # project system uncertainty into measurement space
-    S = P[0, 0] + R
-    K = P[:, 0] / S
+    Parameters
+    ----------
+    states : (n, 2*k) array
+        of the k (value, velocity) pairs of each of the n rows
+    Ps : (n, k, 2, 2) array
+        of the state covariances
+    active : (n,) boolean array
+        rows to predict, the others are left unchanged
+    dt : float
+        time step
+    Q : (k, 2, 2) array
+        process noise covariance of each of the k filters
 
-    x[:] = x + K * y
+    """
+    for i in range(states.shape[0]):
+        if not active[i]:
+            continue
+        for j in range(Ps.shape[1]):
+            states[i, 2 * j] += dt * states[i, 2 * j + 1]
+            # P = F P F^T + Q with F = [[1, dt], [0, 1]]
+            p00, p01 = Ps[i, j, 0, 0], Ps[i, j, 0, 1]
+            p10, p11 = Ps[i, j, 1, 0], Ps[i, j, 1, 1]
+            Ps[i, j, 0, 0] = p00 + dt * (p01 + p10) + dt * dt * p11 + Q[j, 0, 0]
+            Ps[i, j, 0, 1] = p01 + dt * p11 + Q[j, 0, 1]
+            Ps[i, j, 1, 0] = p10 + dt * p11 + Q[j, 1, 0]
+            Ps[i, j, 1, 1] = p11 + Q[j, 1, 1]
 
-    I_KH = np.eye(2)
-    I_KH[0, 0] -= K[0]
-    I_KH[1, 0] = -K[1]
 
-    P[:, :] = ((I_KH @ P) @ I_KH.T) + R * (K @ K.T)
+@jit(nopython=True)
+def update_stacked(measurements, rows, states, Ps, R):
+    """ Updates, in place, some rows of a stack of constant velocity filters
+    with measurements of the values (not of the velocities)
+
+    Parameters
+    ----------
+    measurements : (m, k) array
+        measured values for each of the updated rows
+    rows : (m,) integer array
+        which rows of the stack are updated
+    states : (n, 2*k) array
+        of the k (value, velocity) pairs of each of the n rows
+    Ps : (n, k, 2, 2) array
+        of the state covariances
+    R : (k,) array
+        measurement noise variance of each of the k filters
+
+    """
+    for i_meas in range(len(rows)):
+        i = rows[i_meas]
+        for j in range(Ps.shape[1]):
+            # residual, its variance, and the Kalman gain
+            y = measurements[i_meas, j] - states[i, 2 * j]
+            S = Ps[i, j, 0, 0] + R[j]
+            k0 = Ps[i, j, 0, 0] / S
+            k1 = Ps[i, j, 1, 0] / S
+            states[i, 2 * j] += k0 * y
+            states[i, 2 * j + 1] += k1 * y
+
+            # Joseph form of the covariance update,
+            # P = (I - KH) P (I - KH)^T + R K K^T with H = [1, 0]
+            p00, p01 = Ps[i, j, 0, 0], Ps[i, j, 0, 1]
+            p10, p11 = Ps[i, j, 1, 0], Ps[i, j, 1, 1]
+            a00 = (1 - k0) * p00
+            a01 = (1 - k0) * p01
+            a10 = p10 - k1 * p00
+            a11 = p11 - k1 * p01
+            Ps[i, j, 0, 0] = a00 * (1 - k0) + R[j] * k0 * k0
+            Ps[i, j, 0, 1] = a01 - a00 * k1 + R[j] * k0 * k1
+            Ps[i, j, 1, 0] = a10 * (1 - k0) + R[j] * k1 * k0
+            Ps[i, j, 1, 1] = a11 - a10 * k1 + R[j] * k1 * k1
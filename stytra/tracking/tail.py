@@ -1,6 +1,6 @@
 import numpy as np
-from numba import jit
-from lightparam import Param, Parametrized
+from numba import jit, prange
+from lightparam import Param
 from scipy.ndimage.filters import gaussian_filter1d
 from stytra.utilities import reduce_to_pi
 from stytra.tracking.pipelines import ImageToDataNode, NodeOutput
@@ -10,11 +10,18 @@ from collections import namedtuple
 class TailTrackingMethod(ImageToDataNode):
     """General tail tracking method."""
 
+    stateless_params = dict(time_filter_weight=0.0, reset_zero=False)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, name="tail_tracking", **kwargs)
         self.monitored_headers = ["tail_sum"]
         self.data_log_name = "tail_track"
         self._output_type = None
+        self.resting_angles = None
+        self.previous_angles = None
+        # the segments where the tracing stopped on min_confidence
+        # in the last frame, to report only the changes
+        self.confidence_stops = None
 
     def changed(self, vals):
         if "n_output_segments" in vals.keys():
@@ -24,18 +31,183 @@ class TailTrackingMethod(ImageToDataNode):
         self._output_type = namedtuple(
             "t",
             ["tail_sum"]
-            + ["theta_{:02}".format(i) for i in range(self._params.n_output_segments)],
+            + ["theta_{:02}".format(i) for i in range(self._params.n_output_segments)]
+            + ["tail_confidence"],
         )
         self._output_type_changed = True
 
+    def _tail_roi(self, shape, margin):
+        """ The tail is traced within the tail length (plus a margin)
+        from its starting point, whichever way it bends
+
+        """
+        start_y, start_x = self._params.tail_start
+        tail_length_y, tail_length_x = self._params.tail_length
+        scale = shape[0]
+        radius = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale + margin
+        return (
+            start_y * scale - radius,
+            start_y * scale + radius,
+            start_x * scale - radius,
+            start_x * scale + radius,
+        )
+
+    def _stop_messages(self, intensities, i_missing, labels=("",)):
+        """ Reports the segments where the tracing stopped. A tail which is lost
+        (outside of the image or on an empty window) gives a warning, while
+        a stop on min_confidence is intended and only gives an information
+        when the stopping segment changes, not on every frame.
+
+        Parameters
+        ----------
+        intensities :
+            the intensities along the traced tails, one tail per row
+        i_missing :
+            the first segment not found of each tail, 0 if all were
+        labels :
+            the prefix of the messages about each tail
+
+        Returns
+        -------
+        list of messages
+
+        """
+        intensities = np.atleast_2d(intensities)
+        i_missing = np.atleast_1d(i_missing)
+        stopped = i_missing > 0
+        stop_intensities = intensities[np.arange(len(i_missing)), i_missing - 1]
+        # a lost tail has no (or zero) intensity on the segment not found
+        lost = stopped & ~(stop_intensities > 0)
+        confidence_stops = np.where(stopped & ~lost, i_missing, 0)
+
+        previous = self.confidence_stops
+        if previous is None or previous.shape != confidence_stops.shape:
+            previous = np.zeros_like(confidence_stops)
+        self.confidence_stops = confidence_stops
+
+        messages = []
+        for label, i_segment, is_lost, previous_stop in zip(
+            labels, i_missing, lost, previous
+        ):
+            if is_lost:
+                messages.append("W:{}segment {} not detected".format(label, i_segment))
+            elif i_segment > 0 and i_segment != previous_stop:
+                messages.append(
+                    "I:{}tracing stopped at segment {} below min_confidence".format(
+                        label, i_segment
+                    )
+                )
+        return messages
+
+    def _output_angles(
+        self,
+        messages,
+        angles,
+        intensities,
+        tail_filter_width,
+        time_filter_weight,
+        n_output_segments,
+        reset_zero,
+    ):
+        """ Smooths the absolute angles of the traced segments, interpolates
+        them to the number of output segments, and applies the resting angle
+        correction and the temporal filtering. The angles can also be
+        a 2D array with the angles of several tails in the rows.
+
+        The confidence of the tracking is the lowest intensity found along
+        the tail, relative to the one of the first segment.
+
+        Returns
+        -------
+        NodeOutput with the tail sum, the output angles and the
+        confidence (for each tail)
+
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            confidence = np.nan_to_num(
+                np.fmin.reduce(intensities, axis=-1) / intensities[..., 0], nan=0.0
+            )
+
+        # we want angles to be continuous, this removes potential 2pi discontinuities
+        angles = np.unwrap(angles)
+
+        # we do not need to record a large amount of angles
+        if tail_filter_width > 0:
+            angles = gaussian_filter1d(angles, tail_filter_width, mode="nearest")
+
+        # Interpolate to the desired number of output segments
+        segment_positions = np.linspace(0, 1, angles.shape[-1])
+        angles = np.array(
+            [
+                np.interp(np.linspace(0, 1, n_output_segments), segment_positions, a)
+                for a in angles.reshape(-1, angles.shape[-1])
+            ]
+        ).reshape(angles.shape[:-1] + (n_output_segments,))
+
+        if reset_zero:
+            if self.resting_angles is None or self.resting_angles.shape != angles.shape:
+                self.resting_angles = angles
+            else:
+                self.resting_angles = self.resting_angles * 0.5 + angles * 0.5
+        else:
+            if (
+                self.resting_angles is not None
+                and self.resting_angles.shape == angles.shape
+            ):
+                angles = angles - self.resting_angles + self.resting_angles[..., :1]
+
+        if (
+            time_filter_weight > 0
+            and self.previous_angles is not None
+            and self.previous_angles.shape == angles.shape
+        ):
+            angles = (
+                time_filter_weight * self.previous_angles
+                + (1 - time_filter_weight) * angles
+            )
+
+        self.previous_angles = angles
+
+        if self._output_type is None:
+            self.reset()
+
+        # Total curvature as sum of the last 2 angles - sum of the first 2
+        tail_sum = angles[..., -1] + angles[..., -2] - angles[..., 0] - angles[..., 1]
+        return NodeOutput(
+            messages,
+            self._output(
+                *np.concatenate(
+                    [
+                        np.asarray(tail_sum)[..., None],
+                        angles,
+                        np.asarray(confidence)[..., None],
+                    ],
+                    axis=-1,
+                ).ravel()
+            ),
+        )
+
 
 class CentroidTrackingMethod(TailTrackingMethod):
     """Center-of-mass method to find consecutive segments."""
 
+    stateless_params = dict(TailTrackingMethod.stateless_params, warm_start=False)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.resting_angles = None
-        self.previous_angles = None
+        # the angles of the traced segments and the mean intensity
+        # around them in the last frame, for the warm start
+        self.warm_angles = None
+        self.warm_intensities = None
+
+    def changed(self, vals):
+        super().changed(vals)
+        if {"tail_start", "tail_length", "n_segments", "warm_start"} & vals.keys():
+            self.warm_angles = None
+            self.warm_intensities = None
+
+    def roi(self, shape):
+        return self._tail_roi(shape, self._params.window_size)
 
     def _process(
         self,
@@ -48,10 +220,16 @@ class CentroidTrackingMethod(TailTrackingMethod):
         n_output_segments: Param(9, (1, 30)),
         reset_zero: Param(False),
         window_size: Param(7, (1, 15)),
+        min_confidence: Param(0.0, (0.0, 1.0)),
+        warm_start: Param(False),
+        warm_window_size: Param(7, (1, 15)),
+        warm_min_confidence: Param(0.5, (0.0, 1.0)),
         **extraparams
     ):
         """Finds the tail for an embedded fish, given the starting point and
         the direction of the tail. Alternative to the sequential circular arches.
+        With warm_start, each segment is first searched for in the direction
+        expected from the previous frame, with the smaller warm_window_size.
 
         Parameters
         ----------
@@ -65,6 +243,17 @@ class CentroidTrackingMethod(TailTrackingMethod):
             number of desired segments (Default value = 12)
         window_size :
             window size in pixel for center-of-mass calculation (Default value = 7)
+        min_confidence :
+            the tracing stops if the mean intensity in the window falls
+            below this fraction of the one of the first segment
+        warm_start :
+            if True, start the search of each segment from the previous frame
+        warm_window_size :
+            window size in pixel for the search from the previous position
+        warm_min_confidence :
+            the search from the previous position is discarded if the mean
+            intensity in the window falls below this fraction of the
+            one in the previous frame
         color_invert :
             True for inverting luminosity of the image (Default value = False)
         filter_size :
@@ -79,14 +268,16 @@ class CentroidTrackingMethod(TailTrackingMethod):
         Returns
         -------
         type
-            list of cumulative sum + list of angles
+            list of cumulative sum + list of angles + confidence
 
         """
         messages = []
         start_y, start_x = tail_start
         tail_length_y, tail_length_x = tail_length
 
-        scale = im.shape[0]
+        # the image might be cropped around the tail by the pipeline
+        scale = (self.input_shape or im.shape)[0]
+        offset_y, offset_x = self.input_offset
 
         # Calculate tail length:
         length_tail = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale
@@ -100,62 +291,215 @@ class CentroidTrackingMethod(TailTrackingMethod):
         disp_x = tail_length_x * scale / n_segments
         disp_y = tail_length_y * scale / n_segments
 
-        angles = np.full(n_segments - 1, np.nan)
-        start_x *= scale
-        start_y *= scale
-
-        halfwin = window_size / 2
-        for i in range(1, n_segments):
-            # Use next segment function for find next point
-            # with center-of-mass displacement:
-            start_x, start_y, disp_x, disp_y, acc = _next_segment(
-                im, start_x, start_y, disp_x, disp_y, halfwin, seg_length
+        start_x = start_x * scale - offset_x
+        start_y = start_y * scale - offset_y
+
+        if warm_start:
+            if self.warm_angles is None or len(self.warm_angles) != n_segments - 1:
+                self.warm_angles = np.full(n_segments - 1, np.nan)
+                self.warm_intensities = np.full(n_segments - 1, np.nan)
+            angles, self.warm_intensities, i_missing = _trace_tail_centroid_warm(
+                im,
+                start_x,
+                start_y,
+                disp_x,
+                disp_y,
+                window_size / 2,
+                warm_window_size / 2,
+                seg_length,
+                n_segments,
+                self.warm_angles,
+                self.warm_intensities,
+                warm_min_confidence,
+                min_confidence,
+            )
+            self.warm_angles = angles
+            intensities = self.warm_intensities
+        else:
+            angles, intensities, i_missing = _trace_tail_centroid(
+                im,
+                start_x,
+                start_y,
+                disp_x,
+                disp_y,
+                window_size / 2,
+                seg_length,
+                n_segments,
+                min_confidence,
             )
-            if start_x < 0:
-                messages.append("W:segment {} not detected".format(i))
-                break
+        messages.extend(self._stop_messages(intensities, i_missing))
 
-            abs_angle = np.arctan2(disp_x, disp_y)
-            angles[i - 1] = abs_angle
+        return self._output_angles(
+            messages,
+            angles,
+            intensities,
+            tail_filter_width,
+            time_filter_weight,
+            n_output_segments,
+            reset_zero,
+        )
 
-        # we want angles to be continuous, this removes potential 2pi discontinuities
-        angles = np.unwrap(angles)
 
-        # we do not need to record a large amount of angles
-        if tail_filter_width > 0:
-            angles = gaussian_filter1d(angles, tail_filter_width, mode="nearest")
+class MultiTailTrackingMethod(TailTrackingMethod):
+    """Center-of-mass method to find consecutive segments, for several
+    embedded fish in the same image. The tails are traced in parallel.
+    """
 
-        angles = np.interp(
-            np.linspace(0, 1, n_output_segments),
-            np.linspace(0, 1, n_segments - 1),
-            angles,
+    # the tail placed if none is defined in the parameters
+    default_tail = ((0.25, 1.0), (0.0, -0.6))
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_log_name = "multi_tail_track"
+
+    def changed(self, vals):
+        if "n_output_segments" in vals.keys() or "n_tails" in vals.keys():
+            self.reset()
+
+    def reset(self):
+        self._output_type = namedtuple(
+            "t",
+            [
+                name
+                for i_tail in range(self._params.n_tails)
+                for name in ["a{}_tail_sum".format(i_tail)]
+                + [
+                    "a{}_theta_{:02}".format(i_tail, i)
+                    for i in range(self._params.n_output_segments)
+                ]
+                + ["a{}_tail_confidence".format(i_tail)]
+            ],
         )
-        # Interpolate to the desired number of output segments
+        self.monitored_headers = [
+            "a{}_tail_sum".format(i_tail) for i_tail in range(self._params.n_tails)
+        ]
+        self._output_type_changed = True
 
-        if reset_zero:
-            if self.resting_angles is None or len(self.resting_angles) != len(angles):
-                self.resting_angles = angles
-            else:
-                self.resting_angles = self.resting_angles * 0.5 + angles * 0.5
-        else:
-            if self.resting_angles is not None:
-                angles = angles - self.resting_angles + self.resting_angles[0]
+    def tails(self):
+        """ The starting points and lengths of the n_tails tails. If less
+        tails than n_tails are defined in the parameters, the missing ones are
+        placed next to the last one, or at the default position if there are
+        none
 
-        if time_filter_weight > 0 and self.previous_angles is not None:
-            angles = (
-                time_filter_weight * self.previous_angles
-                + (1 - time_filter_weight) * angles
+        Returns
+        -------
+        list of (tail_start, tail_length) tuples, as (y, x) relative to the
+        image height
+
+        """
+        tails = [
+            (tuple(start), tuple(length))
+            for start, length in zip(
+                self._params.tail_starts, self._params.tail_lengths
+            )
+        ][: self._params.n_tails]
+        if len(tails) == 0:
+            tails.append(self.default_tail)
+        while len(tails) < self._params.n_tails:
+            (start_y, start_x), (length_y, length_x) = tails[-1]
+            # shifted perpendicularly to the tail, by a fifth of its length
+            tails.append(
+                (
+                    (start_y + length_x * 0.2, start_x - length_y * 0.2),
+                    (length_y, length_x),
+                )
             )
+        return tails
+
+    def roi(self, shape):
+        scale = shape[0]
+        y_start, y_stop, x_start, x_stop = np.inf, -np.inf, np.inf, -np.inf
+        for (start_y, start_x), (length_y, length_x) in self.tails():
+            radius = (
+                np.sqrt(length_x ** 2 + length_y ** 2) * scale
+                + self._params.window_size
+            )
+            y_start = min(y_start, start_y * scale - radius)
+            y_stop = max(y_stop, start_y * scale + radius)
+            x_start = min(x_start, start_x * scale - radius)
+            x_stop = max(x_stop, start_x * scale + radius)
+        return y_start, y_stop, x_start, x_stop
 
-        self.previous_angles = angles
+    def _process(
+        self,
+        im,
+        n_tails: Param(2, (1, 16)),
+        tail_starts: Param([(0.25, 1.0), (0.75, 1.0)], gui=False),
+        tail_lengths: Param([(0.0, -0.6), (0.0, -0.6)], gui=False),
+        n_segments: Param(12, (1, 50)),
+        tail_filter_width: Param(0.0, (0.0, 10.0)),
+        time_filter_weight: Param(0.0, (0.0, 1.0)),
+        n_output_segments: Param(9, (1, 30)),
+        reset_zero: Param(False),
+        window_size: Param(7, (1, 15)),
+        min_confidence: Param(0.0, (0.0, 1.0)),
+        **extraparams
+    ):
+        """Finds the tails of several embedded fish, given the starting
+        points and the directions of the tails, as CentroidTrackingMethod.
 
-        if self._output_type is None:
-            self.reset()
+        Parameters
+        ----------
+        im :
+            image to process
+        n_tails :
+            number of tails
+        tail_starts :
+            starting points (y, x) of the tails, relative to the image height
+        tail_lengths :
+            tail lengths (y, x), relative to the image height
+        n_segments :
+            number of segments of each tail (Default value = 12)
+        window_size :
+            window size in pixel for center-of-mass calculation (Default value = 7)
+        min_confidence :
+            the tracing of a tail stops if the mean intensity in the window
+            falls below this fraction of the one of its first segment
 
-        # Total curvature as sum of the last 2 angles - sum of the first 2
-        return NodeOutput(
+        Returns
+        -------
+        NodeOutput with the tail sum, the angles and the confidence of each tail
+
+        """
+        messages = []
+        tails = np.array(self.tails(), dtype=np.float64)
+        starts, lengths = tails[:, 0, :], tails[:, 1, :]
+
+        # the image might be cropped around the tails by the pipeline
+        scale = (self.input_shape or im.shape)[0]
+
+        n_segments += 1
+        disps = lengths * scale / n_segments
+        seg_lengths = np.sqrt(np.sum(lengths ** 2, 1)) * scale / (n_segments - 1)
+        starts = starts * scale - np.array(self.input_offset)
+
+        angles, intensities, i_missing = _trace_tails_centroid(
+            im,
+            starts[:, 1],
+            starts[:, 0],
+            disps[:, 1],
+            disps[:, 0],
+            window_size / 2,
+            seg_lengths,
+            n_segments,
+            min_confidence,
+        )
+        messages.extend(
+            self._stop_messages(
+                intensities,
+                i_missing,
+                ["fish {} ".format(i_tail) for i_tail in range(len(i_missing))],
+            )
+        )
+
+        return self._output_angles(
             messages,
-            self._output_type(angles[-1] + angles[-2] - angles[0] - angles[1], *angles),
+            angles,
+            intensities,
+            tail_filter_width,
+            time_filter_weight,
+            n_output_segments,
+            reset_zero,
         )
 
 
@@ -202,77 +546,89 @@ def find_fish_midline(im, xm, ym, angle, r=9, m=3, n_points=20):
 
 
 class AnglesTrackingMethod(TailTrackingMethod):
-    """Angular sweep method to find consecutive segments."""
-
-    def __init__(self):
-        super().__init__()
-        # self.add_params(dark_tail=False)
-        self.params = Parametrized(name="tracking/tail_angles", params=self.detect)
-        self.accumulator_headers = ["tail_sum"] + [
-            "theta_{:02}".format(i) for i in range(self.params.n_segments)
-        ]
+    """Angular sweep method to find consecutive segments: each segment
+    points to the brightest point on an arc in front of the previous one."""
+
+    def roi(self, shape):
+        # the arcs are sampled with bilinear interpolation
+        return self._tail_roi(shape, 2)
 
-    def detect(
+    def _process(
         self,
         im,
-        tail_start: Param((0, 0), gui=False),
-        n_segments: Param(7),
-        tail_length: Param((1, 1), gui=False),
+        tail_start: Param((0.47, 1.7), gui=False),
+        tail_length: Param((0.07, -1.36), gui=False),
+        n_segments: Param(7, (1, 50)),
+        tail_filter_width: Param(0.0, (0.0, 10.0)),
+        time_filter_weight: Param(0.0, (0.0, 1.0)),
+        n_output_segments: Param(9, (1, 30)),
+        reset_zero: Param(False),
+        min_confidence: Param(0.0, (0.0, 1.0)),
         **extraparams
     ):
-        """Tail tracing based on min (or max) detection on arches. Wraps
-        _tail_trace_core_ls. Speed testing: 20 us for a 514x640 image without
-        smoothing, 300 us with smoothing.
+        """Tail tracing based on max detection on arches. Wraps
+        _trace_tail_arcs.
 
         Parameters
         ----------
-        img :
-            input image
+        im :
+            image to process, the tail has to be brighter than the background
         tail_start :
-            tail starting point (x, y) (Default value = (0)
+            starting point (y, x), relative to the image height
         tail_length :
-            tail length (Default value = (1)
+            tail length (y, x), relative to the image height
         n_segments :
             number of segments (Default value = 7)
-        dark_tail :
-            True for inverting image colors (Default value = False)
-        im :
-
-        0) :
-
-        1) :
-
-        image_scale :
-             (Default value = 1)
+        tail_filter_width :
+            width of the smoothing of the angles along the tail
+        time_filter_weight :
+            weight of the previous angles in the temporal filtering
+        n_output_segments :
+            number of angles in the output
+        reset_zero :
+            if True, the current angles are taken as the resting ones
+        min_confidence :
+            the tracing stops if the maximum on an arch falls below this
+            fraction of the one on the first arch
 
         Returns
         -------
+        NodeOutput with the tail sum, the angles and the confidence
 
         """
+        messages = []
         start_y, start_x = tail_start
         tail_length_y, tail_length_x = tail_length
 
-        scale = im.shape[0]
-
-        # Calculate tail length:
-        length_tail = np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale
-
-        # Initial displacements in x and y:
-        disp_x = tail_length_x * scale / n_segments
-        disp_y = tail_length_y * scale / n_segments
-
-        start_x *= scale
-        start_y *= scale
-
-        # Use jitted function for the actual calculation:
-        angle_list = _tail_trace_core_ls(
-            im, start_x, start_y, disp_x, disp_y, n_segments, length_tail
+        # the image might be cropped around the tail by the pipeline
+        scale = (self.input_shape or im.shape)[0]
+        offset_y, offset_x = self.input_offset
+
+        angles, intensities, i_missing = _trace_tail_arcs(
+            im,
+            start_x * scale - offset_x,
+            start_y * scale - offset_y,
+            np.arctan2(tail_length_x, tail_length_y),
+            np.sqrt(tail_length_x ** 2 + tail_length_y ** 2) * scale / n_segments,
+            n_segments,
+            _FIRST_ARC,
+            _ARC,
+            min_confidence,
         )
+        messages.extend(self._stop_messages(intensities, i_missing))
 
-        return angle_list
+        return self._output_angles(
+            messages,
+            angles,
+            intensities,
+            tail_filter_width,
+            time_filter_weight,
+            n_output_segments,
+            reset_zero,
+        )
 
 
-@jit(nopython=True)
+@jit(nopython=True, nogil=True)
 def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
     """Find the endpoint of the next tail segment
     by calculating the moments in a look-ahead area
@@ -289,11 +645,10 @@ def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
         initial displacement x
     dy :
         initial displacement y
-    wind_size :
-        size of the window to estimate next tail point
+    halfwin :
+        radius of the circular window to estimate next tail point
     next_point_dist :
         distance to the next tail point
-    halfwin :
 
 
     Returns
@@ -301,31 +656,42 @@ def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
 
     """
 
-    # Generate square window for center of mass
-    halfwin2 = halfwin ** 2
+    # the window is centered on the look-ahead point
     y_max, x_max = fc.shape
-    xs = min(max(int(round(xm + dx - halfwin)), 0), x_max)
-    xe = min(max(int(round(xm + dx + halfwin)), 0), x_max)
-    ys = min(max(int(round(ym + dy - halfwin)), 0), y_max)
-    ye = min(max(int(round(ym + dy + halfwin)), 0), y_max)
+    xc = xm + dx
+    yc = ym + dy
 
-    # at the edge returns invalid data
-    if xs == xe and ys == ye:
-        return -1, -1, 0, 0, 0
-
-    # accumulators
+    # accumulators, summed row by row over the pixels of the window,
+    # which are contiguous. The pixels at the ends of each row are weighted
+    # by the fraction covered by the window, so that the center of mass
+    # moves continuously with the window, even when it is small
     acc = 0.0
     acc_x = 0.0
     acc_y = 0.0
-    for x in range(xs, xe):
-        for y in range(ys, ye):
-            lx = (xs + halfwin - x) ** 2
-            ly = (ys + halfwin - y) ** 2
-            if lx + ly <= halfwin2:
-                acc_x += x * fc[y, x]
-                acc_y += y * fc[y, x]
-                acc += fc[y, x]
-
+    for y in range(
+        max(int(np.ceil(yc - halfwin)), 0), min(int(np.floor(yc + halfwin)) + 1, y_max)
+    ):
+        row_halfwin = np.sqrt(halfwin ** 2 - (y - yc) ** 2)
+        row_start = xc - row_halfwin
+        row_end = xc + row_halfwin
+        x_first = int(np.floor(row_start + 0.5))
+        x_last = int(np.floor(row_end + 0.5))
+        row = fc[y]
+        row_acc = 0.0
+        row_acc_x = 0.0
+        for x in range(max(x_first, 0), min(x_last, x_max - 1) + 1):
+            val = row[x]
+            if x == x_first:
+                val = val * (min(x + 0.5, row_end) - row_start)
+            elif x == x_last:
+                val = val * (row_end - (x - 0.5))
+            row_acc += val
+            row_acc_x += val * x
+        acc += row_acc
+        acc_x += row_acc_x
+        acc_y += row_acc * y
+
+    # at the edge, or if the window is empty returns invalid data
     if acc == 0:
         return -1, -1, 0, 0, 0
 
@@ -347,82 +713,305 @@ def _next_segment(fc, xm, ym, dx, dy, halfwin, next_point_dist):
     return xm + dx, ym + dy, dx, dy, acc
 
 
-@jit(nopython=True)
-def _tail_trace_core_ls(img, start_x, start_y, disp_x, disp_y, num_points, tail_length):
-    """Tail tracing based on min (or max) detection on arches. Wrapped by
-    trace_tail_angular_sweep.
+@jit(nopython=True, nogil=True)
+def _trace_tail_centroid(
+    im, start_x, start_y, disp_x, disp_y, halfwin, seg_length, n_segments, min_confidence
+):
+    """Traces the tail segment by segment with _next_segment. The tracing
+    stops if the mean intensity in the window falls below min_confidence
+    times the one of the first segment.
+
+    Returns
+    -------
+    the absolute angles of the n_segments - 1 segments (NaN after a segment
+    which was not found), the mean intensities in the windows
+    and the number of the first segment not found, 0 if all were
+
+    """
+    angles = np.full(n_segments - 1, np.nan)
+    intensities = np.full(n_segments - 1, np.nan)
+    for i in range(1, n_segments):
+        # Use next segment function for find next point
+        # with center-of-mass displacement:
+        start_x, start_y, disp_x, disp_y, acc = _next_segment(
+            im, start_x, start_y, disp_x, disp_y, halfwin, seg_length
+        )
+        intensities[i - 1] = acc / (np.pi * halfwin ** 2)
+        if start_x < 0 or intensities[i - 1] < min_confidence * intensities[0]:
+            return angles, intensities, i
+
+        angles[i - 1] = np.arctan2(disp_x, disp_y)
+    return angles, intensities, 0
+
+
+# the weight of the bend of the segments in the previous frame
+# in the starting direction of the warm-started search
+_WARM_BEND_WEIGHT = 0.5
+
+
+@jit(nopython=True, nogil=True)
+def _trace_tail_centroid_warm(
+    im,
+    start_x,
+    start_y,
+    disp_x,
+    disp_y,
+    halfwin,
+    warm_halfwin,
+    seg_length,
+    n_segments,
+    previous_angles,
+    previous_intensities,
+    warm_min_confidence,
+    min_confidence,
+):
+    """Traces the tail segment by segment as _trace_tail_centroid, but looks
+    for each segment first in the direction expected from the previous frame,
+    with a smaller window. If the segment was not found there, as the mean
+    intensity in the window dropped or the segment moved to the edge
+    of the window, the full window is used.
 
     Parameters
     ----------
-    img :
-        
-    start_x :
-        
-    start_y :
-        
-    disp_x :
-        
-    disp_y :
-        
-    num_points :
-        
-    tail_length :
+    warm_halfwin :
+        radius of the window for the search in the previous direction
+    previous_angles :
+        absolute angles of the segments in the previous frame, NaN
+        for the segments which have to be searched for with the full window
+    previous_intensities :
+        mean intensities in the windows in the previous frame
+    warm_min_confidence :
+        fraction of the previous mean intensity below which the
+        search in the previous direction is discarded
+    min_confidence :
+        fraction of the mean intensity of the first segment below which
+        the tracing stops
 
+    Returns
+    -------
+    the absolute angles of the n_segments - 1 segments (NaN after a segment
+    which was not found), the mean intensities in the windows
+    and the number of the first segment not found, 0 if all were
+
+    """
+    angles = np.full(n_segments - 1, np.nan)
+    intensities = np.full(n_segments - 1, np.nan)
+    for i in range(1, n_segments):
+        found = False
+        previous_angle = previous_angles[i - 1]
+        if not np.isnan(previous_angle):
+            # the segment is expected to be bent relative to the previous
+            # one as in the previous frame. As the center of mass is biased
+            # towards the center of the window, the bend is weighted down,
+            # otherwise the errors would build up from frame to frame
+            if i > 1:
+                previous_angle = (
+                    np.arctan2(disp_x, disp_y)
+                    + (previous_angle - previous_angles[i - 2]) * _WARM_BEND_WEIGHT
+                )
+            x, y, dx, dy, acc = _next_segment(
+                im,
+                start_x,
+                start_y,
+                seg_length * np.sin(previous_angle),
+                seg_length * np.cos(previous_angle),
+                warm_halfwin,
+                seg_length,
+            )
+            intensity = acc / (np.pi * warm_halfwin ** 2)
+            found = (
+                x >= 0
+                and intensity >= warm_min_confidence * previous_intensities[i - 1]
+                and abs(reduce_to_pi(np.arctan2(dx, dy) - previous_angle))
+                * seg_length
+                <= warm_halfwin / 2
+            )
+        if not found:
+            x, y, dx, dy, acc = _next_segment(
+                im, start_x, start_y, disp_x, disp_y, halfwin, seg_length
+            )
+            intensity = acc / (np.pi * halfwin ** 2)
+
+        intensities[i - 1] = intensity
+        if x < 0 or intensity < min_confidence * intensities[0]:
+            return angles, intensities, i
+
+        start_x, start_y, disp_x, disp_y = x, y, dx, dy
+        angles[i - 1] = np.arctan2(disp_x, disp_y)
+    return angles, intensities, 0
+
+
+@jit(nopython=True, parallel=True)
+def _trace_tails_centroid(
+    im,
+    starts_x,
+    starts_y,
+    disps_x,
+    disps_y,
+    halfwin,
+    seg_lengths,
+    n_segments,
+    min_confidence,
+):
+    """Traces several tails in parallel with _trace_tail_centroid
 
     Returns
     -------
+    arrays of the angles of the segments of each tail and of the mean
+    intensities around them, and the array of the numbers of the first
+    segments not found
 
     """
-    # Define starting angle based on tail dimensions:
-    start_angle = np.arctan2(disp_x, disp_y)
-
-    # Initialise first angle arch, tail sum and angle list:
-    pi2 = np.pi / 2
-    lin = np.linspace(-pi2 + start_angle, pi2 + start_angle, 25)
-    tail_sum = 0.0
-    angles = np.zeros(num_points + 1)
-
-    # Create vector of intensities along the arch:
-    intensity_vect = np.zeros(len(lin), dtype=np.int16)
-    seglen = tail_length / num_points
-
-    for j in range(num_points):  # Cycle on segments
-        # Transform arch angles in x and y coordinates:
-        xs = start_x + seglen * np.sin(lin)
-        ys = start_y + seglen * np.cos(lin)
-
-        # fill the vector of intensities along the arch
-        for i in range(len(xs)):
-            yp = int(ys[i])
-            xp = int(xs[i])
-            if (
-                img.shape[1] > xp >= 0 and 0 <= yp < img.shape[0]
-            ):  # check image boundaries
-                intensity_vect[i] = img[yp, xp]
+    n_tails = len(starts_x)
+    angles = np.empty((n_tails, n_segments - 1))
+    intensities = np.empty((n_tails, n_segments - 1))
+    i_missing = np.zeros(n_tails, dtype=np.int64)
+    for i_tail in prange(n_tails):
+        (
+            angles[i_tail, :],
+            intensities[i_tail, :],
+            i_missing[i_tail],
+        ) = _trace_tail_centroid(
+            im,
+            starts_x[i_tail],
+            starts_y[i_tail],
+            disps_x[i_tail],
+            disps_y[i_tail],
+            halfwin,
+            seg_lengths[i_tail],
+            n_segments,
+            min_confidence,
+        )
+    return angles, intensities, i_missing
 
-        # Find minimum or maximum of the arch.
-        # This switch is much faster than inverting the entire image.
-        ident = np.argmax(intensity_vect)
 
-        if not np.isnan(lin[ident]):
-            new_angle = lin[ident]
-        else:
-            new_angle = angles[j]
+def _arc_table(n_points):
+    """Precomputes the angles of the points on an arc spanning pi, relative
+    to the direction of the previous segment, and their cosines and sines
+
+    Returns
+    -------
+    array of shape (3, n_points) with the angles, cosines and sines
 
-        new_angle = reduce_to_pi(new_angle)
+    """
+    angles = np.linspace(-np.pi / 2, np.pi / 2, n_points)
+    return np.stack([angles, np.cos(angles), np.sin(angles)])
+
+
+# the first arc is sampled more finely as the initial direction is less certain
+_FIRST_ARC = _arc_table(25)
+_ARC = _arc_table(20)
+
+
+@jit(nopython=True, nogil=True)
+def _bilinear(img, x, y):
+    """Interpolates the image at (x, y), returns -1 outside of the image"""
+    x0 = int(np.floor(x))
+    y0 = int(np.floor(y))
+    if x0 < 0 or y0 < 0 or x0 + 1 >= img.shape[1] or y0 + 1 >= img.shape[0]:
+        return -1.0
+    fx = x - x0
+    fy = y - y0
+    return (img[y0, x0] * (1 - fx) + img[y0, x0 + 1] * fx) * (1 - fy) + (
+        img[y0 + 1, x0] * (1 - fx) + img[y0 + 1, x0 + 1] * fx
+    ) * fy
+
+
+@jit(nopython=True, nogil=True)
+def _trace_tail_arcs(
+    img,
+    start_x,
+    start_y,
+    start_angle,
+    seg_length,
+    n_segments,
+    first_arc,
+    arc,
+    min_confidence,
+):
+    """Tail tracing based on max detection on arches. The arches are sampled
+    with bilinear interpolation, at angles from the tables computed by
+    _arc_table, so only the sine and cosine of the direction of each
+    segment have to be computed. The angle of the maximum is refined
+    by fitting a parabola to the samples around it.
 
-        # skip the first angle for the tail sum
-        if j > 0:
-            tail_sum += reduce_to_pi(new_angle - angles[j])
+    Parameters
+    ----------
+    img :
+        image, with the tail brighter than the background
+    start_x :
+        x of the tail start
+    start_y :
+        y of the tail start
+    start_angle :
+        direction of the tail, as arctan2(x, y)
+    seg_length :
+        length of each segment
+    n_segments :
+        number of segments
+    first_arc :
+        arc table for the first segment
+    arc :
+        arc table for the following segments
+    min_confidence :
+        fraction of the maximum on the first arch below which the tracing stops
 
-        angles[j + 1] = new_angle
+    Returns
+    -------
+    the absolute angles of the segments (NaN after a segment
+    which was not found), the maxima on the arches
+    and the number of the first segment not found, 0 if all were
 
-        # The point found will be the starting point of the next arc
-        start_x = xs[ident]
-        start_y = ys[ident]
+    """
+    angles = np.full(n_segments, np.nan)
+    intensities = np.full(n_segments, np.nan)
+    values = np.empty(max(first_arc.shape[1], arc.shape[1]))
+    angle = start_angle
+    table = first_arc
+    for j in range(n_segments):
+        sin_angle = np.sin(angle)
+        cos_angle = np.cos(angle)
+
+        # find the brightest point of the arch
+        i_max = -1
+        for i in range(table.shape[1]):
+            # the sine and cosine of the angle plus the one of the arc point
+            sin_point = sin_angle * table[1, i] + cos_angle * table[2, i]
+            cos_point = cos_angle * table[1, i] - sin_angle * table[2, i]
+            values[i] = _bilinear(
+                img, start_x + seg_length * sin_point, start_y + seg_length * cos_point
+            )
+            if values[i] >= 0 and (i_max < 0 or values[i] > values[i_max]):
+                i_max = i
+
+        # the whole arch is outside of the image
+        if i_max < 0:
+            return angles, intensities, j + 1
+
+        intensities[j] = values[i_max]
+        if intensities[j] < min_confidence * intensities[0]:
+            return angles, intensities, j + 1
+
+        d_angle = table[0, i_max]
+        if (
+            0 < i_max < table.shape[1] - 1
+            and values[i_max - 1] >= 0
+            and values[i_max + 1] >= 0
+        ):
+            curvature = values[i_max - 1] - 2 * values[i_max] + values[i_max + 1]
+            if curvature < 0:
+                d_angle += (
+                    (values[i_max - 1] - values[i_max + 1])
+                    / (2 * curvature)
+                    * (table[0, 1] - table[0, 0])
+                )
+
+        angle = reduce_to_pi(angle + d_angle)
+        angles[j] = angle
 
-        # Create an 120 deg angle depending on the previous one:
-        lin = np.linspace(new_angle - pi2, new_angle + pi2, 20)
+        # The point found will be the starting point of the next arc
+        start_x += seg_length * np.sin(angle)
+        start_y += seg_length * np.cos(angle)
+        table = arc
 
-    angles[0] = tail_sum
-    return angles
+    return angles, intensities, 0
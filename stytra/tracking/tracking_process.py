@@ -1,7 +1,13 @@
 from queue import Empty, Full
 from multiprocessing import Event, Value
+from datetime import datetime
+from time import sleep, perf_counter
+
+from collections import namedtuple
 
 from stytra.utilities import FrameProcess
+from stytra.collectors.namedtuplequeue import NamedTupleQueue
+from stytra.collectors.parameterblock import ParameterBlock
 from arrayqueues.shared_arrays import TimestampedArrayQueue
 
 
@@ -22,11 +28,15 @@ class TrackingProcess(FrameProcess):
         in_frame_queue,
         finished_signal: Event = None,
         pipeline=None,
-        processing_parameter_queue=None,
+        parameter_block=None,
         output_queue=None,
         recording_signal=None,
         gui_framerate=30,
         max_mb_queue=100,
+        record_output=False,
+        branch_threads=0,
+        timing_interval=None,
+        gui_queue=None,
         **kwargs
     ):
         """
@@ -40,8 +50,8 @@ class TrackingProcess(FrameProcess):
             signal for the end of the acquisition
         pipeline: Pipeline
             tracking pipeline
-        processing_parameter_queue
-            queue for function&parameters
+        parameter_block: ParameterBlock
+            shared memory with the changes of the tracking parameters
         output_queue:
             tracking output queue
         recording_signal: bool (false)
@@ -54,13 +64,34 @@ class TrackingProcess(FrameProcess):
         max_mb_queue: int (200)
             the maximal size of the image output queues
 
+        record_output: bool (False)
+            if True, the pipeline writes its output in a preallocated
+            structured array instead of creating a namedtuple every frame
+
+        branch_threads: int (0)
+            if larger than 1, number of threads used to run independent
+            branches of the pipeline concurrently
+
+        timing_interval: float (None)
+            if set, the processing time of each pipeline node is recorded
+            and its statistics over this interval (in seconds) are sent
+            through the timing_queue
+
+        gui_queue: TimestampedArrayQueue (None)
+            the queue for frames to be displayed, if not given a new one
+            is created
+
         kwargs
         """
 
         super().__init__(name="tracking", **kwargs)
 
         self.frame_queue = in_frame_queue
-        self.gui_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)  # GUI queue for
+        # GUI queue for
+        if gui_queue is None:
+            self.gui_queue = TimestampedArrayQueue(max_mbytes=max_mb_queue)
+        else:
+            self.gui_queue = gui_queue
 
         self.recording_signal = recording_signal
         if recording_signal is not None:
@@ -71,13 +102,22 @@ class TrackingProcess(FrameProcess):
         #  displaying
         #  the image
         self.output_queue = output_queue  # queue for processing output (e.g., pos)
-        self.processing_parameter_queue = processing_parameter_queue
+        self.parameter_block = parameter_block
 
         self.finished_signal = finished_signal
         self.gui_framerate = gui_framerate
 
         self.pipeline_cls = pipeline
         self.pipeline = None
+        self.record_output = record_output
+        self.branch_threads = branch_threads
+
+        self.timing_interval = timing_interval
+        if timing_interval is not None:
+            self.timing_queue = NamedTupleQueue()
+        else:
+            self.timing_queue = None
+        self.last_timing_sent = None
 
         self.i = 0
 
@@ -98,62 +138,94 @@ class TrackingProcess(FrameProcess):
         """
 
     def retrieve_params(self):
-        while True:
-            try:
-                param_dict = self.processing_parameter_queue.get(timeout=0.0001)
-                self.pipeline.deserialize_params(param_dict)
-            except Empty:
-                break
+        param_dict = self.parameter_block.get()
+        if param_dict is not None:
+            self.pipeline.deserialize_params(param_dict)
 
     def run(self):
         """Loop where the tracking function runs."""
 
         self.pipeline = self.pipeline_cls()
-        self.pipeline.setup()
-
-        while not self.finished_signal.is_set():
+        self.pipeline.setup(
+            record_output=self.record_output,
+            branch_threads=self.branch_threads,
+            record_timing=self.timing_queue is not None,
+        )
 
-            # Gets the processing parameters from their queue
-            self.retrieve_params()
+        try:
+            while not self.finished_signal.is_set():
 
-            # Gets frame from its queue, if the input is too fast, drop frames
-            # and process the latest, if it is too slow continue:
-            try:
-                time, frame_idx, frame = self.frame_queue.get(timeout=0.001)
-            except Empty:
-                continue
+                # Gets the processing parameters from their queue
+                self.retrieve_params()
 
-            messages = []
-            # If we are copying the frames to another queue (e.g. for video recording), do it here
-            if self.recording_signal is not None and self.recording_signal.is_set():
+                # Gets frame from its queue, if the input is too fast, drop frames
+                # and process the latest, if it is too slow continue:
                 try:
-                    self.frame_copy_queue.put(frame.copy(), timestamp=time)
-                except:
-                    messages.append("W:Dropping frames from recording")
-
-            # If a processing function is specified, apply it:
-
-            new_messages, output = self.pipeline.run(frame)
-            for msg in messages + new_messages:
-                self.message_queue.put(msg)
-
-            self.output_queue.put(time, output)
-
-            # calculate the frame rate
-            self.update_framerate()
-
-            # put current frame into the GUI queue
-            self.send_to_gui(
-                time,
-                self.pipeline.diagnostic_image
-                if self.pipeline.diagnostic_image is not None
-                else frame,
-            )
-
+                    time, frame_idx, frame = self.frame_queue.get(timeout=0.001)
+                except Empty:
+                    continue
+
+                messages = []
+                # If we are copying the frames to another queue (e.g. for video recording), do it here
+                if (
+                    self.recording_signal is not None
+                    and self.recording_signal.is_set()
+                ):
+                    try:
+                        self.frame_copy_queue.put(frame.copy(), timestamp=time)
+                    except:
+                        messages.append("W:Dropping frames from recording")
+
+                # If a processing function is specified, apply it:
+
+                new_messages, output = self.pipeline.run(frame, time)
+                self.send_output(time, frame_idx, messages + new_messages, output)
+
+                # calculate the frame rate
+                self.update_framerate()
+
+                if self.timing_queue is not None:
+                    self.send_timing()
+
+                # put current frame into the GUI queue
+                self.send_to_gui(
+                    time,
+                    self.pipeline.diagnostic_image
+                    if self.pipeline.diagnostic_image is not None
+                    else frame,
+                )
+
+        finally:
+            # stop the threads of the pipeline even if tracking fails
+            self.pipeline.close()
         return
 
+    def send_output(self, time, frame_idx, messages, output):
+        """ Dispatches the messages and the tracking output of a frame"""
+        for msg in messages:
+            self.message_queue.put(msg)
+
+        self.output_queue.put(time, output)
+
+    def send_timing(self):
+        """ Sends the statistics of the processing time of the pipeline nodes
+        every timing_interval seconds"""
+        current_time = datetime.now()
+        if self.last_timing_sent is None:
+            self.last_timing_sent = current_time
+        elif (
+            current_time - self.last_timing_sent
+        ).total_seconds() > self.timing_interval:
+            stats = self.pipeline.timing_statistics()
+            if stats is not None:
+                self.timing_queue.put(current_time, stats)
+            self.last_timing_sent = current_time
+
     def send_to_gui(self, frametime, frame):
-        """ Sends the current frame to the GUI queue at the appropriate framerate"""
+        """ Sends the current frame to the GUI queue at the appropriate framerate.
+        The frame can also be a function computing it (as diagnostic images
+        of the pipeline nodes can be), which is called only if the frame is sent.
+        """
         if self.framerate_rec.current_framerate:
             every_x = max(
                 int(self.framerate_rec.current_framerate / self.gui_framerate), 1
@@ -161,6 +233,8 @@ class TrackingProcess(FrameProcess):
         else:
             every_x = 1
         if self.i == 0:
+            if callable(frame):
+                frame = frame()
             try:
                 self.gui_queue.put(frame, timestamp=frametime)
             except Full:
@@ -169,6 +243,183 @@ class TrackingProcess(FrameProcess):
         self.i = (self.i + 1) % every_x
 
 
+class TrackingWorker(TrackingProcess):
+    """ One of the processes of a ParallelTrackingProcess. It takes frames
+    from the camera queue, concurrently with the other workers, and sends
+    the outputs, tagged with the frame index, to the reordering process.
+    Only the first worker sends frames to the GUI and timing statistics.
+
+    """
+
+    def __init__(self, *args, i_worker=0, message_queue=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.i_worker = i_worker
+        self.message_queue = message_queue
+
+    def retrieve_params(self):
+        param_dict = self.parameter_block.get()
+        if param_dict is not None:
+            self.pipeline.deserialize_params(param_dict)
+            # the worker sees only some of the frames, so the nodes
+            # cannot use the previous ones
+            for node_path, changes in self.pipeline.disable_frame_dependence().items():
+                if self.i_worker == 0:
+                    self.message_queue.put(
+                        "W:{} of {} turned off with several workers".format(
+                            ", ".join(changes.keys()), node_path
+                        )
+                    )
+
+    def send_output(self, time, frame_idx, messages, output):
+        self.output_queue.put((time, frame_idx, messages), output)
+
+    def update_framerate(self):
+        # the framerate is sent by the reordering process, the one
+        # measured here is used just for dispatching to the GUI
+        self.framerate_rec.update_framerate()
+
+    def send_to_gui(self, frametime, frame):
+        if self.i_worker == 0:
+            super().send_to_gui(frametime, frame)
+
+
+class ParallelTrackingProcess(TrackingProcess):
+    """ Tracking with several worker processes, each running its own copy of
+    the pipeline on a subset of the frames. This process forwards
+    the parameters to the workers and puts the outputs on the output queue
+    in the order of the frames.
+
+    As each worker sees only some of the frames, pipelines with
+    stateful nodes (e.g. background subtraction or the tracking of fish
+    identities) cannot be run in parallel. The options of the other nodes
+    which depend on the previous frames (e.g. the temporal filtering of
+    tail angles) are kept off in the workers. Recording of the frames is
+    not supported.
+
+    """
+
+    def __init__(self, *args, n_workers=2, reorder_timeout=5.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.pipeline_cls is not None and self.pipeline_cls().stateful:
+            raise ValueError(
+                "Pipelines with stateful nodes cannot be run with several workers"
+            )
+        if self.recording_signal is not None:
+            raise ValueError("Recording is not supported with several workers")
+        self.n_workers = n_workers
+        self.reorder_timeout = reorder_timeout
+        self.worker_parameter_blocks = [ParameterBlock() for _ in range(n_workers)]
+        self.worker_output_queues = [NamedTupleQueue() for _ in range(n_workers)]
+
+        # outputs waiting for the ones of the previous frames, by frame index
+        self.pending_outputs = dict()
+        self.next_frame_idx = None
+        self.last_sent = None
+        self.started_workers = set()
+        self.first_received = None
+        self._output_type = None
+
+    def retrieve_params(self):
+        param_dict = self.parameter_block.get()
+        if param_dict is not None:
+            for block in self.worker_parameter_blocks:
+                block.put(param_dict)
+
+    def run(self):
+        workers = [
+            TrackingWorker(
+                in_frame_queue=self.frame_queue,
+                finished_signal=self.finished_signal,
+                pipeline=self.pipeline_cls,
+                parameter_block=parameter_block,
+                output_queue=output_queue,
+                gui_framerate=self.gui_framerate,
+                record_output=self.record_output,
+                branch_threads=self.branch_threads,
+                timing_interval=self.timing_interval if i_worker == 0 else None,
+                gui_queue=self.gui_queue,
+                i_worker=i_worker,
+                message_queue=self.message_queue,
+            )
+            for i_worker, (parameter_block, output_queue) in enumerate(
+                zip(self.worker_parameter_blocks, self.worker_output_queues)
+            )
+        ]
+        if self.timing_queue is not None:
+            workers[0].timing_queue = self.timing_queue
+        for worker in workers:
+            worker.start()
+
+        while not self.finished_signal.is_set():
+            self.retrieve_params()
+
+            received = False
+            for i_worker, queue in enumerate(self.worker_output_queues):
+                try:
+                    (time, frame_idx, messages), output = queue.get(block=False)
+                    received = True
+                    self.started_workers.add(i_worker)
+                    if self.first_received is None:
+                        self.first_received = perf_counter()
+                except Empty:
+                    continue
+                # outputs of frames which were skipped are discarded
+                if self.next_frame_idx is None or frame_idx >= self.next_frame_idx:
+                    self.pending_outputs[frame_idx] = (time, messages, output)
+
+            # the timeouts are checked even if nothing arrived
+            self.send_ordered()
+            if not received:
+                sleep(0.0001)
+
+        for worker in workers:
+            worker.join()
+
+    def send_ordered(self):
+        """ Sends all the outputs which are next in the frame order. The
+        camera numbers the frames consecutively and every frame is processed
+        by one of the workers, so a missing frame is usually still being
+        processed (e.g. while a worker compiles the numba functions).
+        If it does not arrive within reorder_timeout seconds, it is skipped.
+        """
+        if not self.pending_outputs:
+            return
+        if self.next_frame_idx is None:
+            # at the start, wait for the first output of every worker,
+            # the earliest of them is the first frame taken from the camera.
+            # A worker might get no frames, so the wait is limited
+            if (
+                len(self.started_workers) < self.n_workers
+                and perf_counter() - self.first_received < self.reorder_timeout
+            ):
+                return
+            self.next_frame_idx = min(self.pending_outputs.keys())
+        elif (
+            self.next_frame_idx not in self.pending_outputs
+            and perf_counter() - self.last_sent > self.reorder_timeout
+        ):
+            self.message_queue.put(
+                "W:Frame {} not tracked in time".format(self.next_frame_idx)
+            )
+            self.next_frame_idx = min(self.pending_outputs.keys())
+
+        while self.next_frame_idx in self.pending_outputs:
+            time, messages, output = self.pending_outputs.pop(self.next_frame_idx)
+            # each worker queue has its own output type, put the output in
+            # a common one so that the output queue sends the fields only on change
+            if (
+                self._output_type is None
+                or self._output_type._fields != output._fields
+            ):
+                self._output_type = namedtuple("o", output._fields)
+            super().send_output(
+                time, self.next_frame_idx, messages, self._output_type(*output)
+            )
+            self.update_framerate()
+            self.next_frame_idx += 1
+            self.last_sent = perf_counter()
+
+
 class DispatchProcess(FrameProcess):
     """ A class which handles taking frames from the camera and dispatch them to both a separate
     process (e.g. for saving a movie) and to a gui for display